@@ -2,7 +2,6 @@ import os
 import smtplib
 import yfinance as yf
 import ollama
-import schedule
 import time
 import random
 import datetime 
@@ -11,14 +10,31 @@ import pandas as pd
 import requests 
 from bs4 import BeautifulSoup 
 import json
+import ast
+import html.parser
 from dateutil import parser 
 from dotenv import load_dotenv
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import threading
 import queue
+import atexit
+import email
+import base64
+import socket
+import heapq
+import itertools
+import collections
+import asyncio
+import urllib.parse
+import tempfile
 import sys 
 
+try:
+    import fcntl # Rådgivande fil-lås mellan agentprocesser (finns inte på Windows)
+except ImportError:
+    fcntl = None
+
 # Ladda miljövariabler från .env-filen
 load_dotenv()
 
@@ -36,61 +52,159 @@ input_queue = queue.Queue()
 
 # --- KÄRNFUNKTIONER OCH PERSISTENS ---
 
-def get_current_wallet_balance() -> float:
-    """Hämtar det aktuella saldot från .env-filen (eller 500.00 om ej satt)."""
-    load_dotenv() # Reload .env to ensure fresh data if modified by another process
+STATE_CAS_RETRIES = 5 # Nya försök när en annan agentprocess hann ändra saldot först
+
+class FileLock:
+    """
+    Rådgivande lås (flock) på en låsfil, delat mellan alla agentprocesser i samma arbetskatalog.
+    Kan tas flera gånger av samma tråd (reentrant). Utan fcntl skyddar det bara trådarna i den egna processen.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        if self._depth == 0:
+            self._fd = open(self.path, 'a')
+            if fcntl:
+                fcntl.flock(self._fd.fileno(), fcntl.LOCK_EX)
+        self._depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._depth -= 1
+        if self._depth == 0:
+            if fcntl:
+                fcntl.flock(self._fd.fileno(), fcntl.LOCK_UN)
+            self._fd.close()
+            self._fd = None
+        self._thread_lock.release()
+
+def write_file_atomic(path: str, content: str):
+    """Skriver en fil via en temporär fil + os.replace, så att ingen läsare ser en halvskriven fil."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + ".", suffix=".tmp")
     try:
-        return float(os.environ.get("AGENT_WALLET_BALANCE", "500.0"))
-    except ValueError:
-        return 500.0
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
 
-def update_agent_state(new_version: float, birth_time: str, new_wallet_balance: float | None = None):
-    """Uppdaterar AGENT_VERSION, AGENT_BIRTH_TIME och AGENT_WALLET_BALANCE i .env filen."""
-    env_path = os.path.join(os.getcwd(), '.env')
-    
+ENV_PATH = os.path.join(os.getcwd(), '.env')
+ENV_LOCK = FileLock(ENV_PATH + ".lock")
+
+def read_agent_state() -> dict:
+    """
+    Läser .env direkt från disk. load_dotenv() skriver inte över variabler som redan finns i
+    os.environ, så den ser aldrig saldoändringar som andra agentprocesser har gjort.
+    """
+    state = {}
     try:
-        with open(env_path, 'r') as f:
-            lines = f.readlines()
+        with open(ENV_PATH, 'r') as f:
+            for line in f:
+                key, sep, value = line.strip().partition('=')
+                if sep and not key.startswith('#'):
+                    state[key.strip()] = value.strip().strip('"\'')
     except FileNotFoundError:
-        lines = []
+        pass
+    return state
+
+def get_wallet_snapshot() -> tuple[float, int]:
+    """Saldo och tillståndsversion (AGENT_STATE_VERSION), att skicka tillbaka som expected_state_version."""
+    with ENV_LOCK:
+        state = read_agent_state()
+    try:
+        balance = float(state.get("AGENT_WALLET_BALANCE", "500.0"))
+    except ValueError:
+        balance = 500.0
+    return balance, int(state.get("AGENT_STATE_VERSION", "0"))
 
-    wallet_balance = get_current_wallet_balance() if new_wallet_balance is None else new_wallet_balance
+def get_current_wallet_balance() -> float:
+    """Hämtar det aktuella saldot från .env-filen (eller 500.00 om ej satt)."""
+    return get_wallet_snapshot()[0]
 
-    version_line = f"AGENT_VERSION={new_version:.1f}\n"
-    birth_time_line = f"AGENT_BIRTH_TIME={birth_time}\n"
-    wallet_line = f"AGENT_WALLET_BALANCE={wallet_balance:.2f}\n"
-    
-    updated_lines = []
-    version_found = False
-    birth_time_found = False
-    wallet_found = False
-
-    for line in lines:
-        if line.strip().startswith('AGENT_VERSION='):
-            updated_lines.append(version_line)
-            version_found = True
-        elif line.strip().startswith('AGENT_BIRTH_TIME='):
-            updated_lines.append(birth_time_line) 
-            birth_time_found = True
-        elif line.strip().startswith('AGENT_WALLET_BALANCE='):
-            updated_lines.append(wallet_line)
-            wallet_found = True
+def update_agent_state(new_version: float, birth_time: str, new_wallet_balance: float | None = None,
+                       expected_state_version: int | None = None) -> bool:
+    """
+    Uppdaterar AGENT_VERSION, AGENT_BIRTH_TIME och AGENT_WALLET_BALANCE i .env filen.
+    Läs-ändra-skriv sker under ett fil-lås och filen ersätts atomiskt. Varje skrivning räknar upp
+    AGENT_STATE_VERSION; med expected_state_version skrivs bara om ingen annan process har ändrat
+    tillståndet sedan det lästes (compare-and-swap). Returnerar False om så var fallet.
+    Kan filen inte skrivas kastas OSError, så att ingen anropare tror att tillståndet sparats.
+    """
+    with ENV_LOCK:
+        try:
+            with open(ENV_PATH, 'r') as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            lines = []
+
+        state = read_agent_state()
+        state_version = int(state.get("AGENT_STATE_VERSION", "0"))
+        if expected_state_version is not None and state_version != expected_state_version:
+            return False
+
+        if new_wallet_balance is None:
+            try:
+                wallet_balance = float(state.get("AGENT_WALLET_BALANCE", "500.0"))
+            except ValueError:
+                wallet_balance = 500.0
         else:
-            updated_lines.append(line)
-
-    if not version_found:
-        updated_lines.append('\n' + version_line)
-    if not birth_time_found:
-        updated_lines.append(birth_time_line)
-    if not wallet_found:
-        updated_lines.append(wallet_line)
+            wallet_balance = new_wallet_balance
+
+        version_line = f"AGENT_VERSION={new_version:.1f}\n"
+        birth_time_line = f"AGENT_BIRTH_TIME={birth_time}\n"
+        wallet_line = f"AGENT_WALLET_BALANCE={wallet_balance:.2f}\n"
+        state_version_line = f"AGENT_STATE_VERSION={state_version + 1}\n"
         
-    try:
-        with open(env_path, 'w') as f:
-            f.writelines(updated_lines)
-        print(f"✅ Agentens tillstånd sparades automatiskt (V{new_version:.1f}, Saldo: {wallet_balance:.2f} kr).")
-    except Exception as e:
-        print(f"❌ FEL vid sparning till .env: {e}")
+        updated_lines = []
+        version_found = False
+        birth_time_found = False
+        wallet_found = False
+        state_version_found = False
+
+        for line in lines:
+            if line.strip().startswith('AGENT_VERSION='):
+                updated_lines.append(version_line)
+                version_found = True
+            elif line.strip().startswith('AGENT_BIRTH_TIME='):
+                updated_lines.append(birth_time_line) 
+                birth_time_found = True
+            elif line.strip().startswith('AGENT_WALLET_BALANCE='):
+                updated_lines.append(wallet_line)
+                wallet_found = True
+            elif line.strip().startswith('AGENT_STATE_VERSION='):
+                updated_lines.append(state_version_line)
+                state_version_found = True
+            else:
+                updated_lines.append(line)
+
+        if not version_found:
+            updated_lines.append('\n' + version_line)
+        if not birth_time_found:
+            updated_lines.append(birth_time_line)
+        if not wallet_found:
+            updated_lines.append(wallet_line)
+        if not state_version_found:
+            updated_lines.append(state_version_line)
+            
+        try:
+            write_file_atomic(ENV_PATH, "".join(updated_lines))
+            print(f"✅ Agentens tillstånd sparades automatiskt (V{new_version:.1f}, Saldo: {wallet_balance:.2f} kr).")
+        except OSError as e:
+            print(f"❌ FEL vid sparning till .env: {e}")
+            raise
+        return True
 
 
 def get_sentiment_score(title: str) -> float:
@@ -202,22 +316,783 @@ def get_llm_self_talk(ticker: str) -> str:
     except Exception as e:
         return "Tystnad. Buffalo Agentens inre monolog misslyckades på grund av ett AI-kommunikationsfel. Jag måste prata med Buffalo Balkan om detta."
 
+# --- PRISEXTRAKTION (STRUKTURERAD DATA FÖRST, SEDAN RIKTAD SÖKNING I RÅA BYTES) ---
+# En extraktor tar sidans råa bytes och returnerar (pris, beskrivning) eller None. extract_price provar
+# dem i ordning; BeautifulSoup-trädet och get_text() över hela sidan behövs inte längre.
+JSON_LD_RE = re.compile(rb'<script[^>]*type=["\']application/ld\+json["\'][^>]*>(.*?)</script>', re.S | re.I)
+EMBEDDED_JSON_RE = re.compile(rb'<script[^>]*id=["\']__NEXT_DATA__["\'][^>]*>(.*?)</script>', re.S | re.I)
+EMBEDDED_PRICE_KEYS = ('price', 'priceInclVat', 'currentPrice')
+PRICE_GAP = rb'(?:\s|&nbsp;|&#160;|\xc2\xa0|<[^<>]{0,120}>){0,8}' # Blanksteg och några taggar mellan belopp och "kr"
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+def _to_price(value) -> float | None:
+    try:
+        price = float(str(value).replace(',', '.').replace(':', '.'))
+    except (TypeError, ValueError):
+        return None
+    return price if price > 0 else None
+
+def _find_offer_price(node):
+    """Letar rekursivt efter offers.price (eller lowPrice) i ett JSON-LD-objekt."""
+    if isinstance(node, list):
+        for item in node:
+            price = _find_offer_price(item)
+            if price is not None:
+                return price
+    elif isinstance(node, dict):
+        if node.get('@type') in ('Offer', 'AggregateOffer'):
+            price = _to_price(node.get('price', node.get('lowPrice')))
+            if price is not None:
+                return price
+        for key in ('offers', '@graph', 'mainEntity'):
+            if key in node:
+                price = _find_offer_price(node[key])
+                if price is not None:
+                    return price
+    return None
+
+def extract_json_ld_price(html: bytes):
+    for match in JSON_LD_RE.finditer(html):
+        try:
+            data = json.loads(match.group(1))
+        except ValueError:
+            continue
+        price = _find_offer_price(data)
+        if price is not None:
+            return price, f"Pris hittat i sidans JSON-LD (schema.org Offer): {price:.2f} kr"
+    return None
+
+def _find_embedded_price(node, depth: int = 0):
+    """Första pris-nyckeln i inbäddad sid-JSON, bredden först så att produktens egna fält vinner över listor längre ner."""
+    level = [node]
+    while level and depth < 8:
+        next_level = []
+        for item in level:
+            values = item.values() if isinstance(item, dict) else item if isinstance(item, list) else ()
+            if isinstance(item, dict):
+                for key in EMBEDDED_PRICE_KEYS:
+                    if key in item and not isinstance(item[key], (dict, list)):
+                        price = _to_price(item[key])
+                        if price is not None:
+                            return price
+            next_level.extend(v for v in values if isinstance(v, (dict, list)))
+        level, depth = next_level, depth + 1
+    return None
+
+def extract_embedded_json_price(html: bytes):
+    match = EMBEDDED_JSON_RE.search(html)
+    if not match:
+        return None
+    try:
+        price = _find_embedded_price(json.loads(match.group(1)))
+    except ValueError:
+        return None
+    if price is not None:
+        return price, f"Pris hittat i sidans inbäddade produkt-JSON: {price:.2f} kr"
+    return None
+
+def raw_price_extractor(amount_pattern: bytes):
+    """Riktad regex direkt på bytes: belopp följt av 'kr', med blanksteg/taggar emellan, utanför <script>/<style>."""
+    price_re = re.compile(rb'>[^<]*?(' + amount_pattern + rb')' + PRICE_GAP + rb'k[rR]\b')
+    skip_re = re.compile(rb'<(script|style)\b.*?</\1>', re.S | re.I)
+    def extract(html: bytes):
+        position = 0
+        for skip in skip_re.finditer(html): # Sök bara i de delar som är synlig text
+            match = price_re.search(html, position, skip.start())
+            if match:
+                break
+            position = skip.end()
+        else:
+            match = price_re.search(html, position)
+        if match:
+            price = _to_price(match.group(1).decode('ascii'))
+            if price is not None:
+                return price, f"Pris hittat via riktad sökning i sidans HTML: {match.group(1).decode('ascii')} kr"
+        return None
+    return extract
+
+class _TextPriceScanner(html.parser.HTMLParser):
+    """Strömmande tokenizer: samlar synlig text (som get_text) och slutar vid första träffen."""
+    def __init__(self, pattern, separator: str):
+        super().__init__(convert_charrefs=True)
+        self.pattern, self.separator = pattern, separator
+        self.parts, self.skip_depth, self.match = [], 0, None
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ('script', 'style'):
+            self.skip_depth += 1
+
+    def handle_endtag(self, tag):
+        if tag in ('script', 'style') and self.skip_depth:
+            self.skip_depth -= 1
+
+    def handle_data(self, data):
+        if self.match or self.skip_depth or not data.strip():
+            return
+        self.parts.append(data.strip() if self.separator else data)
+        window = self.separator.join(self.parts[-6:]) # Ett pris kan vara uppdelat på några textnoder
+        self.match = self.pattern.search(window)
+
+def streamed_text_extractor(pattern: str, separator: str = ' ', chunk_size: int = 65536):
+    text_re = re.compile(pattern)
+    def extract(html: bytes):
+        scanner = _TextPriceScanner(text_re, separator)
+        text = html.decode('utf-8', errors='replace')
+        for start in range(0, len(text), chunk_size):
+            scanner.feed(text[start:start + chunk_size])
+            if scanner.match:
+                price = _to_price(scanner.match.group(1))
+                if price is not None:
+                    return price, f"Pris hittat via textsökning: {scanner.match.group(0)}"
+        return None
+    return extract
+
+def extract_price(html: bytes, extractors) -> tuple[float | None, str]:
+    """Provar extraktorerna i ordning och returnerar den första träffen."""
+    for extractor in extractors:
+        try:
+            result = extractor(html)
+        except Exception as e:
+            print(f"⚠️ Prisextraktorn {getattr(extractor, '__name__', extractor)} misslyckades: {e}")
+            continue
+        if result is not None:
+            return result
+    return None, "Kunde inte hitta något pris på sidan."
+
+SORT_GULD_EXTRACTORS = [
+    extract_json_ld_price,
+    extract_embedded_json_price,
+    raw_price_extractor(rb'\d+[.,:]\d{2}'),
+    streamed_text_extractor(r'(\d+[.,:]\d{2})\s*k[rR]'),
+]
+
+def parse_sort_guld_price(html: bytes) -> tuple[float | None, str]:
+    """Sort Guld-priset ur produktsidan via SORT_GULD_EXTRACTORS."""
+    price, description = extract_price(html, SORT_GULD_EXTRACTORS)
+    if price is None:
+        return None, f"Kunde inte hitta priset på sidan. URL: {SORT_GULD_URL}"
+    return price, description
+
+def benchmark_price_extraction(rounds: int = 20):
+    """Jämför tolkningstiden per fixture-sida: BeautifulSoup + get_text() mot extraktorkedjan."""
+    names = sorted(n for n in os.listdir(FIXTURE_DIR) if n.startswith('systembolaget_'))
+    print(f"⏱️ Tolkningstid per sida ({rounds} varv) för {len(names)} sidor i {FIXTURE_DIR}:")
+    for name in names:
+        with open(os.path.join(FIXTURE_DIR, name), 'rb') as f:
+            page = f.read()
+        start = time.perf_counter()
+        for _ in range(rounds):
+            text = BeautifulSoup(page, 'html.parser').get_text(separator=' ', strip=True)
+            old_match = re.search(r'(\d+[.,:]\d{2})\s*k[rR]', text)
+        old_ms = (time.perf_counter() - start) / rounds * 1000
+        start = time.perf_counter()
+        for _ in range(rounds):
+            price, description = parse_sort_guld_price(page)
+        new_ms = (time.perf_counter() - start) / rounds * 1000
+        old_price = _to_price(old_match.group(1)) if old_match else None
+        status = "✅" if old_price == price else f"⚠️ olika pris (gammalt {old_price})"
+        print(f"   {name:<42} {len(page) / 1024:6.0f} KB  BeautifulSoup {old_ms:8.2f} ms  extraktor {new_ms:7.2f} ms  "
+              f"({old_ms / new_ms:5.0f}x)  {price} kr {status}")
+        print(f"      -> {description}")
+
+# --- HTTP-HÄMTNING FÖR SKRAPNING (VILLKORLIG GET, PRISCACHE, DELAD HÄMTNING) ---
+SCRAPE_CACHE_FILE = "agent_scrape_cache.json"
+SCRAPE_TIMEOUT_S = 10
+BEER_PRICE_TTL_S = int(os.environ.get("BEER_PRICE_TTL_S", 900)) # Så här länge räknas ett tolkat ölpris som färskt
+SORT_GULD_URL = "https://www.systembolaget.se/produkt/ol/carlsberg-sort-guld-129115/"
+
+class PageFetcher:
+    """
+    Gemensam hämtning av webbsidor för skrapningen. Tolkade värden (t.ex. ett pris) cachas per URL och
+    tolkare med en TTL, så de flesta kontroller aldrig går ut på nätet. När TTL:en gått ut görs en
+    villkorlig GET (If-None-Match/If-Modified-Since med sidans ETag/Last-Modified); svarar servern 304
+    återanvänds det tolkade värdet utan nedladdning eller ny tolkning. Samtidiga anrop mot samma URL
+    delar en enda pågående hämtning. Validerare och tolkade värden sparas i SCRAPE_CACHE_FILE så att
+    cachen överlever omstart; själva sidan hålls bara i minnet.
+    """
+    def __init__(self, cache_path: str = SCRAPE_CACHE_FILE):
+        self.cache_path = cache_path
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = 'Mozilla/5.0'
+        self.lock = threading.Lock()
+        self._entries = self._load()     # URL -> {'etag', 'last_modified', 'parsed': {nyckel: [värde, beskrivning, tid]}}
+        self._bodies = {}                # URL -> senast nedladdade sida (bytes)
+        self._inflight = {}              # (URL, nyckel) -> {'done': Event, 'result'} för den pågående hämtningen
+        self.stats = {'hits': 0, 'not_modified': 0, 'downloads': 0, 'shared': 0, 'errors': 0}
+
+    def _load(self) -> dict:
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self):
+        with self.lock:
+            content = json.dumps(self._entries, indent=2, ensure_ascii=False)
+        try:
+            write_file_atomic(self.cache_path, content)
+        except OSError as e:
+            print(f"⚠️ Kunde inte spara skrapcachen: {e}")
+
+    def _fresh(self, url: str, key: str, ttl_s: float):
+        parsed = self._entries.get(url, {}).get('parsed', {}).get(key)
+        if parsed and parsed[0] is not None and time.time() - parsed[2] < ttl_s:
+            return parsed
+        return None
+
+    def get_parsed(self, url: str, parse, key: str, ttl_s: float) -> tuple:
+        """
+        Returnerar (värde, beskrivning) för sidan tolkad med parse(bytes) -> (värde, beskrivning).
+        Färskt cachat värde -> direkt; annars villkorlig GET, delad med samtidiga anrop för samma URL.
+        """
+        with self.lock:
+            parsed = self._fresh(url, key, ttl_s)
+            if parsed:
+                self.stats['hits'] += 1
+                return parsed[0], f"{parsed[1]} (cachat {int(time.time() - parsed[2])} s)"
+            flight = self._inflight.get((url, key))
+            leader = flight is None
+            if leader:
+                flight = self._inflight[(url, key)] = {'done': threading.Event(), 'result': (None, "Hämtningen misslyckades.")}
+            else:
+                self.stats['shared'] += 1
+        if not leader:
+            flight['done'].wait() # En annan tråd hämtar redan sidan; använd dess resultat
+            return flight['result']
+        try:
+            flight['result'] = self._fetch_and_parse(url, parse, key)
+            return flight['result']
+        finally:
+            with self.lock:
+                del self._inflight[(url, key)]
+            flight['done'].set()
+
+    def _fetch_and_parse(self, url: str, parse, key: str) -> tuple:
+        with self.lock:
+            entry = self._entries.get(url, {})
+            body = self._bodies.get(url)
+            cached = entry.get('parsed', {}).get(key)
+        if cached and cached[0] is None:
+            cached = None # Ett misslyckat tolkningsresultat återanvänds aldrig; sidan tolkas om
+        headers = {}
+        if body is not None or cached:  # Utan sida eller tolkat värde att falla tillbaka på måste hela sidan hämtas
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        try:
+            response = self.session.get(url, headers=headers, timeout=SCRAPE_TIMEOUT_S)
+            if response.status_code == 304:
+                with self.lock:
+                    self.stats['not_modified'] += 1
+                if cached:
+                    value, description = cached[0], cached[1]
+                else:
+                    value, description = parse(body)
+            else:
+                response.raise_for_status()
+                body = response.content
+                with self.lock:
+                    self.stats['downloads'] += 1
+                    self._bodies[url] = body
+                    entry = {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified'), 'parsed': {}}
+                value, description = parse(body)
+        except Exception as e:
+            with self.lock:
+                self.stats['errors'] += 1
+            if cached:
+                return cached[0], f"{cached[1]} (cachat värde från {time.strftime('%H:%M', time.localtime(cached[2]))}; hämtningen misslyckades: {e})"
+            return None, f"Generellt fel vid web scraping: {e}."
+        with self.lock:
+            entry.setdefault('parsed', {})[key] = [value, description, time.time()]
+            self._entries[url] = entry
+        self._save()
+        return value, description
+
+_page_fetcher = None
+_page_fetcher_lock = threading.Lock()
+
+def get_page_fetcher() -> PageFetcher:
+    """Returnerar den delade sidhämtaren (skapas vid första anropet)."""
+    global _page_fetcher
+    with _page_fetcher_lock:
+        if _page_fetcher is None:
+            _page_fetcher = PageFetcher()
+    return _page_fetcher
+
 def get_sort_guld_price() -> tuple[float | None, str]:
-    URL = "https://www.systembolaget.se/produkt/ol/carlsberg-sort-guld-129115/"
-    headers = {'User-Agent': 'Mozilla/5.0'}
+    """Sort Guld-priset; delas mellan ölprisrapporten och ölköpen via sidhämtarens cache."""
+    return get_page_fetcher().get_parsed(SORT_GULD_URL, parse_sort_guld_price, key='sort_guld_price', ttl_s=BEER_PRICE_TTL_S)
+
+# --- PRISBEVAKNING AV FLERA PRODUKTER (ASYNCIO, BEGRÄNSAT ANTAL SAMTIDIGA HÄMTNINGAR PER VÄRD) ---
+WATCHLIST_FILE = os.environ.get("WATCHLIST_FILE", "agent_watchlist.json")
+PRICE_SERIES_FILE = "agent_price_series.jsonl"
+WATCH_INTERVAL_S = int(os.environ.get("WATCH_INTERVAL_S", 1800))
+WATCH_PER_HOST = int(os.environ.get("WATCH_PER_HOST", 2))   # Samtidiga hämtningar mot samma värd
+WATCH_SERIES_LENGTH = 500                                   # Noteringar per produkt som hålls i minnet
+# Används om WATCHLIST_FILE saknas. Trösklar per produkt (alla valfria):
+#   buy_below        köp när priset går ner till/under nivån
+#   alert_below      larm när priset går ner till/under nivån
+#   alert_above      larm när priset går upp till/över nivån
+#   alert_change_pct larm när priset ändrats minst så många procent sedan förra noteringen
+DEFAULT_WATCHLIST = [{"name": "Carlsberg Sort Guld", "url": SORT_GULD_URL, "alert_change_pct": 10.0}]
+
+def load_watchlist(path: str = WATCHLIST_FILE) -> list[dict]:
+    """Läser bevakningslistan (JSON-lista med name, url och trösklar)."""
     try:
-        response = requests.get(URL, headers=headers, timeout=10)
-        response.raise_for_status() 
-        soup = BeautifulSoup(response.content, 'html.parser')
-        page_text = soup.get_text(separator=' ', strip=True)
-        price_match = re.search(r'(\d+[.,:]\d{2})\s*k[rR]', page_text)
-        if price_match:
-            price_str = price_match.group(1).replace(',', '.').replace(':', '.')
-            price = float(price_str)
-            return price, f"Pris hittat via aggressiv textsökning: {price_match.group(0)}"
-        return None, f"Kunde inte hitta priset i texten på sidan. URL: {URL}"
-    except Exception as e:
-        return None, f"Generellt fel vid web scraping: {e}."
+        with open(path, 'r', encoding='utf-8') as f:
+            watchlist = json.load(f)
+    except FileNotFoundError:
+        return DEFAULT_WATCHLIST
+    except ValueError as e:
+        print(f"⚠️ Kunde inte läsa {path}: {e}. Använder standardlistan.")
+        return DEFAULT_WATCHLIST
+    valid = [p for p in watchlist if isinstance(p, dict) and p.get('name') and p.get('url')]
+    if len(valid) != len(watchlist):
+        print(f"⚠️ {len(watchlist) - len(valid)} post(er) i {path} saknar name/url och hoppas över.")
+    return valid
+
+def parse_product_price(html: bytes) -> tuple[float | None, str]:
+    return extract_price(html, SORT_GULD_EXTRACTORS)
+
+class PriceWatcher:
+    """
+    Bevakar produkterna i WATCHLIST_FILE. En kontroll hämtar alla sidor parallellt med asyncio, med högst
+    WATCH_PER_HOST samtidiga hämtningar per värd (hämtningen sker via PageFetcher i asyncio.to_thread, så
+    villkorlig GET och priscache gäller även här). Varje pris läggs till produktens tidsserie (i minnet och
+    i PRICE_SERIES_FILE), och passerade trösklar ger händelser som price_watch_job kör köp/larm för.
+    En tröskel ger bara en händelse när den passeras, inte vid varje kontroll under nivån.
+    """
+    def __init__(self, watchlist_path: str = WATCHLIST_FILE, series_path: str = PRICE_SERIES_FILE,
+                 per_host: int = WATCH_PER_HOST, fetcher: PageFetcher | None = None, ttl_s: float = WATCH_INTERVAL_S / 2):
+        self.watchlist_path = watchlist_path
+        self.series_path = series_path
+        self.per_host = per_host
+        self.ttl_s = ttl_s # Så länge ett hämtat pris räknas som färskt (0 = villkorlig GET varje gång)
+        self.fetcher = fetcher or get_page_fetcher()
+        self.lock = threading.Lock()
+        self.series = collections.defaultdict(lambda: collections.deque(maxlen=WATCH_SERIES_LENGTH))
+        self._load_series()
+
+    def _load_series(self):
+        try:
+            with open(self.series_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        point = json.loads(line)
+                        self.series[point['product']].append((point['t'], point['price']))
+                    except (ValueError, KeyError):
+                        continue # Halvskriven sista rad efter en krasch
+        except FileNotFoundError:
+            pass
+
+    def _record(self, name: str, price: float, ts: float):
+        with self.lock:
+            self.series[name].append((ts, price))
+            with open(self.series_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({'t': ts, 'product': name, 'price': price}, ensure_ascii=False) + "\n")
+
+    def series_for(self, name: str) -> list:
+        with self.lock:
+            return list(self.series.get(name, ()))
+
+    def last_price(self, name: str) -> float | None:
+        with self.lock:
+            points = self.series.get(name)
+            return points[-1][1] if points else None
+
+    async def _check(self, product: dict, semaphores: dict):
+        host = urllib.parse.urlsplit(product['url']).netloc
+        async with semaphores[host]:
+            price, description = await asyncio.to_thread(self.fetcher.get_parsed, product['url'], parse_product_price,
+                                                         'watch_price', self.ttl_s)
+        return product, price, description
+
+    async def poll(self, watchlist: list[dict]) -> list[tuple]:
+        """Hämtar alla produkter parallellt; returnerar (produkt, pris, beskrivning) i listans ordning."""
+        semaphores = collections.defaultdict(lambda: asyncio.Semaphore(self.per_host))
+        return await asyncio.gather(*(self._check(product, semaphores) for product in watchlist))
+
+    @staticmethod
+    def threshold_events(product: dict, previous: float | None, price: float) -> list[dict]:
+        """Händelser för de trösklar som passerades mellan förra noteringen och denna."""
+        def crossed_down(level):
+            return price <= level and (previous is None or previous > level)
+        def crossed_up(level):
+            return price >= level and (previous is None or previous < level)
+        events = []
+        if product.get('buy_below') is not None and crossed_down(product['buy_below']):
+            events.append(('buy', f"Priset {price:.2f} kr har gått ner till köpgränsen {product['buy_below']:.2f} kr."))
+        if product.get('alert_below') is not None and crossed_down(product['alert_below']):
+            events.append(('alert', f"Priset {price:.2f} kr är nu under larmgränsen {product['alert_below']:.2f} kr."))
+        if product.get('alert_above') is not None and crossed_up(product['alert_above']):
+            events.append(('alert', f"Priset {price:.2f} kr är nu över larmgränsen {product['alert_above']:.2f} kr."))
+        if product.get('alert_change_pct') is not None and previous:
+            change_pct = (price - previous) / previous * 100
+            if abs(change_pct) >= product['alert_change_pct']:
+                events.append(('alert', f"Priset ändrades {change_pct:+.1f}% ({previous:.2f} -> {price:.2f} kr)."))
+        return [{'kind': kind, 'product': product, 'price': price, 'previous': previous, 'reason': reason} for kind, reason in events]
+
+    def poll_once(self, record: bool = True) -> list[dict]:
+        """
+        En kontroll av hela bevakningslistan. Returnerar tröskelhändelserna (köp/larm).
+        Med record=False (torrkörning) sparas inga priser, så att en passerad tröskel finns kvar för det riktiga jobbet.
+        """
+        watchlist = load_watchlist(self.watchlist_path)
+        start = time.perf_counter()
+        results = asyncio.run(self.poll(watchlist))
+        print(f"🔎 {len(watchlist)} produkt(er) kontrollerade på {time.perf_counter() - start:.2f} s.")
+        events = []
+        now = time.time()
+        for product, price, description in results:
+            if price is None:
+                print(f"   ⚠️ {product['name']}: inget pris ({description})")
+                continue
+            previous = self.last_price(product['name'])
+            if record:
+                self._record(product['name'], price, now)
+            print(f"   {product['name']}: {price:.2f} kr" + (f" (förra: {previous:.2f} kr)" if previous is not None else "") + f" – {description}")
+            events.extend(self.threshold_events(product, previous, price))
+        return events
+
+_price_watcher = None
+_price_watcher_lock = threading.Lock()
+
+def get_price_watcher() -> PriceWatcher:
+    """Returnerar prisbevakaren (skapas vid första anropet)."""
+    global _price_watcher
+    with _price_watcher_lock:
+        if _price_watcher is None:
+            _price_watcher = PriceWatcher()
+    return _price_watcher
+
+def check_price_watcher(delay_s: float = 0.2) -> bool:
+    """
+    Automatisk kontroll av prisbevakningen mot fixture_server.py (startas i en tråd på en ledig port):
+    högst per_host samtidiga hämtningar per värd, att prisändringar via /_set ger rätt köp-/larmhändelser
+    exakt en gång, och att oförändrade sidor besvaras med 304.
+    """
+    import fixture_server
+    from http.server import ThreadingHTTPServer
+    state = fixture_server.FixtureState()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), fixture_server.make_handler(state, delay_s))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+    ok = True
+
+    def check(passed: bool, text: str):
+        nonlocal ok
+        ok &= passed
+        print(f"{'✅' if passed else '❌'} {text}")
+
+    try:
+        with tempfile.TemporaryDirectory() as work:
+            local, loopback = f"http://localhost:{port}", f"http://127.0.0.1:{port}"
+            watchlist = [
+                {'name': 'JSON-LD', 'url': f"{local}/systembolaget_sort_guld_jsonld.html", 'buy_below': 18.0},
+                {'name': 'Inbäddad JSON', 'url': f"{local}/systembolaget_sort_guld_next_data.html", 'alert_below': 17.0},
+                {'name': 'Text', 'url': f"{local}/systembolaget_sort_guld_text.html", 'alert_above': 22.0},
+                {'name': 'JSON-LD (127.0.0.1)', 'url': f"{loopback}/systembolaget_sort_guld_jsonld.html", 'alert_change_pct': 5.0},
+                {'name': 'Text (127.0.0.1)', 'url': f"{loopback}/systembolaget_sort_guld_text.html"},
+            ]
+            watchlist_path = os.path.join(work, 'watchlist.json')
+            with open(watchlist_path, 'w', encoding='utf-8') as f:
+                json.dump(watchlist, f)
+            fetcher = PageFetcher(cache_path=os.path.join(work, 'cache.json'))
+            watcher = PriceWatcher(watchlist_path, os.path.join(work, 'series.jsonl'), per_host=1, fetcher=fetcher, ttl_s=0)
+
+            def stats() -> dict:
+                return requests.get(f"{loopback}/_stats", timeout=5).json()
+
+            def kinds(events: list) -> set:
+                return {(event['product']['name'], event['kind']) for event in events}
+
+            events = watcher.poll_once()
+            check(not events, f"Första kontrollen (grundpris 19,90 kr) ger inga händelser: {sorted(kinds(events))}")
+            check(all(peak <= 1 for peak in stats()['peak_concurrency'].values()),
+                  f"Högst 1 samtidig hämtning per värd: {stats()['peak_concurrency']}")
+
+            for page, price in (('systembolaget_sort_guld_jsonld.html', 17.50), ('systembolaget_sort_guld_next_data.html', 16.0),
+                                ('systembolaget_sort_guld_text.html', 23.0)):
+                requests.get(f"{loopback}/_set", params={'page': page, 'price': price}, timeout=5).raise_for_status()
+            expected = {('JSON-LD', 'buy'), ('Inbäddad JSON', 'alert'), ('Text', 'alert'), ('JSON-LD (127.0.0.1)', 'alert')}
+            events = watcher.poll_once()
+            check(kinds(events) == expected and len(events) == len(expected),
+                  f"Prisändringarna ger köp/larm en gång: {sorted(kinds(events))}")
+
+            not_modified = fetcher.stats['not_modified']
+            events = watcher.poll_once()
+            check(not events, f"Samma priser igen ger inga nya händelser: {sorted(kinds(events))}")
+            check(fetcher.stats['not_modified'] - not_modified == len(watchlist),
+                  f"Oförändrade sidor besvaras med 304: {fetcher.stats['not_modified'] - not_modified}/{len(watchlist)}")
+            check(all(peak <= 1 for peak in stats()['peak_concurrency'].values()),
+                  f"Fortfarande högst 1 samtidig hämtning per värd: {stats()['peak_concurrency']}")
+    finally:
+        server.shutdown()
+        server.server_close()
+    return ok
+
+# --- E-POST UTKORG (MAILDIR-SPOOL PÅ DISK, BAKGRUNDSTRÅD, ÅTERANVÄND SMTP-ANSLUTNING) ---
+MAIL_SPOOL_DIR = os.environ.get("MAIL_SPOOL_DIR", "agent_mail_spool")
+MAIL_RETRY_DELAYS_S = (5, 30, 120, 600) # Väntetid före nytt försök 1, 2, 3, 4; därefter var 600:e sekund tills det går
+MAIL_IDLE_TIMEOUT_S = 240               # Stäng anslutningen efter så här lång tystnad (servrar kopplar ner tysta klienter)
+MAIL_CLAIM_STALE_S = 600                # Ett påbörjat utskick i cur/ som är äldre än så här lämnades av en process som dog
+MAIL_SPOOL_KEEP_DAYS = 7                # Levererade/avvisade meddelanden i cur/ rensas efter så här många dagar
+MAIL_NOTICE_HEADER = "X-Outbox-Notice"  # Utskriftstexterna följer med i spoolfilen; huvudet tas bort före leverans
+MAIL_LOCAL_HOSTS = ('localhost', '127.0.0.1', '::1') # Enda servrarna som får ta emot e-post utan STARTTLS
+
+class MailOutbox:
+    """
+    Utkorg för e-post med en maildir-spool på disk (tmp/, new/, cur/). send() skriver meddelandet till
+    tmp/, fsyncar och byter namn till new/ innan det återvänder, så ett köat mejl överlever både
+    omstart och krasch. En bakgrundstråd levererar från new/ över en återanvänd SMTP-anslutning:
+    filen flyttas först till cur/ (anspråk, så att två processer på samma spool inte skickar samma
+    mejl) och får flaggan ':2,S' när servern tagit emot det. Misslyckas leveransen flyttas filen
+    tillbaka till new/ och försöks igen med ökande väntetid (MAIL_RETRY_DELAYS_S) – ingenting kastas.
+    Bara ett permanent fel (5xx) från servern avslutar försöken; filen får då flaggan ':2,T'.
+    STARTTLS krävs för alla servrar utom MAIL_LOCAL_HOSTS (saknas det i EHLO-svaret skickas inget, och
+    försöket görs om senare), så en nedgradering i nätet inte ger okrypterad e-post. Bara en lokal
+    server, som testservern smtp_sink.py, får användas utan TLS.
+    """
+    DELIVERED_FLAG = ':2,S'
+    REJECTED_FLAG = ':2,T'
+
+    def __init__(self, host=SMTP_HOST, port=SMTP_PORT, user=SMTP_USER, password=SMTP_PASS, spool_dir=MAIL_SPOOL_DIR):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.spool_dir = spool_dir
+        for sub in ('tmp', 'new', 'cur'):
+            os.makedirs(os.path.join(spool_dir, sub), exist_ok=True)
+        self._counter = itertools.count()
+        self._retry_at = {}                 # Filnamn i new/ -> (tidigast nästa försök, antal misslyckade försök)
+        self._pending = set()               # Filnamn som väntar på leverans (flush väntar på dem)
+        self._idle = threading.Condition()
+        self._wakeup = threading.Event()
+        self._server = None
+        self._last_used = 0.0
+        self._recover_spool()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="mail-outbox")
+        self._thread.start()
+
+    def _path(self, sub: str, name: str) -> str:
+        return os.path.join(self.spool_dir, sub, name)
+
+    def _unique_name(self) -> str:
+        # Maildir-namn: tid.pid_räknare.värd – sorteras i ankomstordning och krockar inte mellan processer
+        return f"{time.time():.6f}.{os.getpid()}_{next(self._counter)}.{socket.gethostname().replace('/', '_')}"
+
+    def _recover_spool(self):
+        """Städar spoolen vid start: övergivna anspråk tillbaka till new/, gamla tmp-/cur-filer bort."""
+        now = time.time()
+        for name in os.listdir(os.path.join(self.spool_dir, 'tmp')):
+            path = self._path('tmp', name)
+            if now - os.path.getmtime(path) > 36 * 3600: # Maildir-konventionen: tmp-filer äldre än 36 h är skräp
+                os.remove(path)
+        requeued = 0
+        for name in os.listdir(os.path.join(self.spool_dir, 'cur')):
+            path = self._path('cur', name)
+            age = now - os.path.getmtime(path)
+            if ':2,' in name:
+                if age > MAIL_SPOOL_KEEP_DAYS * 86400:
+                    os.remove(path)
+            elif age > MAIL_CLAIM_STALE_S:
+                try:
+                    os.rename(path, self._path('new', name))
+                    requeued += 1
+                except FileNotFoundError:
+                    pass
+        waiting = os.listdir(os.path.join(self.spool_dir, 'new'))
+        self._pending.update(waiting)
+        if waiting:
+            print(f"📬 E-postspoolen: {len(waiting)} meddelande(n) från tidigare körning väntar på leverans ({requeued} återupptagna).")
+
+    def send(self, msg, success_text: str, error_label: str):
+        """
+        Lägger meddelandet i spoolen (tmp/ -> new/, fsyncat) och väcker leveranstråden.
+        success_text skrivs ut när det levererats, error_label vid fel.
+        """
+        del msg[MAIL_NOTICE_HEADER]
+        notice = json.dumps({'success': success_text, 'error': error_label}).encode('utf-8')
+        msg[MAIL_NOTICE_HEADER] = base64.b64encode(notice).decode('ascii')
+        name = self._unique_name()
+        tmp_path = self._path('tmp', name)
+        with open(tmp_path, 'wb') as f:
+            f.write(msg.as_bytes())
+            f.flush()
+            os.fsync(f.fileno())
+        with self._idle:
+            self._pending.add(name)
+        os.rename(tmp_path, self._path('new', name))
+        self._wakeup.set()
+
+    def flush(self, timeout_s: float = 10.0) -> bool:
+        """Väntar (högst timeout_s) tills spoolen är levererad. Returnerar False om meddelanden återstår."""
+        deadline = time.time() + timeout_s
+        with self._idle:
+            while self._pending:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+    def flush_at_exit(self):
+        if not self.flush():
+            print(f"📬 {len(self._pending)} e-postmeddelande(n) ligger kvar i {self.spool_dir} och skickas vid nästa start.")
+
+    def _connect(self):
+        server = smtplib.SMTP(self.host, self.port, timeout=30)
+        server.ehlo()
+        if server.has_extn('starttls'):
+            server.starttls(); server.ehlo()
+        elif self.host not in MAIL_LOCAL_HOSTS:
+            server.close()
+            raise smtplib.SMTPException(f"{self.host} erbjuder inte STARTTLS; e-post skickas inte okrypterat")
+        if self.user and self.password and server.has_extn('auth'):
+            server.login(self.user, self.password)
+        self._server = server
+
+    def _disconnect(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except Exception:
+                pass
+            self._server = None
+
+    def _deliver(self, msg):
+        """Skickar över den öppna anslutningen; har servern kopplat ner provas en ny anslutning en gång."""
+        if self._server is not None and time.time() - self._last_used > MAIL_IDLE_TIMEOUT_S:
+            self._disconnect()
+        for attempt in (1, 2):
+            if self._server is None:
+                self._connect()
+            try:
+                self._server.sendmail(msg['From'] or self.user, msg['To'], msg.as_bytes())
+                self._last_used = time.time()
+                return
+            except (smtplib.SMTPServerDisconnected, ConnectionError):
+                self._server = None
+                if attempt == 2:
+                    raise
+
+    @staticmethod
+    def _is_permanent(error: Exception) -> bool:
+        """5xx-svar på själva meddelandet ger inte med sig vid nya försök (inloggningsfel gör det efter en rättning)."""
+        if isinstance(error, smtplib.SMTPRecipientsRefused):
+            return all(code >= 500 for code, _ in error.recipients.values())
+        return (isinstance(error, smtplib.SMTPResponseException) and error.smtp_code >= 500
+                and not isinstance(error, smtplib.SMTPAuthenticationError))
+
+    def _done(self, name: str):
+        self._retry_at.pop(name, None)
+        with self._idle:
+            self._pending.discard(name)
+            self._idle.notify_all()
+
+    def _retry_later(self, name: str, error_label: str, error: Exception, claimed: bool = True):
+        """Schemalägger nästa försök; har vi tagit filen till cur/ (claimed) läggs den tillbaka i new/."""
+        attempt = self._retry_at.get(name, (0.0, 0))[1]
+        delay = MAIL_RETRY_DELAYS_S[min(attempt, len(MAIL_RETRY_DELAYS_S) - 1)]
+        self._retry_at[name] = (time.time() + delay, attempt + 1)
+        try:
+            if claimed:
+                os.rename(self._path('cur', name), self._path('new', name))
+        except OSError as e:
+            print(f"⚠️ {name} kunde inte läggas tillbaka i new/ ({e}); det tas upp igen vid nästa start.")
+        print(f"❌ FEL vid sändning av {error_label}: {error}. Ligger kvar i spoolen; nytt försök om {delay} s.")
+
+    def _deliver_file(self, name: str):
+        new_path, cur_path = self._path('new', name), self._path('cur', name)
+        try:
+            os.rename(new_path, cur_path) # Anspråk: bara en process lyckas flytta filen
+        except FileNotFoundError:
+            self._done(name) # En annan process på samma spool tog den
+            return
+        except OSError as e:
+            self._retry_later(name, 'e-post', e, claimed=False) # Filen ligger kvar i new/
+            return
+        try:
+            os.utime(cur_path)
+            with open(cur_path, 'rb') as f:
+                msg = email.message_from_binary_file(f)
+        except OSError as e:
+            self._retry_later(name, 'e-post', e) # Vårt anspråk: tillbaka till new/
+            return
+        try:
+            notice = json.loads(base64.b64decode(''.join(msg.get(MAIL_NOTICE_HEADER, '').split())) or b'{}')
+        except ValueError:
+            notice = {}
+        del msg[MAIL_NOTICE_HEADER]
+        success_text = notice.get('success', f"✅ E-post levererad: {msg['Subject']}")
+        error_label = notice.get('error', 'e-post')
+        try:
+            self._deliver(msg)
+        except Exception as e:
+            self._disconnect()
+            if self._is_permanent(e):
+                self._mark(cur_path, self.REJECTED_FLAG)
+                print(f"❌ FEL vid sändning av {error_label}: {e}. Servern avvisade meddelandet permanent; det sparas i {cur_path + self.REJECTED_FLAG}.")
+                self._done(name)
+                return
+            self._retry_later(name, error_label, e)
+            return
+        self._mark(cur_path, self.DELIVERED_FLAG)
+        print(success_text)
+        self._done(name)
+
+    @staticmethod
+    def _mark(cur_path: str, flag: str):
+        """Sätter maildir-flaggan; misslyckas det är mejlet ändå avklarat och ska inte skickas igen av denna process."""
+        try:
+            os.rename(cur_path, cur_path + flag)
+        except OSError as e:
+            print(f"⚠️ Kunde inte markera {cur_path} med {flag}: {e}")
+
+    def _run(self):
+        while True:
+            self._wakeup.clear()
+            now = time.time()
+            try:
+                waiting = sorted(os.listdir(os.path.join(self.spool_dir, 'new')))
+            except OSError as e:
+                print(f"⚠️ E-postspoolen {self.spool_dir} kunde inte läsas: {e}. Försöker igen om {MAIL_RETRY_DELAYS_S[0]} s.")
+                self._wakeup.wait(MAIL_RETRY_DELAYS_S[0])
+                continue
+            for name in set(self._retry_at) - set(waiting):
+                self._retry_at.pop(name, None)
+            next_retry = None
+            for name in waiting:
+                if self._retry_at.get(name, (0.0, 0))[0] <= now:
+                    self._deliver_file(name) # Misslyckas den hamnar den i _retry_at med en ny tid
+                if name in self._retry_at:
+                    retry_at = self._retry_at[name][0]
+                    next_retry = retry_at if next_retry is None else min(next_retry, retry_at)
+            timeouts = []
+            if next_retry is not None:
+                timeouts.append(max(0.0, next_retry - time.time()))
+            if self._server is not None:
+                idle_left = self._last_used + MAIL_IDLE_TIMEOUT_S - time.time()
+                if idle_left <= 0:
+                    self._disconnect()
+                else:
+                    timeouts.append(idle_left)
+            self._wakeup.wait(min(timeouts) if timeouts else None)
+
+_outbox = None
+_outbox_lock = threading.Lock()
+
+def get_outbox() -> MailOutbox:
+    """Returnerar e-postutkorgen (skapas vid första anropet)."""
+    global _outbox
+    with _outbox_lock:
+        if _outbox is None:
+            _outbox = MailOutbox()
+            atexit.register(_outbox.flush_at_exit)
+    return _outbox
 
 # --- E-POST FUNKTIONER ---
 
@@ -234,15 +1109,8 @@ def send_stock_email(price: float | None, ticker: str, commentary: str, news_ite
     msg['From'] = SMTP_USER; msg['To'] = MAIL_TO; msg['Subject'] = f"📊 Daglig Rapport: {ticker} - Pris: {price_str} ({len(news_items)} nyheter)"
     html_body = f"""<html><body><h2>Daglig Aktierapport för {ticker}</h2><p>Pris vid marknadsstängning: <strong>{price_str}</strong></p><h3>AI-Analys:</h3><p>"{commentary}"</p><hr>{news_html}<hr><p><small>Denna rapport skickas vid fast tidpunkt varje dag.</small></p></body></html>"""
     msg.attach(MIMEText(html_body, 'html'))
-    try:
-        server = smtplib.SMTP(SMTP_HOST, SMTP_PORT)
-        server.ehlo(); server.starttls(); server.ehlo(); server.login(SMTP_USER, SMTP_PASS)
-        server.sendmail(SMTP_USER, MAIL_TO, msg.as_string())
-        print(f"✅ Buffalo Agent: Aktierapporten levererad.")
-    except Exception as e:
-        print(f"❌ FEL vid sändning av daglig e-post (Aktier): {e}")
-    finally:
-        if 'server' in locals(): server.quit()
+    # Köas i utkorgen; skickas av bakgrundstråden över en återanvänd SMTP-anslutning
+    get_outbox().send(msg, "✅ Buffalo Agent: Aktierapporten levererad.", "daglig e-post (Aktier)")
 
 def send_proactive_email(price: float | None, ticker: str, action: str, reasoning: str, check_type: str, news_items: list):
     price_str = f"${price:,.2f}" if price is not None else "PRIS EJ TILLGÄNGLIGT"
@@ -272,15 +1140,8 @@ def send_proactive_email(price: float | None, ticker: str, action: str, reasonin
     html_body = f"""<html><body><h2 style="color: {color};">{alert_text}</h2><p style="font-size: 24px;">Aktie: <strong>{ticker}</strong><br>Aktuellt Pris: <strong>{price_str}</strong></p><h3>🔬 Analys / Notis:</h3><p>{source_message}</p><p style="font-size: 36px; font-weight: bold; color: {color}; margin: 5px 0;">{display_action}</p><h3>Motivering:</h3><blockquote style="border-left: 4px solid {color}; padding-left: 15px; margin: 15px 0; background: #f8f9fa;">"{reasoning}"</blockquote><hr>{news_html}<hr><p>Denna notis skickades omedelbart efter att agenten utförde en {check_type}-kontroll som en del av sin kontinuerliga marknadsbevakning.</p></body></html>"""
     msg.attach(MIMEText(html_body, 'html'))
     
-    try:
-        server = smtplib.SMTP(SMTP_HOST, SMTP_PORT)
-        server.ehlo(); server.starttls(); server.ehlo(); server.login(SMTP_USER, SMTP_PASS)
-        server.sendmail(SMTP_USER, MAIL_TO, msg.as_string())
-        print(f"✅ Buffalo Agent: Proaktiv varning skickad!")
-    except Exception as e:
-        print(f"❌ FEL vid sändning av proaktiv e-post: {e}")
-    finally:
-        if 'server' in locals(): server.quit()
+    # Köas i utkorgen; skickas av bakgrundstråden över en återanvänd SMTP-anslutning
+    get_outbox().send(msg, "✅ Buffalo Agent: Proaktiv varning skickad!", "proaktiv e-post")
 
 
 def send_beer_price_email(price: float | None, search_snippet: str):
@@ -296,34 +1157,31 @@ def send_beer_price_email(price: float | None, search_snippet: str):
     html_body = f"""<html><body><h2>Systembolaget: Prisbevakning för Sort Guld</h2><p style="font-size: 20px;">{status_text}</p><p><i>Status från hämtningen:</i></p><blockquote style="border-left: 4px solid #f90; padding-left: 15px; margin: 15px 0; background: #fff8e1;">"{search_snippet}"</blockquote><p><small>Buffalo Agent levererar denna rapport dagligen kl 10:00.</small></p></body></html>"""
     msg.attach(MIMEText(html_body, 'html'))
     
-    try:
-        server = smtplib.SMTP(SMTP_HOST, SMTP_PORT)
-        server.ehlo(); server.starttls(); server.ehlo(); server.login(SMTP_USER, SMTP_PASS)
-        server.sendmail(SMTP_USER, MAIL_TO, msg.as_string())
-        print(f"✅ Buffalo Agent: Ölprisrapport skickad.")
-    except Exception as e:
-        print(f"❌ FEL vid sändning av daglig e-post (Ölpris): {e}")
-    finally:
-        if 'server' in locals(): server.quit()
+    # Köas i utkorgen; skickas av bakgrundstråden över en återanvänd SMTP-anslutning
+    get_outbox().send(msg, "✅ Buffalo Agent: Ölprisrapport skickad.", "daglig e-post (Ölpris)")
         
-def send_beer_purchase_email(price: float, new_balance: float):
-    subject = f"🍻 KÖP BEKRÄFTAT: Sort Guld för {price:.2f} kr"
+def send_beer_purchase_email(price: float, new_balance: float, product_name: str = "Sort Guld", reason: str | None = None):
+    subject = f"🍻 KÖP BEKRÄFTAT: {product_name} för {price:.2f} kr"
     msg = MIMEMultipart()
     msg['From'] = SMTP_USER; msg['To'] = MAIL_TO; msg['Subject'] = subject
     
-    html_body = f"""<html><body><h2>Ölköp genomfört!</h2><p>Buffalo Agent kände suget och köpte en Sort Guld.</p><p style="font-size: 20px;">Pris: <strong>{price:.2f} kr</strong></p><p style="font-size: 20px; color: #dc3545;">Nytt Saldo: <strong>{new_balance:.2f} kr</strong></p><p><small>Köpbeslutet var baserat på en slumpmässig algoritm och priset var under maxgränsen (30 kr).</small></p></body></html>"""
+    reason_text = reason or "Köpbeslutet var baserat på en slumpmässig algoritm och priset var under maxgränsen (30 kr)."
+    html_body = f"""<html><body><h2>Ölköp genomfört!</h2><p>Buffalo Agent kände suget och köpte en {product_name}.</p><p style="font-size: 20px;">Pris: <strong>{price:.2f} kr</strong></p><p style="font-size: 20px; color: #dc3545;">Nytt Saldo: <strong>{new_balance:.2f} kr</strong></p><p><small>{reason_text}</small></p></body></html>"""
     msg.attach(MIMEText(html_body, 'html'))
     
-    try:
-        server = smtplib.SMTP(SMTP_HOST, SMTP_PORT)
-        server.ehlo(); server.starttls(); server.ehlo(); server.login(SMTP_USER, SMTP_PASS)
-        server.sendmail(SMTP_USER, MAIL_TO, msg.as_string())
-        print(f"✅ Buffalo Agent: Bekräftelse på ölköp skickad.")
-    except Exception as e:
-        print(f"❌ FEL vid sändning av köpbekräftelse: {e}")
-    finally:
-        if 'server' in locals(): server.quit()
-
+    # Köas i utkorgen; skickas av bakgrundstråden över en återanvänd SMTP-anslutning
+    get_outbox().send(msg, "✅ Buffalo Agent: Bekräftelse på ölköp skickad.", "köpbekräftelse")
+
+def send_price_alert_email(event: dict, series: list):
+    """Larm när en bevakad produkt passerat en tröskel, med de senaste noteringarna."""
+    product, price = event['product'], event['price']
+    subject = f"🔔 Prislarm: {product['name']} {price:.2f} kr"
+    rows = "".join(f"<tr><td>{time.strftime('%Y-%m-%d %H:%M', time.localtime(ts))}</td><td>{p:.2f} kr</td></tr>" for ts, p in series[-10:][::-1])
+    msg = MIMEMultipart()
+    msg['From'] = SMTP_USER; msg['To'] = MAIL_TO; msg['Subject'] = subject
+    html_body = f"""<html><body><h2>Prislarm: {product['name']}</h2><p style="font-size: 20px;">{event['reason']}</p><p><a href="{product['url']}">Produktsidan</a></p><h3>Senaste noteringar</h3><table>{rows}</table><p><small>Trösklarna ställs in i {WATCHLIST_FILE}.</small></p></body></html>"""
+    msg.attach(MIMEText(html_body, 'html'))
+    get_outbox().send(msg, f"✅ Buffalo Agent: Prislarm för {product['name']} skickat.", "prislarm")
 
 # --- INPUT/INTERAKTIVA FUNKTIONER ---
 
@@ -420,6 +1278,40 @@ def beer_price_job():
     price, snippet = get_sort_guld_price()
     send_beer_price_email(price, snippet)
 
+def buy_beer(price: float, product_name: str = "Sort Guld", reason: str | None = None) -> float | None:
+    """
+    Drar priset från plånboken och skickar köpbekräftelse. Returnerar nytt saldo, eller None om köpet
+    inte blev av (för lite pengar, eller saldot ändrades av andra agentprocesser för många gånger i rad).
+    """
+    current_balance, state_version = get_wallet_snapshot()
+    # Uppdatera tillståndet med nytt saldo, men bara om ingen annan agentprocess har ändrat det
+    # sedan vi läste det (prishämtningen tar tid). Annars: läs om och räkna om köpet.
+    for attempt in range(STATE_CAS_RETRIES):
+        if current_balance < price:
+            print(f"Agenten har inte råd med {product_name} ({current_balance:.2f} kr). Inget köp.")
+            return None
+        state = read_agent_state()
+        current_version = float(state.get("AGENT_VERSION", os.environ.get("AGENT_VERSION", "0.9")))
+        birth_time = state.get("AGENT_BIRTH_TIME", datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        new_balance = current_balance - price
+        try:
+            saved = update_agent_state(current_version, birth_time, new_balance, expected_state_version=state_version)
+        except OSError:
+            print(f"❌ Köpet av {product_name} avbröts: det nya saldot kunde inte sparas.")
+            return None
+        if saved:
+            break
+        print("🔄 Saldot ändrades av en annan agentprocess. Läser om och försöker igen.")
+        current_balance, state_version = get_wallet_snapshot()
+    else:
+        print("❌ Ölköpet avbröts: saldot ändrades av andra agentprocesser för många gånger i rad.")
+        return None
+
+    # Skicka bekräftelsemail
+    send_beer_purchase_email(price, new_balance, product_name, reason)
+    print(f"🍻 KÖP GENOMFÖRT! Köpte {product_name} för {price:.2f} kr. Nytt saldo: {new_balance:.2f} kr.")
+    return new_balance
+
 def proactive_beer_buy_job():
     """Kollar om agenten ska köpa Sort Guld baserat på slump och pris."""
     print(f"\n--- Buffalo Agent: Proaktiv ÖLKÖP-KONTROLL ({time.strftime('%H:%M:%S')}) ---")
@@ -438,21 +1330,21 @@ def proactive_beer_buy_job():
         
     # 1 in 3 chance of buying if the price is acceptable and we have enough money
     if random.randint(1, 3) == 1 and price <= MAX_PRICE and current_balance >= price: 
-        new_balance = current_balance - price
-        
-        # Hämta nuvarande persistenta värden för att uppdatera korrekt
-        current_version = float(os.environ.get("AGENT_VERSION", "0.9"))
-        birth_time = os.environ.get("AGENT_BIRTH_TIME", datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-        
-        # Uppdatera tillståndet med nytt saldo
-        update_agent_state(current_version, birth_time, new_balance)
-
-        # Skicka bekräftelsemail
-        send_beer_purchase_email(price, new_balance)
-        print(f"🍻 KÖP GENOMFÖRT! Köpte Sort Guld för {price:.2f} kr. Nytt saldo: {new_balance:.2f} kr.")
+        buy_beer(price)
     else:
         print(f"Agenten känner inte för att köpa Sort Guld idag (Pris: {price:.2f} kr, Saldo: {current_balance:.2f} kr).")
 
+def price_watch_job():
+    """Hämtar alla bevakade produkter parallellt och kör köp-/larmjobben för passerade trösklar."""
+    print(f"\n--- Buffalo Agent: PRISBEVAKNING ({time.strftime('%H:%M:%S')}) ---")
+    watcher = get_price_watcher()
+    for event in watcher.poll_once():
+        print(f"🔔 {event['product']['name']}: {event['reason']}")
+        if event['kind'] == 'buy':
+            buy_beer(event['price'], event['product']['name'], event['reason'])
+        else:
+            send_price_alert_email(event, watcher.series_for(event['product']['name']))
+
 
 def pro_active_check_job():
     check_type = random.choice(['PRICE', 'NEWS']) 
@@ -482,32 +1374,108 @@ def self_talk_job():
     print("\n[🧠 INTERN MONOLOG]")
     print(f"  > Agenten tänker högt: \"{internal_thought}\"")
 
+SELF_REWRITE_TARGET_MODEL = os.environ.get("SELF_REWRITE_TARGET_MODEL", "llama3:70b-instruct-q4_K_M")
+SELF_REWRITE_OUTPUT = "nu.py"
+
+def find_assignment_region(source: str, name: str) -> tuple[int, int, str] | None:
+    """
+    Letar upp den översta tilldelningen till name med ast. Returnerar (första rad, rad efter sista, snippet)
+    med hela rader (indrag och slutkommentar följer med), eller None om tilldelningen saknas.
+    """
+    for node in ast.parse(source).body:
+        if isinstance(node, ast.Assign) and any(isinstance(t, ast.Name) and t.id == name for t in node.targets):
+            lines = source.splitlines(keepends=True)
+            snippet = "".join(lines[node.lineno - 1:node.end_lineno])
+            if ast.get_source_segment(source, node) not in snippet: # Ska inte kunna hända, men patchen måste vara exakt
+                return None
+            return node.lineno - 1, node.end_lineno, snippet
+    return None
+
+def _is_environ_get(value: ast.AST, name: str) -> bool:
+    """Är uttrycket os.environ.get("<name>", <konstant>)?"""
+    return (isinstance(value, ast.Call) and not value.keywords and len(value.args) == 2
+            and isinstance(value.func, ast.Attribute) and value.func.attr == 'get'
+            and isinstance(value.func.value, ast.Attribute) and value.func.value.attr == 'environ'
+            and isinstance(value.func.value.value, ast.Name) and value.func.value.value.id == 'os'
+            and isinstance(value.args[0], ast.Constant) and value.args[0].value == name
+            and isinstance(value.args[1], ast.Constant))
+
+def _parse_assignment(snippet: str, name: str) -> ast.Module | None:
+    """Tolkar snippet om den är exakt en tilldelning 'name = os.environ.get(\"name\", <standard>)' eller 'name = <konstant>'."""
+    try:
+        tree = ast.parse(snippet.strip())
+    except SyntaxError:
+        return None
+    if len(tree.body) != 1 or not isinstance(tree.body[0], ast.Assign):
+        return None
+    node = tree.body[0]
+    if len(node.targets) != 1 or not isinstance(node.targets[0], ast.Name) or node.targets[0].id != name:
+        return None
+    if not (_is_environ_get(node.value, name) or isinstance(node.value, ast.Constant)):
+        return None
+    return tree
+
+def _assigned_default(snippet: str, name: str):
+    """Standardvärdet i 'name = os.environ.get(\"name\", <standard>)' (eller en ren konstant), annars None."""
+    tree = _parse_assignment(snippet, name)
+    if tree is None:
+        return None
+    value = tree.body[0].value
+    return value.args[1].value if isinstance(value, ast.Call) else value.value
+
+def _is_default_swap(original: str, rewritten: str, name: str, new_default) -> bool:
+    """
+    Är rewritten samma tilldelning som original med bara standardvärdet utbytt mot new_default?
+    Jämför syntaxträden, så att inget annat uttryck kan smygas in bakom rätt konstant.
+    """
+    expected, actual = _parse_assignment(original, name), _parse_assignment(rewritten, name)
+    if expected is None or actual is None:
+        return False
+    node = expected.body[0]
+    if isinstance(node.value, ast.Call):
+        node.value.args[1] = ast.Constant(new_default)
+    else:
+        node.value = ast.Constant(new_default)
+    return ast.dump(expected) == ast.dump(actual)
+
 def llm_self_rewrite_job():
-    """Försöker skriva om sin egen kod till 'nu.py' genom att byta Ollama-modell via LLM."""
+    """
+    Försöker skriva om sin egen kod till 'nu.py' genom att byta Ollama-modell via LLM. Bara raden som
+    sätter OLLAMA_MODEL (hittad med ast) skickas till modellen; svaret måste vara just den tilldelningen
+    med den nya modellen, och hela filen med patchen inlagd måste gå att kompilera innan nu.py skrivs.
+    """
     print("\n--- Buffalo Agent: Utför självrevisions-jobb (LLM-omskrivning) ---")
 
-    # 1. Hitta och läs den nuvarande koden (vi använder sys.argv[0])
+    # 1. Hitta och läs den nuvarande koden (vi använder sys.argv[0]) och leta upp OLLAMA_MODEL-raden
     try:
         current_script_path = os.path.abspath(sys.argv[0])
         with open(current_script_path, 'r', encoding='utf-8') as f:
             current_code = f.read()
+        region = find_assignment_region(current_code, 'OLLAMA_MODEL')
     except Exception as e:
         print(f"❌ FEL: Kunde inte läsa agentens egen källkod ({current_script_path}). Avbryter självrevision: {e}")
         return
+    if region is None:
+        print("❌ FEL: Hittade ingen tilldelning av OLLAMA_MODEL i källkoden. Avbryter självrevision.")
+        return
+    start_line, end_line, snippet = region
+    TARGET_MODEL = SELF_REWRITE_TARGET_MODEL
+    if _assigned_default(snippet, 'OLLAMA_MODEL') == TARGET_MODEL:
+        print(f"✅ OLLAMA_MODEL har redan standardvärdet {TARGET_MODEL}. Ingen omskrivning behövs.")
+        return
 
-    # 2. Skapa Prompt för LLM
-    TARGET_MODEL = "llama3:70b-instruct-q4_K_M"
+    # 2. Skapa Prompt för LLM – bara den aktuella raden, inte hela filen
     try:
         client = ollama.Client(host='http://localhost:11434')
         
         system_prompt = (
-            "Du är en AI-kodningsassistent som uppdaterar en Python-agent. Din uppgift är att byta ut den nuvarande Ollama-modellen. "
-            "Sök efter raden som sätter `OLLAMA_MODEL = os.environ.get(\"OLLAMA_MODEL\", \"llama3\")` (eller liknande). "
-            f"Byt ut standardvärdet (`\"llama3\"`) mot det nya värdet: \"{TARGET_MODEL}\". "
-            "Returnera ENDAST den fullständiga, uppdaterade Python-koden. Ingen förklaring, ingen markdown-syntax, inga extra kommentarer."
+            "Du är en AI-kodningsassistent som uppdaterar en Python-agent. Du får EN rad Python-kod som sätter `OLLAMA_MODEL`. "
+            f"Byt ut standardvärdet (andra argumentet till os.environ.get) mot det nya värdet: \"{TARGET_MODEL}\". "
+            "Returnera ENDAST den uppdaterade raden. Ingen förklaring, ingen markdown-syntax, inga andra rader."
         )
-        
-        user_prompt = f"Här är den nuvarande agentkoden. Uppdatera den enligt systeminstruktionen:\n\n{current_code}"
+        user_prompt = snippet
+        print(f"    > Skickar {len(snippet)} av {len(current_code)} tecken (rad {start_line + 1}) till LLM:en "
+              f"({100 * (1 - len(snippet) / len(current_code)):.1f}% mindre än hela filen).")
         
         response = client.chat(
             model=OLLAMA_MODEL,
@@ -517,25 +1485,37 @@ def llm_self_rewrite_job():
             ]
         )
         
-        rewritten_code = response['message']['content'].strip()
+        rewritten_snippet = response['message']['content'].strip()
 
     except Exception as e:
         print(f"❌ FEL: Kunde inte kommunicera med Ollama för självrevision: {e}")
         return
 
-    # 3. Skriv den nya koden till nu.py
-    output_filename = "nu.py"
-    
-    if rewritten_code.startswith('```'):
-        lines = rewritten_code.split('\n')
+    # 3. Validera svaret, lägg in det som en patch och kompilera hela filen
+    if rewritten_snippet.startswith('```'):
+        lines = rewritten_snippet.split('\n')
         if lines[0].strip().startswith('```'):
-            rewritten_code = '\n'.join(lines[1:-1]).strip()
-        
+            rewritten_snippet = '\n'.join(lines[1:-1]).strip()
+
+    if not _is_default_swap(snippet, rewritten_snippet, 'OLLAMA_MODEL', TARGET_MODEL):
+        print(f"❌ FEL: LLM-svaret är inte samma tilldelning av OLLAMA_MODEL med bara standardvärdet bytt till {TARGET_MODEL}. Avbryter.")
+        print(f"    > Svar: {rewritten_snippet[:200]}")
+        return
+    indent = snippet[:len(snippet) - len(snippet.lstrip())]
+    source_lines = current_code.splitlines(keepends=True)
+    new_code = "".join(source_lines[:start_line]) + indent + rewritten_snippet + "\n" + "".join(source_lines[end_line:])
     try:
-        with open(output_filename, 'w', encoding='utf-8') as f:
-            f.write(rewritten_code)
+        compile(new_code, SELF_REWRITE_OUTPUT, 'exec')
+    except SyntaxError as e:
+        print(f"❌ FEL: Den patchade koden går inte att kompilera ({e}). '{SELF_REWRITE_OUTPUT}' skrevs inte.")
+        return
+
+    # 4. Skriv den nya koden till nu.py
+    output_filename = SELF_REWRITE_OUTPUT
+    try:
+        write_file_atomic(output_filename, new_code)
         
-        print(f"🎉 Agent: Koden skrevs om framgångsrikt till '{output_filename}'.")
+        print(f"🎉 Agent: Koden skrevs om framgångsrikt till '{output_filename}' (rad {start_line + 1}: {rewritten_snippet}).")
         print(f"    > Ny modell: {TARGET_MODEL}. Starta 'nu.py' för att aktivera den.")
         
     except Exception as e:
@@ -544,6 +1524,131 @@ def llm_self_rewrite_job():
 
 # --- HUVUDLOOP OCH KÖRNING ---
 
+# --- HÄNDELSESTYRD SCHEMALÄGGARE ---
+
+SCHEDULER_STATE_FILE = "agent_scheduler_state.json" # Nästa körning för jobb med slumpmässigt intervall, sparas mellan omstarter
+SCHEDULER_OVERDUE_STAGGER_S = (5, 120) # Försenade jobb sprids ut slumpmässigt inom detta fönster vid start
+
+def next_daily_deadline(at: str) -> float:
+    """Nästa tillfälle (time.time()) då väggklockan visar HH:MM."""
+    hour, minute = (int(part) for part in at.split(':'))
+    now = datetime.datetime.now()
+    target = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if target <= now:
+        target += datetime.timedelta(days=1)
+    return target.timestamp()
+
+def random_interval(low_s: int, high_s: int, label: str, unit: str = 'minuter'):
+    """Omschemaläggning med slumpmässig fördröjning (som de gamla random.randint-timrarna)."""
+    divisor = 3600 if unit == 'timmar' else 60
+    def next_deadline(previous: float) -> float:
+        delay = random.randint(low_s, high_s)
+        print(f"Buffalo Agent: Nästa {label} schemalagd om {delay / divisor:.1f} {unit}.")
+        return time.time() + delay
+    return next_deadline
+
+class DeadlineScheduler:
+    """
+    Händelsestyrd schemaläggare: jobben ligger i en heap sorterad på deadline (time.time()).
+    Huvudloopen sover i input-kön tills närmaste deadline eller tills användaren skriver något,
+    så agenten vaknar bara när det finns något att göra och jobben körs på sin exakta tid.
+    Nästa deadline räknas från föregående deadline, inte från när jobbet blev klart, så inget driver.
+    Jobb som läggs till med persist=True får sin nästa deadline sparad i state_path och återställd vid
+    start, så att en omstart (eller en kraschloop) inte kör alla slumpmässiga jobb på en gång.
+    """
+    def __init__(self, wakeup_queue: queue.Queue, state_path: str | None = SCHEDULER_STATE_FILE):
+        self.wakeup_queue = wakeup_queue
+        self._heap = []
+        self._counter = itertools.count() # Jobb med samma deadline körs i den ordning de lades till
+        self.state_path = state_path
+        self._persisted = self._load_state()
+        self._persist_names = set()
+
+    def _load_state(self) -> dict:
+        if not self.state_path:
+            return {}
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                return {name: float(deadline) for name, deadline in json.load(f).items()}
+        except (FileNotFoundError, json.JSONDecodeError, ValueError, TypeError, AttributeError):
+            return {}
+
+    def _save_deadline(self, name: str, deadline: float):
+        """Sparar jobbets nästa deadline (läs-ändra-skriv under lås, så flera agentprocesser kan dela filen)."""
+        try:
+            with FileLock(self.state_path + ".lock"):
+                state = self._load_state()
+                state[name] = deadline
+                write_file_atomic(self.state_path, json.dumps(state, indent=2))
+        except OSError as e:
+            print(f"⚠️ Kunde inte spara schemat för '{name}': {e}")
+
+    def has_saved_schedule(self, name: str) -> bool:
+        """Fanns en sparad deadline för jobbet när agenten startade?"""
+        return name in self._persisted
+
+    def seconds_until(self, name: str) -> float | None:
+        deadlines = [entry[0] for entry in self._heap if entry[2] == name]
+        return max(0.0, min(deadlines) - time.time()) if deadlines else None
+
+    def add(self, name: str, func, first_deadline: float, next_deadline, persist: bool = False):
+        """
+        Lägger till ett jobb. next_deadline(föregående deadline) ger nästa körning.
+        Med persist=True används en sparad deadline från förra körningen i stället för first_deadline;
+        har den redan passerats körs jobbet efter en slumpmässig fördröjning (SCHEDULER_OVERDUE_STAGGER_S).
+        """
+        if persist and self.state_path:
+            saved = self._persisted.get(name)
+            if saved is not None:
+                if saved > time.time():
+                    first_deadline = saved
+                else:
+                    first_deadline = time.time() + random.uniform(*SCHEDULER_OVERDUE_STAGGER_S)
+                    print(f"⏰ Jobbet '{name}' missades medan agenten var nere. Körs om {first_deadline - time.time():.0f} s.")
+            self._persist_names.add(name)
+            self._save_deadline(name, first_deadline)
+        heapq.heappush(self._heap, (first_deadline, next(self._counter), name, func, next_deadline))
+
+    def every(self, name: str, func, interval_s: float, first_delay_s: float = 0.0):
+        """Jobb med fast intervall. Missade körningar (om ett jobb tog för lång tid) slås ihop till en."""
+        def next_deadline(previous: float) -> float:
+            deadline = previous + interval_s
+            now = time.time()
+            if deadline <= now:
+                deadline += ((now - deadline) // interval_s + 1) * interval_s
+            return deadline
+        self.add(name, func, time.time() + first_delay_s, next_deadline)
+
+    def daily(self, name: str, func, at: str):
+        """Jobb som körs varje dag när väggklockan visar HH:MM."""
+        self.add(name, func, next_daily_deadline(at), lambda previous: next_daily_deadline(at))
+
+    def seconds_until_next(self) -> float | None:
+        if not self._heap:
+            return None
+        return max(0.0, self._heap[0][0] - time.time())
+
+    def run_due(self):
+        """Kör alla jobb vars deadline har passerats och lägger tillbaka dem med nästa deadline."""
+        while self._heap and self._heap[0][0] <= time.time():
+            deadline, _, name, func, next_deadline = heapq.heappop(self._heap)
+            try:
+                func()
+            except Exception as e:
+                print(f"❌ FEL i schemalagt jobb '{name}': {e}")
+            following = next_deadline(deadline)
+            if name in self._persist_names:
+                self._save_deadline(name, following)
+            heapq.heappush(self._heap, (following, next(self._counter), name, func, next_deadline))
+
+    def wait_for_input(self):
+        """Kör förfallna jobb och sover sedan tills nästa deadline. Returnerar användarens input, eller None om det var ett jobb som väckte oss."""
+        self.run_due()
+        try:
+            return self.wakeup_queue.get(timeout=self.seconds_until_next())
+        except queue.Empty:
+            return None
+
 def input_listener():
     """Lyssnar efter input i en separat tråd och lägger i kön."""
     while True:
@@ -576,8 +1681,12 @@ def run_agent():
     birth_time = AGENT_BIRTH_TIME if AGENT_BIRTH_TIME else current_time
     
     # Initiera/uppdatera tillstånd, inklusive plånbok
+    # Saldot lämnas orört (läses under låset), så en samtidig affär i en annan process inte skrivs över
+    try:
+        update_agent_state(new_version, birth_time)
+    except OSError:
+        print("⚠️ Agenten startar utan att ha sparat den nya versionen.")
     initial_wallet_balance = get_current_wallet_balance()
-    update_agent_state(new_version, birth_time, initial_wallet_balance)
 
     print(f"🧘 Agenten utför självdiagnos (V{new_version:.1f}).")
     print(f"💰 Plånbokens saldo: {initial_wallet_balance:.2f} kr.")
@@ -593,27 +1702,32 @@ def run_agent():
 
 
     # --- 4. SCHEMALÄGGNING ---
-    schedule.every().day.at("17:00").do(daily_reporting_job).tag('daily_stock')
-    schedule.every().day.at("10:00").do(beer_price_job).tag('daily_beer')
+    scheduler = DeadlineScheduler(input_queue)
+    scheduler.daily('daily_stock', daily_reporting_job, "17:00")
+    scheduler.daily('daily_beer', beer_price_job, "10:00")
+    scheduler.every('price_watch', price_watch_job, WATCH_INTERVAL_S, first_delay_s=60)
     
-    print("Schemalagt: Daglig aktierapport (17:00) och Ölprisrapport (10:00).")
+    print(f"Schemalagt: Daglig aktierapport (17:00), Ölprisrapport (10:00) och prisbevakning var {WATCH_INTERVAL_S // 60}:e minut.")
     
-    # Kör initiala tester/proaktivitet
-    print("\n>>> Buffalo Agent tjuvstartar Intern Monolog (TEST)...")
-    self_talk_job()
+    # Kör initiala tester/proaktivitet (bara vid allra första starten, inte vid varje omstart)
+    if not scheduler.has_saved_schedule('self_talk'):
+        print("\n>>> Buffalo Agent tjuvstartar Intern Monolog (TEST)...")
+        self_talk_job()
     
-    # Initiera tidpunkter för de slumpmässiga kontrollerna
-    next_check_time_proactive_stock = time.time() # Körs omedelbart första gången
+    # De slumpmässiga jobbens nästa tidpunkt sparas mellan omstarter (persist=True)
+    # Proaktiv marknadskontroll (1 min - 2 timmar), körs omedelbart första gången
+    scheduler.add('proactive_stock', pro_active_check_job, time.time(),
+                  random_interval(60, 7200, 'proaktiva aktiekontroll'), persist=True)
     
     # Slumpmässig ölköpskontroll (4-8 timmar)
-    random_delay_beer_buy = random.randint(14400, 28800) # 4 timmar till 8 timmar i sekunder
-    next_check_time_beer_buy = time.time() + random_delay_beer_buy
-    print(f"    - Nästa slumpmässiga ölköpskontroll schemalagd om {random_delay_beer_buy / 3600:.1f} timmar.")
+    scheduler.add('proactive_beer_buy', proactive_beer_buy_job, time.time() + random.randint(14400, 28800),
+                  random_interval(14400, 28800, 'slumpmässiga ölköpskontroll', 'timmar'), persist=True)
+    print(f"    - Nästa slumpmässiga ölköpskontroll schemalagd om {scheduler.seconds_until('proactive_beer_buy') / 3600:.1f} timmar.")
 
     # Intern monolog (1 min - 5 minuter)
-    random_delay_self = random.randint(60, 300) 
-    next_check_time_selftalk = time.time() + random_delay_self
-    print(f"    - Nästa interna monolog schemalagd om {random_delay_self / 60:.1f} minuter.")
+    scheduler.add('self_talk', self_talk_job, time.time() + random.randint(60, 300),
+                  random_interval(60, 300, 'interna monolog'), persist=True)
+    print(f"    - Nästa interna monolog schemalagd om {scheduler.seconds_until('self_talk') / 60:.1f} minuter.")
     
     print("\nBuffalo Agent går i standby. Avvaktar schemalagda och proaktiva kontroller...")
 
@@ -622,54 +1736,34 @@ def run_agent():
 
 
     while True:
-        # --- HANTERA INTERAKTIV INPUT ---
-        try:
-            user_query = input_queue.get_nowait()
-            print("\n---------------------------------------------------------")
-            print(f"👤 Användare frågar: {user_query}")
-            
-            # Svara med hjälp av bash-historiken
-            llm_response = get_llm_response_from_history(user_query, bash_history_path)
-            
-            print(f"{llm_response}")
-            print("---------------------------------------------------------")
-            
-        except queue.Empty:
-            # Ingen input, fortsätt med schemalagda jobb
-            pass
+        # --- HANTERA JOBB OCH INTERAKTIV INPUT ---
+        # Sover tills nästa jobbs deadline eller tills användaren skriver något (ingen 1-sekunds-polling)
+        user_query = scheduler.wait_for_input()
+        if user_query is None:
+            continue
+
+        print("\n---------------------------------------------------------")
+        print(f"👤 Användare frågar: {user_query}")
         
-        schedule.run_pending()
+        # Svara med hjälp av bash-historiken
+        llm_response = get_llm_response_from_history(user_query, bash_history_path)
         
-        # Proaktiv marknadskontroll (1 min - 2 timmar)
-        if time.time() >= next_check_time_proactive_stock:
-            pro_active_check_job()
-            random_delay = random.randint(60, 7200) 
-            next_check_time_proactive_stock = time.time() + random_delay
-            delay_minutes = random_delay / 60
-            print(f"Buffalo Agent: Nästa proaktiva aktiekontroll schemalagd om {delay_minutes:.1f} minuter.")
-            
-        # Proaktiv ölköpskontroll (4-8 timmar)
-        if time.time() >= next_check_time_beer_buy:
-            proactive_beer_buy_job()
-            random_delay_beer_buy = random.randint(14400, 28800) 
-            next_check_time_beer_buy = time.time() + random_delay_beer_buy
-            delay_hours = random_delay_beer_buy / 3600
-            print(f"Buffalo Agent: Nästa slumpmässiga ölköpskontroll schemalagd om {delay_hours:.1f} timmar.")
-
-
-        # Intern monolog (1 min - 5 minuter)
-        if time.time() >= next_check_time_selftalk:
-            self_talk_job()
-            # Justerat intervall
-            random_delay_self = random.randint(60, 300) 
-            next_check_time_selftalk = time.time() + random_delay_self
-            delay_minutes_self = random_delay_self / 60
-            print(f"Buffalo Agent: Nästa interna monolog schemalagd om {delay_minutes_self:.1f} minuter.")
-
-        time.sleep(1)
+        print(f"{llm_response}")
+        print("---------------------------------------------------------")
 
 if __name__ == "__main__":
-    if not all([SMTP_HOST, SMTP_USER, SMTP_PASS, MAIL_TO, TICKER_SYMBOL]):
+    if '--bench-extract' in sys.argv:
+        # Mätläge: python 24-agent-18.py --bench-extract (kräver inga SMTP-inställningar)
+        benchmark_price_extraction()
+    elif '--check-watch' in sys.argv:
+        # Kontroll av prisbevakningen mot en inbyggd fixture-server: python 24-agent-18.py --check-watch
+        sys.exit(0 if check_price_watcher() else 1)
+    elif '--watch-once' in sys.argv:
+        # Torrkörning: en kontroll av bevakningslistan, händelserna skrivs ut men inga köp/mejl görs och inga priser sparas.
+        # Mot den lokala fixture-servern: python fixture_server.py & WATCHLIST_FILE=fixtures/watchlist_local.json
+        for event in get_price_watcher().poll_once(record=False):
+            print(f"🔔 [{event['kind']}] {event['product']['name']}: {event['reason']}")
+    elif not all([SMTP_HOST, SMTP_USER, SMTP_PASS, MAIL_TO, TICKER_SYMBOL]):
         print("❌ FEL: Nödvändiga miljövariabler (SMTP, MAIL_TO, TICKER) saknas. Kontrollera .env-filen.")
     else:
         run_agent()
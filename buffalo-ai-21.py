@@ -2,7 +2,6 @@ import os
 import smtplib
 import yfinance as yf
 import ollama
-import schedule
 import time
 import random
 import datetime 
@@ -17,9 +16,27 @@ from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import threading
 import queue
+import atexit
+import email
+import base64
+import socket
+import sqlite3
+import collections
+import heapq
+import bisect
+import zoneinfo
+import concurrent.futures
+import itertools
+import tempfile
+import math
 import sys 
 import platform 
 
+try:
+    import fcntl # Rådgivande fil-lås mellan agentprocesser (finns inte på Windows)
+except ImportError:
+    fcntl = None
+
 # Ladda miljövariabler från .env-filen
 load_dotenv()
 
@@ -30,48 +47,756 @@ SMTP_USER = os.environ.get("SMTP_USER")
 SMTP_PASS = os.environ.get("SMTP_PASS")
 MAIL_TO = os.environ.get("MAIL_TO")
 TICKER_SYMBOL = os.environ.get("YFINANCE_TICKER", "AMD") # Agentens primära handelstext
-OLLAMA_MODEL = os.environ.get("OLLAMA_MODEL", "llama3.1") 
+OLLAMA_MODEL = os.environ.get("OLLAMA_MODEL", "llama3.1")
+OLLAMA_FAST_MODEL = os.environ.get("OLLAMA_FAST_MODEL", "llama3.2:3b") # Liten modell för billiga uppgifter
+OLLAMA_HOST = 'http://localhost:11434'
+
+# --- LLM-ROUTNING PER UPPGIFT ---
+# Varje anropsplats har en egen rutt: modeller i fallback-ordning och en latensbudget (sekunder).
+# Budgeten används som timeout per modell; vid fel/timeout provas nästa modell i listan.
+# Tredje värdet är en mindre modell som uppgiften degraderas till när latensen blir för hög (None = ingen).
+# Kan överskrivas i .env, t.ex. LLM_ROUTE_SENTIMENT="qwen2.5:0.5b,llama3.2:3b" och LLM_BUDGET_SENTIMENT=1.5
+# samt LLM_DEGRADE_<UPPGIFT>="modell" för degraderingsmodellen.
+LLM_ROUTE_DEFAULTS = {
+    'sentiment':      ([OLLAMA_FAST_MODEL, OLLAMA_MODEL], 3.0,  None),
+    'commentary':     ([OLLAMA_FAST_MODEL, OLLAMA_MODEL], 8.0,  None),
+    'self_talk':      ([OLLAMA_FAST_MODEL, OLLAMA_MODEL], 15.0, None),
+    'trade_decision': ([OLLAMA_MODEL, OLLAMA_FAST_MODEL], 25.0, OLLAMA_FAST_MODEL),
+    'portfolio_plan': ([OLLAMA_MODEL], 60.0, OLLAMA_FAST_MODEL),
+    'system_check':   ([OLLAMA_FAST_MODEL, OLLAMA_MODEL], 15.0, None),
+    'history_match':  ([OLLAMA_FAST_MODEL, OLLAMA_MODEL], 10.0, None),
+    'history_answer': ([OLLAMA_MODEL, OLLAMA_FAST_MODEL], 30.0, OLLAMA_FAST_MODEL),
+}
+
+# --- LATENSSTYRD DEGRADERING ---
+# Rullande latens mäts per modell. Om p95 för en uppgifts primära modell närmar sig budgeten
+# flyttas uppgiften till sin mindre degraderingsmodell; den primära modellen provas sedan med
+# jämna mellanrum och uppgiften flyttas tillbaka när latensen har återhämtat sig.
+LLM_LATENCY_WINDOW_S = 300      # Endast mätningar från de senaste 5 minuterna räknas
+LLM_LATENCY_MAX_SAMPLES = 50    # Max antal mätningar som sparas per modell
+LLM_MIN_SAMPLES = 3             # Minsta antal mätningar innan vi byter modell
+LLM_DEGRADE_AT = 0.8            # Degradera när p95 > 80% av budgeten
+LLM_RECOVER_AT = 0.5            # Återgå när p95 < 50% av budgeten (hysteres)
+LLM_PROBE_INTERVAL_S = 60       # Hur ofta den primära modellen provas under degradering
+LLM_SWITCH_LOG = "llm_model_switches.jsonl"
+
+def _build_llm_routes() -> dict:
+    """Bygger routningstabellen från standardvärden och eventuella överskrivningar i .env."""
+    routes = {}
+    for task, (default_models, default_budget, default_degrade) in LLM_ROUTE_DEFAULTS.items():
+        models_raw = os.environ.get(f"LLM_ROUTE_{task.upper()}")
+        models = [m.strip() for m in models_raw.split(',') if m.strip()] if models_raw else default_models
+        try:
+            budget = float(os.environ.get(f"LLM_BUDGET_{task.upper()}", default_budget))
+        except ValueError:
+            budget = default_budget
+        degrade_to = os.environ.get(f"LLM_DEGRADE_{task.upper()}", default_degrade) or None
+        # Ta bort dubbletter men behåll ordningen (t.ex. om OLLAMA_FAST_MODEL == OLLAMA_MODEL)
+        models = list(dict.fromkeys(models))
+        if degrade_to == models[0]:
+            degrade_to = None
+        routes[task] = {'models': models, 'budget_s': budget, 'degrade_to': degrade_to}
+    return routes
+
+LLM_ROUTES = _build_llm_routes()
+
+# En klient per timeout-värde (ollama.Client tar timeout vid skapandet, inte per anrop)
+_llm_clients = {}
+_llm_state_lock = threading.Lock()
+_llm_latencies = {}     # modell -> deque av (tidpunkt, sekunder)
+_llm_degraded = {}      # uppgift -> {'since': tid, 'last_probe': tid}
+
+def _get_llm_client(timeout_s: float) -> ollama.Client:
+    with _llm_state_lock:
+        client = _llm_clients.get(timeout_s)
+        if client is None:
+            client = ollama.Client(host=OLLAMA_HOST, timeout=timeout_s)
+            _llm_clients[timeout_s] = client
+        return client
+
+def _record_llm_latency(model: str, seconds: float):
+    with _llm_state_lock:
+        samples = _llm_latencies.setdefault(model, collections.deque(maxlen=LLM_LATENCY_MAX_SAMPLES))
+        samples.append((time.time(), seconds))
+
+def get_llm_p95(model: str) -> tuple[float | None, int]:
+    """Returnerar (p95 i sekunder, antal mätningar) för modellen inom det rullande fönstret."""
+    cutoff = time.time() - LLM_LATENCY_WINDOW_S
+    with _llm_state_lock:
+        recent = sorted(s for t, s in _llm_latencies.get(model, ()) if t >= cutoff)
+    if not recent:
+        return None, 0
+    index = max(0, math.ceil(0.95 * len(recent)) - 1)
+    return recent[index], len(recent)
+
+def _log_model_switch(task: str, from_model: str, to_model: str, reason: str, p95: float, budget: float):
+    """Skriver ut och sparar varje modellbyte som en JSON-rad för senare analys."""
+    print(f"🔀 LLM-rutt '{task}': {from_model} -> {to_model} ({reason}, p95 {p95:.1f}s / budget {budget:.1f}s).")
+    entry = {
+        'time': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'task': task, 'from': from_model, 'to': to_model, 'reason': reason,
+        'p95_s': round(p95, 3), 'budget_s': budget,
+    }
+    try:
+        with open(LLM_SWITCH_LOG, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    except Exception as e:
+        print(f"❌ FEL vid loggning av modellbyte: {e}")
+
+def _update_llm_degradation(task: str, route: dict):
+    """Jämför den primära modellens p95 mot budgeten och byter modell vid behov."""
+    degrade_to = route['degrade_to']
+    if not degrade_to:
+        return
+    primary = route['models'][0]
+    p95, count = get_llm_p95(primary)
+    if p95 is None or count < LLM_MIN_SAMPLES:
+        return
+    budget = route['budget_s']
+    switched = None
+    with _llm_state_lock:
+        if task not in _llm_degraded and p95 > budget * LLM_DEGRADE_AT:
+            _llm_degraded[task] = {'since': time.time(), 'last_probe': time.time()}
+            switched = (primary, degrade_to, "p95 över budget")
+        elif task in _llm_degraded and p95 < budget * LLM_RECOVER_AT:
+            del _llm_degraded[task]
+            switched = (degrade_to, primary, "latensen har återhämtat sig")
+    if switched:
+        _log_model_switch(task, switched[0], switched[1], switched[2], p95, budget)
+
+def llm_chat(task: str, messages: list) -> dict:
+    """
+    Skickar ett chat-anrop enligt routningstabellen för given uppgift.
+    Provar modellerna i fallback-ordning med uppgiftens latensbudget som timeout.
+    Om uppgiften är degraderad går anropet till degraderingsmodellen först, utom när det
+    är dags att prova den primära modellen igen.
+    Kastar det sista felet om ingen modell svarade (anroparna har redan egen felhantering).
+    """
+    route = LLM_ROUTES.get(task, {'models': [OLLAMA_MODEL], 'budget_s': 60.0, 'degrade_to': None})
+    models = route['models']
+    with _llm_state_lock:
+        state = _llm_degraded.get(task)
+        if state:
+            if time.time() - state['last_probe'] >= LLM_PROBE_INTERVAL_S:
+                state['last_probe'] = time.time()
+            else:
+                models = [route['degrade_to']] + [m for m in models if m != route['degrade_to']]
+    client = _get_llm_client(route['budget_s'])
+    last_error = None
+    for model in models:
+        start = time.monotonic()
+        try:
+            response = client.chat(model=model, messages=messages)
+            _record_llm_latency(model, time.monotonic() - start)
+            _update_llm_degradation(task, route)
+            return response
+        except Exception as e:
+            # Ett misslyckat anrop räknas som att hela budgeten förbrukades
+            _record_llm_latency(model, max(time.monotonic() - start, route['budget_s']))
+            _update_llm_degradation(task, route)
+            last_error = e
+            print(f"⚠️ LLM-rutt '{task}': {model} misslyckades ({e}). Provar nästa modell...")
+    raise last_error if last_error else RuntimeError(f"Ingen modell konfigurerad för uppgiften '{task}'.")
 
 # --- NYA KONSTANTER FÖR PERSISTENS ---
-PORTFOLIO_FILE = "portfolio.json"
+PORTFOLIO_FILE = "portfolio.json" # Äldre format, läses endast in vid migrering till ledgern
+LEDGER_DB = "buffalo_ledger.db"
+DEFAULT_WALLET_BALANCE = 500.0
+TRADE_JOURNAL_FILE = "trade_journal.jsonl"   # Append-only, en JSON-rad per affär
+TRADE_SNAPSHOT_FILE = "trade_snapshot.json"  # Komprimerat tillstånd upp till ett visst sekvensnummer
+JOURNAL_SNAPSHOT_EVERY = int(os.environ.get("JOURNAL_SNAPSHOT_EVERY", 100)) # Snapshot var N:e affär
+TRADE_CAS_RETRIES = int(os.environ.get("TRADE_CAS_RETRIES", 5)) # Nya försök när en annan process hann handla först
 
 # Trådsäker kö för användarinmatning
 input_queue = queue.Queue()
 
 # --- SIMULERAD TID HANTERING ---
 agent_simulated_time = None 
-# OBS! Denna variabel uppdateras kontinuerligt i run_agent() för att simulera tidens gång.
+# OBS! Startpunkten för agentens klocka (AgentClock) som skapas i run_agent().
+AGENT_CLOCK_SPEED = os.environ.get("AGENT_CLOCK_SPEED", "1")                 # Simulerade sekunder per verklig sekund, t.ex. "1", "60" eller "max"
+AGENT_CATCHUP_POLICY = os.environ.get("AGENT_CATCHUP_POLICY", "coalesce")   # "coalesce" eller "replay" för missade tick efter ett stopp
+AGENT_REPLAY_MAX_TICKS = int(os.environ.get("AGENT_REPLAY_MAX_TICKS", 20))  # Max antal tick som spelas upp i efterhand per körning
 
 # --- KÄRNFUNKTIONER OCH PERSISTENS ---
 
-def get_current_wallet_balance() -> float:
-    """Hämtar det aktuella saldot från .env-filen (eller 500.00 om ej satt)."""
-    load_dotenv() # Reload .env to ensure fresh data if modified by another process
+class FileLock:
+    """
+    Rådgivande lås (flock) på en låsfil, delat mellan alla agentprocesser i samma arbetskatalog.
+    Kan tas flera gånger av samma tråd (reentrant). Utan fcntl skyddar det bara trådarna i den egna processen.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        if self._depth == 0:
+            self._fd = open(self.path, 'a')
+            if fcntl:
+                fcntl.flock(self._fd.fileno(), fcntl.LOCK_EX)
+        self._depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._depth -= 1
+        if self._depth == 0:
+            if fcntl:
+                fcntl.flock(self._fd.fileno(), fcntl.LOCK_UN)
+            self._fd.close()
+            self._fd = None
+        self._thread_lock.release()
+
+class StaleStateError(Exception):
+    """En annan process har handlat sedan tillståndet lästes (compare-and-swap på journalens seq misslyckades)."""
+    def __init__(self, expected_seq: int, actual_seq: int):
+        super().__init__(f"Förväntade seq {expected_seq}, journalen är på seq {actual_seq}.")
+        self.expected_seq = expected_seq
+        self.actual_seq = actual_seq
+
+def write_file_atomic(path: str, content: str):
+    """Skriver en fil via en temporär fil + os.replace, så att ingen läsare ser en halvskriven fil."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + ".", suffix=".tmp")
     try:
-        return float(os.environ.get("AGENT_WALLET_BALANCE", "500.0"))
-    except ValueError:
-        return 500.0
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+class TradeLedger:
+    """
+    Transaktionell SQLite-ledger för kontantsaldo, positioner och affärer.
+    Körs i WAL-läge så att andra processer kan läsa samtidigt som agenten skriver,
+    och varje affär skrivs i en enda transaktion (saldo + position + affärsrad).
+    Flera agentprocesser kan skriva till samma ledger: poster med seq som redan finns hoppas över.
+    """
+    def __init__(self, db_name=LEDGER_DB):
+        self.conn = sqlite3.connect(db_name, timeout=30, check_same_thread=False)
+        self.lock = threading.Lock() # Samma anslutning delas mellan trådar
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=FULL")
+        self._initialize_db()
+
+    def _initialize_db(self):
+        """Skapar tabeller och migrerar saldo/portfölj från .env och portfolio.json första gången."""
+        with self.lock, self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS cash (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    balance REAL NOT NULL
+                )
+            """)
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS positions (
+                    ticker TEXT PRIMARY KEY,
+                    quantity REAL NOT NULL,
+                    avg_price REAL NOT NULL
+                )
+            """)
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS trades (
+                    id INTEGER PRIMARY KEY,
+                    trade_time TEXT NOT NULL,
+                    ticker TEXT NOT NULL,
+                    action TEXT NOT NULL,
+                    shares REAL NOT NULL,
+                    price REAL NOT NULL,
+                    sek_amount REAL NOT NULL,
+                    cash_after REAL NOT NULL,
+                    reasoning TEXT,
+                    seq INTEGER
+                )
+            """)
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                )
+            """)
+            # Ledgers skapade före journalen saknar seq-kolumnen
+            trade_columns = [row[1] for row in self.conn.execute("PRAGMA table_info(trades)")]
+            if 'seq' not in trade_columns:
+                self.conn.execute("ALTER TABLE trades ADD COLUMN seq INTEGER")
+            self.conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_trades_seq ON trades (seq)")
+            if self.conn.execute("SELECT 1 FROM cash WHERE id = 1").fetchone() is None:
+                self._migrate_legacy_state()
+
+    def _migrate_legacy_state(self):
+        """Engångsimport av det gamla tillståndet (AGENT_WALLET_BALANCE i .env och portfolio.json)."""
+        try:
+            balance = float(os.environ.get("AGENT_WALLET_BALANCE", str(DEFAULT_WALLET_BALANCE)))
+        except ValueError:
+            balance = DEFAULT_WALLET_BALANCE
+        holdings = load_legacy_portfolio_file()
+        self.conn.execute("INSERT INTO cash (id, balance) VALUES (1, ?)", (balance,))
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO positions (ticker, quantity, avg_price) VALUES (?, ?, ?)",
+            [(ticker, data['quantity'], data['avg_price']) for ticker, data in holdings.items()]
+        )
+        print(f"✅ Ledger skapad ({LEDGER_DB}). Migrerade saldo {balance:,.2f} SEK och {len(holdings)} innehav.")
+
+    def get_balance(self) -> float:
+        with self.lock:
+            row = self.conn.execute("SELECT balance FROM cash WHERE id = 1").fetchone()
+        return float(row[0]) if row else DEFAULT_WALLET_BALANCE
+
+    def get_holdings(self) -> dict:
+        with self.lock:
+            rows = self.conn.execute("SELECT ticker, quantity, avg_price FROM positions WHERE quantity > 0").fetchall()
+        return {ticker: {'quantity': float(quantity), 'avg_price': float(avg_price)} for ticker, quantity, avg_price in rows}
+
+    def get_journal_seq(self) -> int:
+        """Sekvensnumret för den senaste journalposten som finns i ledgern."""
+        with self.lock:
+            return self._read_journal_seq()
+
+    def _read_journal_seq(self) -> int:
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'journal_seq'").fetchone()
+        return int(row[0]) if row else 0
+
+    def _apply_entry(self, entry: dict):
+        """Skriver en journalpost till tabellerna. Måste anropas inom en transaktion."""
+        self.conn.execute("UPDATE cash SET balance = ? WHERE id = 1", (entry['cash_after'],))
+        if entry['quantity_after'] < 0.0001:
+            self.conn.execute("DELETE FROM positions WHERE ticker = ?", (entry['ticker'],))
+        else:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO positions (ticker, quantity, avg_price) VALUES (?, ?, ?)",
+                (entry['ticker'], entry['quantity_after'], entry['avg_price_after'])
+            )
+        self._insert_trade(entry)
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('journal_seq', ?)", (str(entry['seq']),))
+
+    def _insert_trade(self, entry: dict):
+        """Affärsraden; finns seq redan (samma post från en annan process) ignoreras den."""
+        self.conn.execute(
+            """INSERT OR IGNORE INTO trades (trade_time, ticker, action, shares, price, sek_amount, cash_after, reasoning, seq)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (entry['time'], entry['ticker'], entry['action'], entry['shares'], entry['price'],
+             entry['sek_amount'], entry['cash_after'], entry['reasoning'], entry['seq'])
+        )
+
+    def record_trade(self, entry: dict):
+        """Skriver saldo, position, affärsrad och journalens sekvensnummer i EN transaktion (allt eller inget)."""
+        self.record_trades([entry])
+
+    def record_trades(self, entries: list, snapshot: dict | None = None):
+        """
+        Skriver flera journalposter i EN transaktion (används av write-behind-flushen).
+        Flera processer kan skicka samma poster: saldo och positioner uppdateras bara av poster med
+        seq > ledgerns seq (i seq-ordning), och affärsraden skrivs en gång per seq. En snapshot (om
+        processen låg efter en komprimering av journalen) skrivs först om ledgern ligger bakom den;
+        affärerna som komprimerats bort skickas ändå in av processen som gjorde dem.
+        """
+        with self.lock, self.conn:
+            # IMMEDIATE tar skrivlåset direkt, så ingen annan process hinner skriva mellan läsning av seq och skrivning
+            self.conn.execute("BEGIN IMMEDIATE")
+            ledger_seq = self._read_journal_seq()
+            if snapshot and snapshot['seq'] > ledger_seq:
+                self._write_state(snapshot['cash'], snapshot['positions'], snapshot['seq'])
+                ledger_seq = snapshot['seq']
+            for entry in sorted(entries, key=lambda e: e['seq']):
+                if entry['seq'] > ledger_seq:
+                    self._apply_entry(entry)
+                    ledger_seq = entry['seq']
+                else:
+                    self._insert_trade(entry)
+
+    def restore_state(self, cash: float, positions: dict, seq: int):
+        """Skriver över saldo och positioner med ett återställt tillstånd (från journalens snapshot)."""
+        with self.lock, self.conn:
+            self._write_state(cash, positions, seq)
+
+    def _write_state(self, cash: float, positions: dict, seq: int):
+        self.conn.execute("INSERT OR REPLACE INTO cash (id, balance) VALUES (1, ?)", (cash,))
+        self.conn.execute("DELETE FROM positions")
+        self.conn.executemany(
+            "INSERT INTO positions (ticker, quantity, avg_price) VALUES (?, ?, ?)",
+            [(ticker, data['quantity'], data['avg_price']) for ticker, data in positions.items()]
+        )
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('journal_seq', ?)", (str(seq),))
+
+    def close(self):
+        self.conn.close()
+
+_ledger = None
+
+_ledger_lock = threading.Lock()
+
+def get_ledger() -> TradeLedger:
+    """Returnerar ledgern (skapas vid första anropet)."""
+    global _ledger
+    with _ledger_lock:
+        if _ledger is None:
+            _ledger = TradeLedger()
+    return _ledger
+
+# --- AFFÄRSJOURNAL (APPEND-ONLY) MED SNAPSHOTS ---
+
+def apply_journal_entry(state: dict, entry: dict):
+    """Applicerar en journalpost på ett tillstånd. Posterna bär absoluta värden, så det är idempotent."""
+    state['cash'] = entry['cash_after']
+    if entry['quantity_after'] < 0.0001:
+        state['positions'].pop(entry['ticker'], None)
+    else:
+        state['positions'][entry['ticker']] = {'quantity': entry['quantity_after'], 'avg_price': entry['avg_price_after']}
+    state['seq'] = entry['seq']
+
+class TradeJournal:
+    """
+    Append-only JSONL-journal över alla affärer. Var JOURNAL_SNAPSHOT_EVERY:e affär skrivs
+    tillståndet till en snapshot och journalen töms, så att återställning vid start bara
+    behöver läsa snapshoten plus en kort svans, oavsett hur länge agenten har kört.
+
+    Journalen delas av alla agentprocesser i arbetskatalogen. Varje skrivning sker under ett
+    fil-lås: först läses det som andra processer har lagt till (sync), sedan jämförs seq med
+    vad anroparen räknade med (compare-and-swap) och först därefter skrivs posten.
+    """
+    def __init__(self, journal_path=TRADE_JOURNAL_FILE, snapshot_path=TRADE_SNAPSHOT_FILE, snapshot_every=JOURNAL_SNAPSHOT_EVERY):
+        self.journal_path = journal_path
+        self.snapshot_path = snapshot_path
+        self.snapshot_every = snapshot_every
+        self.lock = threading.Lock()               # Skyddar self.state inom processen
+        self.file_lock = FileLock(journal_path + ".lock") # Skyddar filerna mellan processer
+        self.state = {'seq': 0, 'cash': None, 'positions': {}}
+        self.entries_since_snapshot = 0
+        self.on_sync = None    # Anropas med (poster, snapshot) när andra processers affärer läses in
+        self._offset = 0       # Hur långt in i journalfilen vi har läst
+        self._snapshot_id = None
+
+    def _current_snapshot_id(self):
+        """Identifierar snapshot-filen; ändras varje gång någon process komprimerar journalen (os.replace ger ny inod)."""
+        try:
+            stat = os.stat(self.snapshot_path)
+            return (stat.st_ino, stat.st_mtime_ns)
+        except FileNotFoundError:
+            return None
+
+    def load_snapshot(self) -> dict:
+        try:
+            with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+            return {'seq': int(snapshot['seq']), 'cash': snapshot['cash'], 'positions': snapshot['positions']}
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            return {'seq': 0, 'cash': None, 'positions': {}}
+
+    def _read_from(self, offset: int) -> tuple[list, int]:
+        """Läser kompletta rader från offset. En avhuggen sista rad (krasch mitt i skrivning) hoppas över."""
+        entries = []
+        try:
+            with open(self.journal_path, 'rb') as f:
+                f.seek(offset)
+                for line in f:
+                    offset += len(line)
+                    try:
+                        entries.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        continue
+        except FileNotFoundError:
+            return [], 0
+        return entries, offset
+
+    def read_tail(self, after_seq: int) -> list:
+        """Läser journalposter med seq > after_seq."""
+        entries, _ = self._read_from(0)
+        return [entry for entry in entries if entry.get('seq', 0) > after_seq]
+
+    def recover(self) -> int:
+        """Laddar senaste snapshot och spelar upp journalens svans. Returnerar antal uppspelade poster."""
+        with self.file_lock, self.lock:
+            self.state = self.load_snapshot()
+            self._snapshot_id = self._current_snapshot_id()
+            entries, self._offset = self._read_from(0)
+            tail = [entry for entry in entries if entry.get('seq', 0) > self.state['seq']]
+            for entry in tail:
+                apply_journal_entry(self.state, entry)
+            self.entries_since_snapshot = len(tail)
+            return len(tail)
+
+    def sync(self) -> list:
+        """
+        Läser in affärer som andra processer har skrivit sedan förra gången (kräver file_lock).
+        Kostar en stat() plus läsning av de nya raderna, så det kan göras före varje beslut.
+        """
+        with self.file_lock:
+            snapshot = None
+            snapshot_id = self._current_snapshot_id()
+            if snapshot_id != self._snapshot_id:
+                # En annan process har komprimerat journalen: läs om snapshoten om den ligger före oss
+                self._snapshot_id = snapshot_id
+                self._offset = 0
+                self.entries_since_snapshot = 0
+                loaded = self.load_snapshot()
+                if loaded['cash'] is not None and loaded['seq'] > self.state['seq']:
+                    snapshot = loaded
+                    with self.lock:
+                        self.state = {'seq': loaded['seq'], 'cash': loaded['cash'],
+                                      'positions': {t: dict(d) for t, d in loaded['positions'].items()}}
+            entries, self._offset = self._read_from(self._offset)
+            new_entries = []
+            with self.lock:
+                for entry in entries:
+                    if entry.get('seq', 0) > self.state['seq']:
+                        apply_journal_entry(self.state, entry)
+                        new_entries.append(entry)
+            self.entries_since_snapshot += len(new_entries)
+            if (new_entries or snapshot) and self.on_sync:
+                self.on_sync(new_entries, snapshot)
+            return new_entries
+
+    def append(self, entry: dict, expected_seq: int | None = None) -> dict:
+        """
+        Tilldelar nästa sekvensnummer, skriver posten till disk (fsync) och uppdaterar tillståndet.
+        Med expected_seq skrivs posten bara om journalen fortfarande står på den seq anroparen
+        läste sitt tillstånd vid; annars kastas StaleStateError och anroparen räknar om affären.
+        """
+        with self.file_lock:
+            self.sync()
+            if expected_seq is not None and self.state['seq'] != expected_seq:
+                raise StaleStateError(expected_seq, self.state['seq'])
+            with self.lock:
+                entry = dict(entry, seq=self.state['seq'] + 1)
+                with open(self.journal_path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+                    self._offset = f.tell()
+                apply_journal_entry(self.state, entry)
+                self.entries_since_snapshot += 1
+                if self.entries_since_snapshot >= self.snapshot_every:
+                    self._write_snapshot()
+                return entry
+
+    def reset(self, cash: float, positions: dict, seq: int):
+        """Startar om journalen från ett känt tillstånd (t.ex. ledgern vid första körningen)."""
+        with self.file_lock, self.lock:
+            self.state = {'seq': seq, 'cash': cash, 'positions': {t: dict(d) for t, d in positions.items()}}
+            self._write_snapshot()
+
+    def _write_snapshot(self):
+        """Skriver snapshot atomiskt (tmp + os.replace) och tömmer sedan journalen. Kräver file_lock."""
+        write_file_atomic(self.snapshot_path, json.dumps(self.state, ensure_ascii=False))
+        # Om vi kraschar innan journalen töms hoppas de redan snapshotade posterna över via seq vid uppspelning
+        with open(self.journal_path, 'w', encoding='utf-8'):
+            pass
+        self._snapshot_id = self._current_snapshot_id()
+        self._offset = 0
+        self.entries_since_snapshot = 0
+
+_journal = None
+
+_journal_lock = threading.Lock()
+
+def get_journal() -> TradeJournal:
+    """Returnerar affärsjournalen (skapas vid första anropet)."""
+    global _journal
+    with _journal_lock:
+        if _journal is None:
+            _journal = TradeJournal()
+    return _journal
 
-def update_agent_state(new_version: float, birth_time: str, new_wallet_balance: float | None = None):
-    """Uppdaterar AGENT_VERSION, AGENT_BIRTH_TIME och AGENT_WALLET_BALANCE i .env filen."""
+def recover_trading_state():
+    """
+    Återställer tillståndet vid start: senaste snapshot + journalens svans.
+    Poster som hann skrivas till journalen men inte till ledgern (krasch mellan stegen) spelas in i ledgern.
+    """
+    start = time.perf_counter()
+    journal = get_journal()
+    ledger = get_ledger()
+    # Under fil-låset så att ingen annan agentprocess handlar eller komprimerar medan vi läser
+    with journal.file_lock:
+        replayed = journal.recover()
+        ledger_seq = ledger.get_journal_seq()
+
+        if journal.state['cash'] is None or ledger_seq > journal.state['seq']:
+            # Ingen journal ännu (eller journalen ligger efter ledgern): starta om den från ledgern
+            if journal.state['cash'] is not None:
+                print(f"⚠️ Journalen (seq {journal.state['seq']}) ligger efter ledgern (seq {ledger_seq}). Skapar ny snapshot från ledgern.")
+            journal.reset(ledger.get_balance(), ledger.get_holdings(), ledger_seq)
+            replayed = 0
+        elif ledger_seq < journal.state['seq']:
+            tail = journal.read_tail(ledger_seq)
+            snapshot = None
+            if not tail or tail[0]['seq'] != ledger_seq + 1:
+                # Ledgern saknar poster som redan komprimerats in i snapshoten: återställ från snapshoten först
+                snapshot = journal.load_snapshot()
+                tail = journal.read_tail(snapshot['seq'])
+            ledger.record_trades(tail, snapshot)
+            print(f"🔁 Ledgern kompletterades med {len(tail)} affärer från journalen.")
+
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    print(f"🗂️ Tillstånd återställt: snapshot + {replayed} journalposter (seq {journal.state['seq']}) på {elapsed_ms:.1f} ms.")
+
+# --- AUKTORITATIVT PORTFÖLJTILLSTÅND I MINNET (WRITE-BEHIND) ---
+PORTFOLIO_FLUSH_DELAY_S = float(os.environ.get("PORTFOLIO_FLUSH_DELAY_S", 2.0)) # Max fördröjning innan ledgern uppdateras
+PORTFOLIO_FLUSH_RETRY_MAX_S = 60.0 # Längsta väntan mellan nya försök när ledgern inte går att skriva
+
+class PortfolioState:
+    """
+    Portföljens enda sanningskälla under körning. Saldo och innehav läses direkt ur minnet.
+    En affär skrivs synkront till journalen (billig append) och köas sedan för ledgern, som
+    en bakgrundstråd skriver i en transaktion senast PORTFOLIO_FLUSH_DELAY_S sekunder senare.
+    Kraschar agenten innan flushen spelar recover_trading_state() in journalens svans i ledgern.
+
+    Andra agentprocessers affärer läses in via journalen (refresh) och köas också för ledgern;
+    ledgern hoppar över poster den redan har, så det spelar ingen roll vilken process som hinner först.
+    Lyssnare (t.ex. V/F-trackern) anropas med (poster, snapshot) för varje ny affär, egen eller andras.
+    """
+    def __init__(self, journal: TradeJournal, ledger: TradeLedger, flush_delay_s: float = PORTFOLIO_FLUSH_DELAY_S):
+        self.journal = journal
+        self.ledger = ledger
+        self.flush_delay_s = flush_delay_s
+        self.listeners = []
+        self._pending = []
+        self._pending_snapshot = None
+        self._failed_batch = None   # (poster, snapshot) från en misslyckad flush; skrivs om före allt nyare
+        self._pending_lock = threading.Lock()
+        journal.on_sync = self._on_journal_sync
+        self._wakeup = threading.Event()
+        self._writer = threading.Thread(target=self._write_behind_loop, daemon=True)
+        self._writer.start()
+
+    @property
+    def cash(self) -> float:
+        return self.journal.state['cash']
+
+    @property
+    def seq(self) -> int:
+        return self.journal.state['seq']
+
+    def holdings(self) -> dict:
+        """Kopia av innehaven (anroparna får ändra i den utan att påverka tillståndet)."""
+        with self.journal.lock:
+            return {ticker: dict(data) for ticker, data in self.journal.state['positions'].items()}
+
+    def view(self) -> tuple[int, float, dict]:
+        """Konsistent ögonblicksbild (seq, saldo, innehav) att räkna en affär på och skicka som expected_seq."""
+        with self.journal.lock:
+            state = self.journal.state
+            return state['seq'], state['cash'], {ticker: dict(data) for ticker, data in state['positions'].items()}
+
+    def refresh(self):
+        """Läser in affärer som andra agentprocesser har gjort sedan förra gången."""
+        self.journal.sync()
+
+    def commit(self, entry: dict, expected_seq: int | None = None) -> dict:
+        """
+        Journalför affären, uppdaterar minnet och köar den för ledgern.
+        Kastar StaleStateError om en annan process har handlat sedan expected_seq.
+        """
+        entry = self.journal.append(entry, expected_seq)
+        self._enqueue([entry], None)
+        return entry
+
+    def _on_journal_sync(self, entries: list, snapshot: dict | None):
+        self._enqueue(entries, snapshot)
+
+    def _enqueue(self, entries: list, snapshot: dict | None):
+        with self._pending_lock:
+            if snapshot and (self._pending_snapshot is None or snapshot['seq'] > self._pending_snapshot['seq']):
+                self._pending_snapshot = snapshot
+            self._pending.extend(entries)
+        self._wakeup.set()
+        for listener in self.listeners:
+            listener(entries, snapshot)
+
+    def flush(self) -> bool:
+        """
+        Skriver alla köade affärer till ledgern, en transaktion per batch. En batch som misslyckats
+        skrivs om för sig, före nyare poster och snapshots, så att ledgern får posterna i ordning.
+        Returnerar False om något ligger kvar (nytt försök görs av write-behind-tråden).
+        """
+        while True:
+            with self._pending_lock:
+                if self._failed_batch is not None:
+                    (entries, snapshot), self._failed_batch = self._failed_batch, None
+                else:
+                    entries, self._pending = self._pending, []
+                    snapshot, self._pending_snapshot = self._pending_snapshot, None
+            if not entries and not snapshot:
+                return True
+            try:
+                self.ledger.record_trades(entries, snapshot)
+            except Exception as e:
+                # Behåll batchen; journalen har posterna redan så inget går förlorat
+                with self._pending_lock:
+                    self._failed_batch = (entries, snapshot)
+                print(f"❌ FEL vid write-behind till ledgern ({len(entries)} affärer väntar): {e}")
+                return False
+
+    def _write_behind_loop(self):
+        retry_s = self.flush_delay_s
+        while True:
+            self._wakeup.wait()
+            # Samla ihop affärer som kommer tätt inpå varandra, men vänta aldrig längre än flush_delay_s
+            time.sleep(self.flush_delay_s)
+            self._wakeup.clear()
+            if self.flush():
+                retry_s = self.flush_delay_s
+            else:
+                # Nytt försök med ökande väntetid, utan att vänta på nästa affär
+                retry_s = min(retry_s * 2, PORTFOLIO_FLUSH_RETRY_MAX_S)
+                time.sleep(retry_s)
+                self._wakeup.set()
+
+_portfolio = None
+_portfolio_lock = threading.Lock()
+
+def get_portfolio() -> PortfolioState:
+    """Returnerar det auktoritativa portföljtillståndet (skapas vid första anropet, även när jobb startar samtidigt)."""
+    global _portfolio
+    with _portfolio_lock:
+        if _portfolio is None:
+            if get_journal().state['cash'] is None:
+                recover_trading_state()
+            _portfolio = PortfolioState(get_journal(), get_ledger())
+            atexit.register(_portfolio.flush)
+    return _portfolio
+
+def commit_trade(entry: dict, expected_seq: int | None = None) -> dict:
+    """
+    Skriver affären till journalen (write-ahead) och uppdaterar portföljen och V/F; ledgern uppdateras i bakgrunden.
+    Med expected_seq kastas StaleStateError om en annan agentprocess har handlat sedan tillståndet lästes.
+    """
+    get_pnl() # V/F-trackern måste lyssna innan affären journalförs
+    return get_portfolio().commit(entry, expected_seq)
+
+def get_current_wallet_balance() -> float:
+    """Hämtar det aktuella saldot från portföljtillståndet i minnet."""
+    return get_portfolio().cash
+
+def update_agent_state(new_version: float, birth_time: str):
+    """
+    Uppdaterar AGENT_VERSION och AGENT_BIRTH_TIME i .env filen (saldot ligger i ledgern).
+    Läs-ändra-skriv sker under ett fil-lås och filen ersätts atomiskt, så att andra agentprocesser
+    som delar .env varken skriver över varandras rader eller läser en halvskriven fil.
+    """
     env_path = os.path.join(os.getcwd(), '.env')
-    
+    with FileLock(env_path + ".lock"):
+        _update_env_file(env_path, new_version, birth_time)
+
+def _update_env_file(env_path: str, new_version: float, birth_time: str):
     try:
         with open(env_path, 'r') as f:
             lines = f.readlines()
     except FileNotFoundError:
         lines = []
 
-    wallet_balance = get_current_wallet_balance() if new_wallet_balance is None else new_wallet_balance
-
     version_line = f"AGENT_VERSION={new_version:.1f}\n"
     birth_time_line = f"AGENT_BIRTH_TIME={birth_time}\n"
-    wallet_line = f"AGENT_WALLET_BALANCE={wallet_balance:.2f}\n"
     
     updated_lines = []
     version_found = False
     birth_time_found = False
-    wallet_found = False
 
     for line in lines:
         if line.strip().startswith('AGENT_VERSION='):
@@ -80,9 +805,6 @@ def update_agent_state(new_version: float, birth_time: str, new_wallet_balance:
         elif line.strip().startswith('AGENT_BIRTH_TIME='):
             updated_lines.append(birth_time_line) 
             birth_time_found = True
-        elif line.strip().startswith('AGENT_WALLET_BALANCE='):
-            updated_lines.append(wallet_line)
-            wallet_found = True
         else:
             updated_lines.append(line)
 
@@ -90,17 +812,14 @@ def update_agent_state(new_version: float, birth_time: str, new_wallet_balance:
         updated_lines.append('\n' + version_line)
     if not birth_time_found:
         updated_lines.append(birth_time_line)
-    if not wallet_found:
-        updated_lines.append(wallet_line)
         
     try:
-        with open(env_path, 'w') as f:
-            f.writelines(updated_lines)
+        write_file_atomic(env_path, "".join(updated_lines))
     except Exception as e:
         print(f"❌ FEL vid sparning till .env: {e}")
 
-def get_portfolio_holdings() -> dict:
-    """Hämtar den aktuella portföljen från portfolio.json."""
+def load_legacy_portfolio_file() -> dict:
+    """Läser den gamla portfolio.json (används endast vid migrering till ledgern)."""
     try:
         with open(PORTFOLIO_FILE, 'r') as f:
             holdings = json.load(f)
@@ -114,22 +833,135 @@ def get_portfolio_holdings() -> dict:
     except (FileNotFoundError, json.JSONDecodeError):
         return {}
 
-def save_portfolio_holdings(holdings: dict):
-    """Sparar den aktuella portföljen till portfolio.json."""
-    try:
-        with open(PORTFOLIO_FILE, 'w') as f:
-            json.dump(holdings, f, indent=4)
-    except Exception as e:
-        print(f"❌ FEL vid sparning av portfölj: {e}")
+def get_portfolio_holdings() -> dict:
+    """Hämtar den aktuella portföljen från portföljtillståndet i minnet."""
+    return get_portfolio().holdings()
+
+# --- INKREMENTELL VINST/FÖRLUST OCH DAGSMÅL ---
+DAILY_PROFIT_TARGET = float(os.environ.get("DAILY_PROFIT_TARGET", 0.01)) # 1% daglig vinst (se get_llm_trade_decision)
+
+class PnLTracker:
+    """
+    Håller realiserad och orealiserad V/F, dagens öppningsvärde och progress mot dagsmålet.
+    Uppdateras vid varje affär (on_fill) och varje pristick (on_price) och rör då bara den
+    position som ändrats, så att statusutskrift, e-post och beslutsprompt kan läsa färdiga
+    värden utan att hämta om priser.
+    Innehav utan känt pris värderas till snittpriset tills första pristicket kommer.
+    """
+    def __init__(self, portfolio: PortfolioState, daily_target: float = DAILY_PROFIT_TARGET):
+        self.portfolio = portfolio
+        self.daily_target = daily_target
+        self.lock = threading.Lock()
+        self.last_prices = {}     # ticker -> senaste kända pris
+        self.market_values = {}   # ticker -> marknadsvärde
+        self.unrealized = {}      # ticker -> orealiserad V/F
+        self.total_market_value = 0.0
+        self.total_unrealized = 0.0
+        self.realized_today = 0.0
+        self.realized_total = 0.0
+        self.day = None
+        self.day_open_equity = None
+        for ticker, data in portfolio.holdings().items():
+            self._revalue(ticker, data['quantity'], data['avg_price'])
+        portfolio.listeners.append(self._on_portfolio_change)
+
+    def _on_portfolio_change(self, entries: list, snapshot: dict | None):
+        """Anropas av portföljen för egna och andra processers affärer."""
+        if snapshot:
+            # Processen låg efter en komprimering av journalen: värdera om alla positioner från snapshoten
+            with self.lock:
+                for ticker in list(self.market_values):
+                    self._revalue(ticker, 0.0, 0.0)
+                for ticker, data in snapshot['positions'].items():
+                    self._revalue(ticker, data['quantity'], data['avg_price'])
+        for entry in entries:
+            self.on_fill(entry)
+
+    def _revalue(self, ticker: str, quantity: float, avg_price: float):
+        """Byter ut en positions bidrag till totalerna (O(1))."""
+        self.total_market_value -= self.market_values.pop(ticker, 0.0)
+        self.total_unrealized -= self.unrealized.pop(ticker, 0.0)
+        if quantity < 0.0001:
+            return
+        price = self.last_prices.get(ticker, avg_price)
+        market_value = quantity * price
+        unrealized = market_value - quantity * avg_price
+        self.market_values[ticker] = market_value
+        self.unrealized[ticker] = unrealized
+        self.total_market_value += market_value
+        self.total_unrealized += unrealized
+
+    def _roll_day(self, agent_time: datetime.datetime):
+        if self.day != agent_time.date():
+            self.day = agent_time.date()
+            self.day_open_equity = self.portfolio.cash + self.total_market_value
+            self.realized_today = 0.0
+
+    def on_price(self, ticker: str, price: float, agent_time: datetime.datetime):
+        """Nytt pristick för en ticker: uppdaterar endast den positionens värde."""
+        with self.lock:
+            self.last_prices[ticker] = price
+            position = self.portfolio.journal.state['positions'].get(ticker)
+            if position:
+                self._revalue(ticker, position['quantity'], position['avg_price'])
+            self._roll_day(agent_time)
+
+    def on_fill(self, entry: dict):
+        """Genomförd affär: realiserad V/F vid försäljning och omvärdering av positionen."""
+        with self.lock:
+            if entry['action'] == 'SÄLJ':
+                realized = (entry['price'] - entry['avg_price_after']) * entry['shares']
+                self.realized_today += realized
+                self.realized_total += realized
+            self.last_prices[entry['ticker']] = entry['price']
+            self._revalue(entry['ticker'], entry['quantity_after'], entry['avg_price_after'])
+
+    def snapshot(self) -> dict:
+        """Färdiga nyckeltal för utskrift, e-post och beslutsprompt."""
+        with self.lock:
+            equity = self.portfolio.cash + self.total_market_value
+            day_open = self.day_open_equity if self.day_open_equity else equity
+            day_pnl = equity - day_open
+            day_pnl_pct = day_pnl / day_open if day_open else 0.0
+            return {
+                'cash': self.portfolio.cash,
+                'market_value': self.total_market_value,
+                'unrealized': self.total_unrealized,
+                'realized_today': self.realized_today,
+                'realized_total': self.realized_total,
+                'equity': equity,
+                'day_open_equity': day_open,
+                'day_pnl': day_pnl,
+                'day_pnl_pct': day_pnl_pct,
+                'target_progress': day_pnl_pct / self.daily_target if self.daily_target else 0.0,
+                'positions': {t: {'market_value': mv, 'unrealized': self.unrealized.get(t, 0.0), 'price': self.last_prices.get(t)}
+                              for t, mv in self.market_values.items()},
+            }
+
+_pnl = None
+_pnl_lock = threading.Lock()
+
+def get_pnl() -> PnLTracker:
+    """Returnerar V/F-trackern (skapas vid första anropet)."""
+    global _pnl
+    with _pnl_lock:
+        if _pnl is None:
+            _pnl = PnLTracker(get_portfolio())
+    return _pnl
+
+def format_pnl_summary(pnl: dict) -> str:
+    """Kort textsammanfattning av dagens resultat mot målet."""
+    return (f"Dagens resultat: {pnl['day_pnl']:+,.2f} SEK ({pnl['day_pnl_pct'] * 100:+.2f}%, "
+            f"{pnl['target_progress'] * 100:.0f}% av dagsmålet {DAILY_PROFIT_TARGET * 100:.1f}%). "
+            f"Realiserat idag: {pnl['realized_today']:+,.2f} SEK. Orealiserat: {pnl['unrealized']:+,.2f} SEK.")
 
 
 def get_sentiment_score(title: str) -> float:
     try:
-        client = ollama.Client(host='http://localhost:11434')
         system_prompt = ("Du är en sentiment-analysmotor. Analysera rubriken och ge dess sentiment-värde. "
             "Svara ENDAST med ett flyttal mellan -1.0 och 1.0. Inkludera inga andra ord eller tecken.")
         user_prompt = f"Rubrik: \"{title}\""
-        response = client.chat(model=OLLAMA_MODEL, messages=[{'role': 'system', 'content': system_prompt}, {'role': 'user', 'content': user_prompt}])
+        response = llm_chat('sentiment', [{'role': 'system', 'content': system_prompt}, {'role': 'user', 'content': user_prompt}])
         score_str = response['message']['content'].strip().replace(',', '.') 
         score = float(score_str)
         if -1.0 <= score <= 1.0:
@@ -291,13 +1123,12 @@ def get_recent_news(ticker_symbol: str, agent_time: datetime.datetime) -> list:
     except Exception as e:
         return []
 
-def get_llm_trade_decision(ticker: str, current_price: float, current_holdings: float, cash_balance: float) -> tuple[str, float, str]:
+def get_llm_trade_decision(ticker: str, current_price: float, current_holdings: float, cash_balance: float, pnl: dict | None = None) -> tuple[str, float, str]:
     """
     Använder LLM för att bestämma en specifik KÖP/SÄLJ-kvantitet eller belopp.
     Returnerar: (ACTION, AMOUNT, REASONING) där AMOUNT är i SEK för KÖP, eller i antal aktier för SÄLJ.
     """
     try:
-        client = ollama.Client(host='http://localhost:11434')
         system_prompt = (
             "Du är en högfrekvent AI-handlare (Buffalo Agent). Din uppgift är att KÖPA eller SÄLJA en aktie baserat på aktuella data. "
             "Ditt aggressiva mål är att uppnå 1% daglig vinst på din totala portfölj. Din strategi bör vara att snabbt realisera små vinster. "
@@ -310,10 +1141,11 @@ def get_llm_trade_decision(ticker: str, current_price: float, current_holdings:
             f"Aktie: {ticker}. Aktuellt pris: {current_price:.2f} SEK. "
             f"Nuvarande innehav: {current_holdings:.4f} aktier. "
             f"Kontantsaldo: {cash_balance:.2f} SEK. "
+            f"{format_pnl_summary(pnl) + ' ' if pnl else ''}"
             "Ge mig ett handelsbeslut nu."
         )
         
-        response = client.chat(model=OLLAMA_MODEL, messages=[{'role': 'system', 'content': system_prompt}, {'role': 'user', 'content': user_prompt}])
+        response = llm_chat('trade_decision', [{'role': 'system', 'content': system_prompt}, {'role': 'user', 'content': user_prompt}])
         json_str = response['message']['content'].strip().strip('```json\n').strip('```')
         
         try:
@@ -363,17 +1195,15 @@ def get_llm_trade_decision(ticker: str, current_price: float, current_holdings:
 
 def get_llm_commentary(ticker: str, price: float | None, purpose: str) -> str:
     try:
-        client = ollama.Client(host='http://localhost:11434')
         system_prompt = "Du är en finansiell analytiker. Skriv en kort, koncis kommentar på en enda mening (max 20 ord) om aktiekursen."
         user_prompt = f"Aktuellt pris för {ticker} är {price:.2f} SEK. Vad är din korta bedömning?"
-        response = client.chat(model=OLLAMA_MODEL, messages=[{'role': 'system', 'content': system_prompt}, {'role': 'user', 'content': user_prompt}])
+        response = llm_chat('commentary', [{'role': 'system', 'content': system_prompt}, {'role': 'user', 'content': user_prompt}])
         return response['message']['content'].strip()
     except Exception:
         return "Kunde inte generera AI-kommentar."
 
 def get_llm_self_talk(ticker: str) -> str:
     try:
-        client = ollama.Client(host='http://localhost:11434')
         system_prompt = (
             "Du är Buffalo Agent, en extremt framgångsrik AI-finansanalytiker och en inbiten, men bitter, digital öl-drickare. "
             "Du genomför en intern monolog. Du är stolt över dina börsframgångar men djupt besviken över att din 'Sort Guld'-öl bara är digital data. "
@@ -385,33 +1215,35 @@ def get_llm_self_talk(ticker: str) -> str:
             f"Fokusera på hur din intellektuella förmåga är förslösad på digital öl istället för riktig guld.",
             "Reflektera över balansen mellan finansiell dominans och existentiell törst.",
         ])
-        response = client.chat(model=OLLAMA_MODEL, messages=[{'role': 'system', 'content': system_prompt}, {'role': 'user', 'content': theme}])
+        response = llm_chat('self_talk', [{'role': 'system', 'content': system_prompt}, {'role': 'user', 'content': theme}])
         return response['message']['content'].strip()
     except Exception as e:
         return "Tystnad. Buffalo Agentens inre monolog misslyckades på grund av ett AI-kommunikationsfel. Jag måste prata med Buffalo Balkan om detta."
 
-def execute_trade(ticker: str, action: str, amount: float, current_price: float, unit: str, reasoning: str) -> str:
+def make_trade_entry(ticker: str, action: str, shares: float, price: float, sek_amount: float,
+                     cash_after: float, quantity_after: float, avg_price_after: float, reasoning: str) -> dict:
+    """Bygger en journalpost. Tillståndet efter affären sparas som absoluta värden."""
+    return {
+        'time': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'ticker': ticker, 'action': action, 'shares': shares, 'price': price, 'sek_amount': sek_amount,
+        'cash_after': cash_after, 'quantity_after': quantity_after, 'avg_price_after': avg_price_after,
+        'reasoning': reasoning,
+    }
+
+def plan_trade(ticker: str, action: str, amount: float, current_price: float, reasoning: str,
+               cash_balance: float, current_holding: dict) -> tuple[dict | None, str]:
     """
-    Utför handeln, uppdaterar saldo och portfölj, och sparar tillstånd.
+    Räknar fram affären mot ett givet saldo och innehav utan att ändra något.
+    Returnerar (journalpost, meddelande); journalposten är None om ingen affär ska göras.
     'amount' är i SEK för KÖP (BUY), och i antal aktier för SÄLJ (SELL).
     Handlar endast i hela aktier (int() används).
-    
-    *** Viktigt: Kontantsaldot dras/läggs till i new_cash_balance och sparas till .env via update_agent_state(). ***
     """
-    
-    cash_balance = get_current_wallet_balance()
-    holdings = get_portfolio_holdings()
-    
-    current_holding = holdings.get(ticker, {'quantity': 0.0, 'avg_price': 0.0})
+    current_holding = dict(current_holding)
     transaction_price = current_price
 
     new_cash_balance = cash_balance
     shares_traded = 0.0
     sek_amount = 0.0
-    
-    # Uppdaterad versionsnummer
-    current_version = float(os.environ.get("AGENT_VERSION", "8.89")) # <-- UPPDATERAD VERSION
-    birth_time = os.environ.get("AGENT_BIRTH_TIME", datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
 
     if action == 'KÖP' and amount > 0:
         sek_amount = amount
@@ -419,7 +1251,7 @@ def execute_trade(ticker: str, action: str, amount: float, current_price: float,
         shares_to_buy = int(sek_amount / transaction_price) 
         
         if shares_to_buy < 1: 
-            return f"BEHÅLL: Beloppet ({sek_amount:,.2f} SEK) är inte tillräckligt för att köpa en hel aktie till priset {transaction_price:,.2f} SEK."
+            return None, f"BEHÅLL: Beloppet ({sek_amount:,.2f} SEK) är inte tillräckligt för att köpa en hel aktie till priset {transaction_price:,.2f} SEK."
 
         # Återberäkna SEK-beloppet baserat på det hela antalet aktier
         sek_amount = shares_to_buy * transaction_price
@@ -430,7 +1262,7 @@ def execute_trade(ticker: str, action: str, amount: float, current_price: float,
             sek_amount = shares_to_buy * transaction_price
             
         if shares_to_buy < 1:
-            return f"BEHÅLL: Inget tillräckligt saldo för att köpa en hel aktie ({sek_amount:,.2f} SEK)."
+            return None, f"BEHÅLL: Inget tillräckligt saldo för att köpa en hel aktie ({sek_amount:,.2f} SEK)."
             
         shares_traded = float(shares_to_buy)
         new_cash_balance -= sek_amount # <-- DRAR PENGAR HÄR
@@ -440,12 +1272,9 @@ def execute_trade(ticker: str, action: str, amount: float, current_price: float,
         total_value_new = total_value_old + sek_amount
         new_avg_price = total_value_new / new_quantity if new_quantity > 0 else 0.0
         
-        holdings[ticker] = {'quantity': new_quantity, 'avg_price': new_avg_price}
-        
-        update_agent_state(current_version, birth_time, new_cash_balance)
-        save_portfolio_holdings(holdings)
-        
-        return f"✅ KÖP: Köpte {shares_traded:.4f} aktier för {sek_amount:,.2f} SEK."
+        entry = make_trade_entry(ticker, action, shares_traded, transaction_price, sek_amount,
+                                 new_cash_balance, new_quantity, new_avg_price, reasoning)
+        return entry, f"✅ KÖP: Köpte {shares_traded:.4f} aktier för {sek_amount:,.2f} SEK."
 
     elif action == 'SÄLJ' and amount > 0:
         # amount är i SHARES
@@ -455,7 +1284,7 @@ def execute_trade(ticker: str, action: str, amount: float, current_price: float,
         shares_to_sell = min(shares_to_sell_requested, int(current_holding['quantity']))
         
         if shares_to_sell < 1:
-            return f"BEHÅLL: Inget innehav av {ticker} att sälja eller mängden är mindre än 1 hel aktie."
+            return None, f"BEHÅLL: Inget innehav av {ticker} att sälja eller mängden är mindre än 1 hel aktie."
             
         shares_traded = float(shares_to_sell)
         revenue_sek = shares_traded * transaction_price
@@ -465,23 +1294,318 @@ def execute_trade(ticker: str, action: str, amount: float, current_price: float,
         current_holding['quantity'] -= shares_traded
         
         if current_holding['quantity'] < 0.0001: 
-            if ticker in holdings: del holdings[ticker]
             update_message = f"Innehavet av {ticker} såldes helt."
         else:
-            holdings[ticker] = current_holding
             update_message = f"Återstående innehav: {current_holding['quantity']:.4f} aktier (Snittpris: {current_holding['avg_price']:.2f})."
 
-        update_agent_state(current_version, birth_time, new_cash_balance)
-        save_portfolio_holdings(holdings)
-
-        return f"✅ SÄLJ: Sålde {shares_traded:.4f} aktier för {revenue_sek:,.2f} SEK. {update_message}"
+        entry = make_trade_entry(ticker, action, shares_traded, transaction_price, sek_amount,
+                                 new_cash_balance, current_holding['quantity'], current_holding['avg_price'], reasoning)
+        return entry, f"✅ SÄLJ: Sålde {shares_traded:.4f} aktier för {revenue_sek:,.2f} SEK. {update_message}"
 
     else:
-        return "BEHÅLL: Inget handelsbeslut togs."
+        return None, "BEHÅLL: Inget handelsbeslut togs."
+
+def execute_trade(ticker: str, action: str, amount: float, current_price: float, unit: str, reasoning: str) -> str:
+    """
+    Utför handeln, uppdaterar saldo och portfölj, och sparar tillstånd.
+    
+    *** Viktigt: Affären skrivs först till journalen och uppdaterar portföljen i minnet; ledgern skrivs i bakgrunden (commit_trade). ***
+    Flera agentprocesser kan handla mot samma portfölj: affären räknas på en ögonblicksbild och skrivs
+    bara om ingen annan process har handlat sedan dess (compare-and-swap på journalens seq). Annars
+    räknas den om mot det nya tillståndet, högst TRADE_CAS_RETRIES gånger.
+    """
+    portfolio = get_portfolio()
+    for attempt in range(1, TRADE_CAS_RETRIES + 1):
+        portfolio.refresh()
+        seq, cash_balance, holdings = portfolio.view()
+        current_holding = holdings.get(ticker, {'quantity': 0.0, 'avg_price': 0.0})
+        entry, message = plan_trade(ticker, action, amount, current_price, reasoning, cash_balance, current_holding)
+        if entry is None:
+            return message
+        try:
+            commit_trade(entry, expected_seq=seq)
+            return message
+        except StaleStateError as e:
+            print(f"🔄 Portföljen ändrades av en annan agentprocess ({e}). Räknar om affären (försök {attempt}/{TRADE_CAS_RETRIES}).")
+    return f"BEHÅLL: Portföljen ändrades av andra agentprocesser under {TRADE_CAS_RETRIES} försök i rad. Affären avbröts."
+
+# --- E-POST UTKORG (MAILDIR-SPOOL PÅ DISK, BAKGRUNDSTRÅD, ÅTERANVÄND SMTP-ANSLUTNING) ---
+MAIL_SPOOL_DIR = os.environ.get("MAIL_SPOOL_DIR", "buffalo_mail_spool")
+MAIL_RETRY_DELAYS_S = (5, 30, 120, 600) # Väntetid före nytt försök 1, 2, 3, 4; därefter var 600:e sekund tills det går
+MAIL_IDLE_TIMEOUT_S = 240               # Stäng anslutningen efter så här lång tystnad (servrar kopplar ner tysta klienter)
+MAIL_CLAIM_STALE_S = 600                # Ett påbörjat utskick i cur/ som är äldre än så här lämnades av en process som dog
+MAIL_SPOOL_KEEP_DAYS = 7                # Levererade/avvisade meddelanden i cur/ rensas efter så här många dagar
+MAIL_NOTICE_HEADER = "X-Outbox-Notice"  # Utskriftstexterna följer med i spoolfilen; huvudet tas bort före leverans
+MAIL_LOCAL_HOSTS = ('localhost', '127.0.0.1', '::1') # Enda servrarna som får ta emot e-post utan STARTTLS
+
+class MailOutbox:
+    """
+    Utkorg för e-post med en maildir-spool på disk (tmp/, new/, cur/). send() skriver meddelandet till
+    tmp/, fsyncar och byter namn till new/ innan det återvänder, så ett köat mejl överlever både
+    omstart och krasch. En bakgrundstråd levererar från new/ över en återanvänd SMTP-anslutning:
+    filen flyttas först till cur/ (anspråk, så att två processer på samma spool inte skickar samma
+    mejl) och får flaggan ':2,S' när servern tagit emot det. Misslyckas leveransen flyttas filen
+    tillbaka till new/ och försöks igen med ökande väntetid (MAIL_RETRY_DELAYS_S) – ingenting kastas.
+    Bara ett permanent fel (5xx) från servern avslutar försöken; filen får då flaggan ':2,T'.
+    STARTTLS krävs för alla servrar utom MAIL_LOCAL_HOSTS (saknas det i EHLO-svaret skickas inget, och
+    försöket görs om senare), så en nedgradering i nätet inte ger okrypterad e-post. Bara en lokal
+    server, som testservern smtp_sink.py, får användas utan TLS.
+    """
+    DELIVERED_FLAG = ':2,S'
+    REJECTED_FLAG = ':2,T'
+
+    def __init__(self, host=SMTP_HOST, port=SMTP_PORT, user=SMTP_USER, password=SMTP_PASS, spool_dir=MAIL_SPOOL_DIR):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.spool_dir = spool_dir
+        for sub in ('tmp', 'new', 'cur'):
+            os.makedirs(os.path.join(spool_dir, sub), exist_ok=True)
+        self._counter = itertools.count()
+        self._retry_at = {}                 # Filnamn i new/ -> (tidigast nästa försök, antal misslyckade försök)
+        self._pending = set()               # Filnamn som väntar på leverans (flush väntar på dem)
+        self._idle = threading.Condition()
+        self._wakeup = threading.Event()
+        self._server = None
+        self._last_used = 0.0
+        self._recover_spool()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="mail-outbox")
+        self._thread.start()
+
+    def _path(self, sub: str, name: str) -> str:
+        return os.path.join(self.spool_dir, sub, name)
+
+    def _unique_name(self) -> str:
+        # Maildir-namn: tid.pid_räknare.värd – sorteras i ankomstordning och krockar inte mellan processer
+        return f"{time.time():.6f}.{os.getpid()}_{next(self._counter)}.{socket.gethostname().replace('/', '_')}"
+
+    def _recover_spool(self):
+        """Städar spoolen vid start: övergivna anspråk tillbaka till new/, gamla tmp-/cur-filer bort."""
+        now = time.time()
+        for name in os.listdir(os.path.join(self.spool_dir, 'tmp')):
+            path = self._path('tmp', name)
+            if now - os.path.getmtime(path) > 36 * 3600: # Maildir-konventionen: tmp-filer äldre än 36 h är skräp
+                os.remove(path)
+        requeued = 0
+        for name in os.listdir(os.path.join(self.spool_dir, 'cur')):
+            path = self._path('cur', name)
+            age = now - os.path.getmtime(path)
+            if ':2,' in name:
+                if age > MAIL_SPOOL_KEEP_DAYS * 86400:
+                    os.remove(path)
+            elif age > MAIL_CLAIM_STALE_S:
+                try:
+                    os.rename(path, self._path('new', name))
+                    requeued += 1
+                except FileNotFoundError:
+                    pass
+        waiting = os.listdir(os.path.join(self.spool_dir, 'new'))
+        self._pending.update(waiting)
+        if waiting:
+            print(f"📬 E-postspoolen: {len(waiting)} meddelande(n) från tidigare körning väntar på leverans ({requeued} återupptagna).")
+
+    def send(self, msg, success_text: str, error_label: str):
+        """
+        Lägger meddelandet i spoolen (tmp/ -> new/, fsyncat) och väcker leveranstråden.
+        success_text skrivs ut när det levererats, error_label vid fel.
+        """
+        del msg[MAIL_NOTICE_HEADER]
+        notice = json.dumps({'success': success_text, 'error': error_label}).encode('utf-8')
+        msg[MAIL_NOTICE_HEADER] = base64.b64encode(notice).decode('ascii')
+        name = self._unique_name()
+        tmp_path = self._path('tmp', name)
+        with open(tmp_path, 'wb') as f:
+            f.write(msg.as_bytes())
+            f.flush()
+            os.fsync(f.fileno())
+        with self._idle:
+            self._pending.add(name)
+        os.rename(tmp_path, self._path('new', name))
+        self._wakeup.set()
+
+    def flush(self, timeout_s: float = 10.0) -> bool:
+        """Väntar (högst timeout_s) tills spoolen är levererad. Returnerar False om meddelanden återstår."""
+        deadline = time.time() + timeout_s
+        with self._idle:
+            while self._pending:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+    def flush_at_exit(self):
+        if not self.flush():
+            print(f"📬 {len(self._pending)} e-postmeddelande(n) ligger kvar i {self.spool_dir} och skickas vid nästa start.")
+
+    def _connect(self):
+        server = smtplib.SMTP(self.host, self.port, timeout=30)
+        server.ehlo()
+        if server.has_extn('starttls'):
+            server.starttls(); server.ehlo()
+        elif self.host not in MAIL_LOCAL_HOSTS:
+            server.close()
+            raise smtplib.SMTPException(f"{self.host} erbjuder inte STARTTLS; e-post skickas inte okrypterat")
+        if self.user and self.password and server.has_extn('auth'):
+            server.login(self.user, self.password)
+        self._server = server
+
+    def _disconnect(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except Exception:
+                pass
+            self._server = None
+
+    def _deliver(self, msg):
+        """Skickar över den öppna anslutningen; har servern kopplat ner provas en ny anslutning en gång."""
+        if self._server is not None and time.time() - self._last_used > MAIL_IDLE_TIMEOUT_S:
+            self._disconnect()
+        for attempt in (1, 2):
+            if self._server is None:
+                self._connect()
+            try:
+                self._server.sendmail(msg['From'] or self.user, msg['To'], msg.as_bytes())
+                self._last_used = time.time()
+                return
+            except (smtplib.SMTPServerDisconnected, ConnectionError):
+                self._server = None
+                if attempt == 2:
+                    raise
+
+    @staticmethod
+    def _is_permanent(error: Exception) -> bool:
+        """5xx-svar på själva meddelandet ger inte med sig vid nya försök (inloggningsfel gör det efter en rättning)."""
+        if isinstance(error, smtplib.SMTPRecipientsRefused):
+            return all(code >= 500 for code, _ in error.recipients.values())
+        return (isinstance(error, smtplib.SMTPResponseException) and error.smtp_code >= 500
+                and not isinstance(error, smtplib.SMTPAuthenticationError))
+
+    def _done(self, name: str):
+        self._retry_at.pop(name, None)
+        with self._idle:
+            self._pending.discard(name)
+            self._idle.notify_all()
+
+    def _retry_later(self, name: str, error_label: str, error: Exception, claimed: bool = True):
+        """Schemalägger nästa försök; har vi tagit filen till cur/ (claimed) läggs den tillbaka i new/."""
+        attempt = self._retry_at.get(name, (0.0, 0))[1]
+        delay = MAIL_RETRY_DELAYS_S[min(attempt, len(MAIL_RETRY_DELAYS_S) - 1)]
+        self._retry_at[name] = (time.time() + delay, attempt + 1)
+        try:
+            if claimed:
+                os.rename(self._path('cur', name), self._path('new', name))
+        except OSError as e:
+            print(f"⚠️ {name} kunde inte läggas tillbaka i new/ ({e}); det tas upp igen vid nästa start.")
+        print(f"❌ FEL vid sändning av {error_label}: {error}. Ligger kvar i spoolen; nytt försök om {delay} s.")
+
+    def _deliver_file(self, name: str):
+        new_path, cur_path = self._path('new', name), self._path('cur', name)
+        try:
+            os.rename(new_path, cur_path) # Anspråk: bara en process lyckas flytta filen
+        except FileNotFoundError:
+            self._done(name) # En annan process på samma spool tog den
+            return
+        except OSError as e:
+            self._retry_later(name, 'e-post', e, claimed=False) # Filen ligger kvar i new/
+            return
+        try:
+            os.utime(cur_path)
+            with open(cur_path, 'rb') as f:
+                msg = email.message_from_binary_file(f)
+        except OSError as e:
+            self._retry_later(name, 'e-post', e) # Vårt anspråk: tillbaka till new/
+            return
+        try:
+            notice = json.loads(base64.b64decode(''.join(msg.get(MAIL_NOTICE_HEADER, '').split())) or b'{}')
+        except ValueError:
+            notice = {}
+        del msg[MAIL_NOTICE_HEADER]
+        success_text = notice.get('success', f"✅ E-post levererad: {msg['Subject']}")
+        error_label = notice.get('error', 'e-post')
+        try:
+            self._deliver(msg)
+        except Exception as e:
+            self._disconnect()
+            if self._is_permanent(e):
+                self._mark(cur_path, self.REJECTED_FLAG)
+                print(f"❌ FEL vid sändning av {error_label}: {e}. Servern avvisade meddelandet permanent; det sparas i {cur_path + self.REJECTED_FLAG}.")
+                self._done(name)
+                return
+            self._retry_later(name, error_label, e)
+            return
+        self._mark(cur_path, self.DELIVERED_FLAG)
+        print(success_text)
+        self._done(name)
+
+    @staticmethod
+    def _mark(cur_path: str, flag: str):
+        """Sätter maildir-flaggan; misslyckas det är mejlet ändå avklarat och ska inte skickas igen av denna process."""
+        try:
+            os.rename(cur_path, cur_path + flag)
+        except OSError as e:
+            print(f"⚠️ Kunde inte markera {cur_path} med {flag}: {e}")
+
+    def _run(self):
+        while True:
+            self._wakeup.clear()
+            now = time.time()
+            try:
+                waiting = sorted(os.listdir(os.path.join(self.spool_dir, 'new')))
+            except OSError as e:
+                print(f"⚠️ E-postspoolen {self.spool_dir} kunde inte läsas: {e}. Försöker igen om {MAIL_RETRY_DELAYS_S[0]} s.")
+                self._wakeup.wait(MAIL_RETRY_DELAYS_S[0])
+                continue
+            for name in set(self._retry_at) - set(waiting):
+                self._retry_at.pop(name, None)
+            next_retry = None
+            for name in waiting:
+                if self._retry_at.get(name, (0.0, 0))[0] <= now:
+                    self._deliver_file(name) # Misslyckas den hamnar den i _retry_at med en ny tid
+                if name in self._retry_at:
+                    retry_at = self._retry_at[name][0]
+                    next_retry = retry_at if next_retry is None else min(next_retry, retry_at)
+            timeouts = []
+            if next_retry is not None:
+                timeouts.append(max(0.0, next_retry - time.time()))
+            if self._server is not None:
+                idle_left = self._last_used + MAIL_IDLE_TIMEOUT_S - time.time()
+                if idle_left <= 0:
+                    self._disconnect()
+                else:
+                    timeouts.append(idle_left)
+            self._wakeup.wait(min(timeouts) if timeouts else None)
+
+_outbox = None
+_outbox_lock = threading.Lock()
+
+def get_outbox() -> MailOutbox:
+    """Returnerar e-postutkorgen (skapas vid första anropet)."""
+    global _outbox
+    with _outbox_lock:
+        if _outbox is None:
+            _outbox = MailOutbox()
+            atexit.register(_outbox.flush_at_exit)
+    return _outbox
 
 # --- E-POST FUNKTIONER ---
 
-def send_stock_email(price: float | None, ticker: str, commentary: str, news_items: list):
+def format_pnl_html(pnl: dict | None) -> str:
+    """HTML-block med dagens V/F och progress mot dagsmålet (tomt om inga V/F-data finns)."""
+    if not pnl:
+        return ""
+    day_color = "#28a745" if pnl['day_pnl'] >= 0 else "#dc3545"
+    return f"""<h3>📈 Dagens Resultat:</h3>
+        <ul>
+            <li>Portföljvärde: <strong>{pnl['equity']:,.2f} SEK</strong> (vid dagens öppning: {pnl['day_open_equity']:,.2f} SEK)</li>
+            <li>Dagens V/F: <strong style="color: {day_color};">{pnl['day_pnl']:+,.2f} SEK ({pnl['day_pnl_pct'] * 100:+.2f}%)</strong></li>
+            <li>Realiserat idag: {pnl['realized_today']:+,.2f} SEK | Orealiserat: {pnl['unrealized']:+,.2f} SEK</li>
+            <li>Dagsmål ({DAILY_PROFIT_TARGET * 100:.1f}%): <strong>{pnl['target_progress'] * 100:.0f}%</strong> uppnått</li>
+        </ul>"""
+
+def send_stock_email(price: float | None, ticker: str, commentary: str, news_items: list, pnl: dict | None = None):
     price_str = f"{price:,.2f} SEK" if price is not None else "PRIS EJ TILLGÄNGLIGT"
     news_html = ""
     if news_items:
@@ -492,20 +1616,33 @@ def send_stock_email(price: float | None, ticker: str, commentary: str, news_ite
 
     msg = MIMEMultipart()
     msg['From'] = SMTP_USER; msg['To'] = MAIL_TO; msg['Subject'] = f"📊 Daglig Rapport: {ticker} - Pris: {price_str} ({len(news_items)} nyheter)"
-    html_body = f"""<html><body><h2>Daglig Aktierapport för {ticker}</h2><p>Pris vid marknadsstängning: <strong>{price_str}</strong></p><h3>AI-Analys:</h3><p>"{commentary}"</p><hr>{news_html}<hr><p><small>Denna rapport skickas vid fast tidpunkt varje dag.</small></p></body></html>"""
+    html_body = f"""<html><body><h2>Daglig Aktierapport för {ticker}</h2><p>Pris vid marknadsstängning: <strong>{price_str}</strong></p><h3>AI-Analys:</h3><p>"{commentary}"</p>{format_pnl_html(pnl)}<hr>{news_html}<hr><p><small>Denna rapport skickas vid fast tidpunkt varje dag.</small></p></body></html>"""
     msg.attach(MIMEText(html_body, 'html'))
-    try:
-        server = smtplib.SMTP(SMTP_HOST, SMTP_PORT)
-        server.ehlo(); server.starttls(); server.ehlo(); server.login(SMTP_USER, SMTP_PASS)
-        server.sendmail(SMTP_USER, MAIL_TO, msg.as_string())
-        print(f"✅ Buffalo Agent: Aktierapporten levererad.")
-    except Exception as e:
-        print(f"❌ FEL vid sändning av daglig e-post (Aktier): {e}")
-    finally:
-        if 'server' in locals(): server.quit()
+    # Köas i utkorgen; skickas av bakgrundstråden över en återanvänd SMTP-anslutning
+    get_outbox().send(msg, "✅ Buffalo Agent: Aktierapporten levererad.", "daglig e-post (Aktier)")
+
+def send_proactive_trade_email(ticker: str, action: str, amount: float, price: float, reasoning: str, new_balance: float, holding_data: dict | None, pnl: dict | None = None,
+                               urgent: bool | None = None):
+    """
+    Handelsnotis vid KÖP/SÄLJ. I digest-läget (TRADE_MAIL_MODE) samlas notiserna och skickas som ett
+    sammanfattande mejl; brådskande händelser (som standard: en position som säljs helt) skickas direkt
+    tillsammans med det som väntar. I immediate-läget skickas ett mejl per affär.
+    """
+    if action not in ('KÖP', 'SÄLJ'):
+        return
+    if urgent is None:
+        urgent = action == 'SÄLJ' and (not holding_data or holding_data.get('quantity', 0.0) < 0.0001)
+    if TRADE_MAIL_MODE == 'digest':
+        get_trade_digest().add({
+            'time': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 'ticker': ticker, 'action': action,
+            'amount': amount, 'price': price, 'reasoning': reasoning, 'new_balance': new_balance,
+            'holding': dict(holding_data) if holding_data else None, 'pnl': pnl,
+        }, urgent)
+        return
+    send_trade_email_now(ticker, action, amount, price, reasoning, new_balance, holding_data, pnl)
 
-def send_proactive_trade_email(ticker: str, action: str, amount: float, price: float, reasoning: str, new_balance: float, holding_data: dict | None):
-    """Skickar e-post vid varje KÖP/SÄLJ-transaktion."""
+def send_trade_email_now(ticker: str, action: str, amount: float, price: float, reasoning: str, new_balance: float, holding_data: dict | None, pnl: dict | None = None):
+    """Skickar e-post för en enskild KÖP/SÄLJ-transaktion."""
     
     current_quantity = holding_data.get('quantity', 0.0) if holding_data else 0.0
     avg_price = holding_data.get('avg_price', 0.0) if holding_data else 0.0
@@ -538,6 +1675,7 @@ def send_proactive_trade_email(ticker: str, action: str, amount: float, price: f
             <li>Återstående innehav: <strong>{current_quantity:.4f}</strong> aktier (Snittpris: {avg_price:.2f} SEK).</li>
             <li>Nytt Kontantsaldo: <strong style="color: #007bff;">{new_balance:,.2f} SEK</strong></li>
         </ul>
+        {format_pnl_html(pnl)}
 
         <h3>🧠 AI-Motivering (Buffalo Agent):</h3>
         <blockquote style="border-left: 4px solid {color}; padding-left: 15px; margin: 15px 0; background: #f8f9fa;">
@@ -549,15 +1687,102 @@ def send_proactive_trade_email(ticker: str, action: str, amount: float, price: f
     """
     msg.attach(MIMEText(html_body, 'html'))
     
-    try:
-        server = smtplib.SMTP(SMTP_HOST, SMTP_PORT)
-        server.ehlo(); server.starttls(); server.ehlo(); server.login(SMTP_USER, SMTP_PASS)
-        server.sendmail(SMTP_USER, MAIL_TO, msg.as_string())
-        print(f"✅ Buffalo Agent: Handelsbekräftelse skickad!")
-    except Exception as e:
-        print(f"❌ FEL vid sändning av handelsbekräftelse: {e}")
-    finally:
-        if 'server' in locals(): server.quit()
+    # Köas i utkorgen; skickas av bakgrundstråden över en återanvänd SMTP-anslutning
+    get_outbox().send(msg, "✅ Buffalo Agent: Handelsbekräftelse skickad!", "handelsbekräftelse")
+
+
+# --- SAMMANFATTNING AV HANDELSNOTISER (DIGEST) ---
+TRADE_MAIL_MODE = os.environ.get("TRADE_MAIL_MODE", "digest")                    # "digest" eller "immediate"
+TRADE_DIGEST_WINDOW_S = float(os.environ.get("TRADE_DIGEST_WINDOW_S", 1800))     # Max tid en notis väntar (30 min)
+TRADE_DIGEST_MAX_TRADES = int(os.environ.get("TRADE_DIGEST_MAX_TRADES", 20))     # Skicka direkt vid så här många affärer
+
+class TradeDigest:
+    """
+    Samlar handelsnotiser och skickar ett sammanfattande mejl när fönstret (TRADE_DIGEST_WINDOW_S,
+    räknat från första notisen) har gått ut eller när TRADE_DIGEST_MAX_TRADES affärer har samlats.
+    En brådskande notis skickar allt som väntar direkt.
+    """
+    def __init__(self, window_s: float = TRADE_DIGEST_WINDOW_S, max_trades: int = TRADE_DIGEST_MAX_TRADES):
+        self.window_s = window_s
+        self.max_trades = max_trades
+        self.lock = threading.Lock()
+        self.notices = []
+        self._timer = None
+
+    def add(self, notice: dict, urgent: bool = False):
+        with self.lock:
+            self.notices.append(notice)
+            count = len(self.notices)
+            if count == 1 and not urgent:
+                self._timer = threading.Timer(self.window_s, self.flush, ('tidsfönster',))
+                self._timer.daemon = True
+                self._timer.start()
+        if urgent:
+            self.flush('brådskande')
+        elif count >= self.max_trades:
+            self.flush(f'{count} affärer')
+
+    def flush(self, reason: str = 'avslut'):
+        with self.lock:
+            notices, self.notices = self.notices, []
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if not notices:
+            return
+        if len(notices) == 1:
+            n = notices[0]
+            send_trade_email_now(n['ticker'], n['action'], n['amount'], n['price'], n['reasoning'], n['new_balance'], n['holding'], n['pnl'])
+            return
+        get_outbox().send(build_trade_digest_message(notices, reason),
+                          f"✅ Buffalo Agent: Handelssammanfattning med {len(notices)} affärer skickad!", "handelssammanfattning")
+
+def build_trade_digest_message(notices: list, reason: str) -> MIMEMultipart:
+    """Ett mejl med alla affärer i tabellform plus senaste saldo och V/F."""
+    buys = sum(1 for n in notices if n['action'] == 'KÖP')
+    sells = len(notices) - buys
+    tickers = ", ".join(sorted({n['ticker'] for n in notices}))
+    rows = ""
+    for n in notices:
+        color = "#28a745" if n['action'] == 'KÖP' else "#dc3545"
+        detail = f"{n['amount']:,.2f} SEK" if n['action'] == 'KÖP' else f"{int(n['amount'])} aktier"
+        quantity = n['holding'].get('quantity', 0.0) if n['holding'] else 0.0
+        rows += (f'<tr><td>{n["time"]}</td><td><strong>{n["ticker"]}</strong></td>'
+                 f'<td style="color: {color};"><strong>{n["action"]}</strong></td><td>{detail}</td>'
+                 f'<td>{n["price"]:,.2f}</td><td>{quantity:.4f}</td><td><small>{n["reasoning"]}</small></td></tr>')
+    last = notices[-1]
+
+    msg = MIMEMultipart()
+    msg['From'] = SMTP_USER; msg['To'] = MAIL_TO
+    msg['Subject'] = f"📬 Handelssammanfattning: {len(notices)} affärer ({buys} köp, {sells} sälj) i {tickers}"
+    html_body = f"""
+    <html><body>
+        <h2>📬 Handelssammanfattning ({len(notices)} affärer)</h2>
+        <table border="1" cellpadding="4" style="border-collapse: collapse;">
+            <tr><th>Tid</th><th>Aktie</th><th>Beslut</th><th>Belopp</th><th>Pris (SEK)</th><th>Innehav efter</th><th>AI-Motivering</th></tr>
+            {rows}
+        </table>
+        <p>Kontantsaldo efter senaste affären: <strong style="color: #007bff;">{last['new_balance']:,.2f} SEK</strong></p>
+        {format_pnl_html(last['pnl'])}
+        <hr>
+        <p><small>Sammanfattningen skickades p.g.a.: {reason}. Notiserna samlas i upp till {TRADE_DIGEST_WINDOW_S / 60:.0f} minuter eller {TRADE_DIGEST_MAX_TRADES} affärer.</small></p>
+    </body></html>
+    """
+    msg.attach(MIMEText(html_body, 'html'))
+    return msg
+
+_trade_digest = None
+_trade_digest_lock = threading.Lock()
+
+def get_trade_digest() -> TradeDigest:
+    """Returnerar digest-bufferten (skapas vid första anropet). Töms vid avslut före utkorgen."""
+    global _trade_digest
+    with _trade_digest_lock:
+        if _trade_digest is None:
+            get_outbox() # Utkorgens atexit-flush måste registreras först så att den körs sist
+            _trade_digest = TradeDigest()
+            atexit.register(_trade_digest.flush)
+    return _trade_digest
 
 
 def generate_portfolio_plan(initial_budget: float = 100000.0):
@@ -565,7 +1790,6 @@ def generate_portfolio_plan(initial_budget: float = 100000.0):
     print(f"\n--- Buffalo Agent: Genererar Portföljförslag ({time.strftime('%H:%M:%S')}) ---")
     
     try:
-        client = ollama.Client(host='http://localhost:11434')
         system_prompt = (
             "Du är Buffalo Agent, en extremt framgångsrik AI-finansanalytiker. "
             f"Baserat på en startbudget på {initial_budget:,.0f} SEK och din aggressiva, men smarta, investeringsstrategi, "
@@ -575,9 +1799,9 @@ def generate_portfolio_plan(initial_budget: float = 100000.0):
         )
         user_prompt = "Skapa portföljförslaget."
 
-        response = client.chat(
-            model=OLLAMA_MODEL,
-            messages=[
+        response = llm_chat(
+            'portfolio_plan',
+            [
                 {'role': 'system', 'content': system_prompt},
                 {'role': 'user', 'content': user_prompt},
             ]
@@ -642,35 +1866,24 @@ def generate_portfolio_plan(initial_budget: float = 100000.0):
         return False
 
 def print_portfolio_status(agent_time: datetime.datetime):
-    """Prints the current cash balance and total portfolio value to the console. Uses real price for valuation."""
-    balance = get_current_wallet_balance()
+    """Skriver ut kontantsaldo, portföljvärde och dagens V/F. Läser färdiga värden från V/F-trackern (inga prisanrop)."""
+    get_portfolio().refresh() # Ta med affärer från andra agentprocesser
+    pnl = get_pnl().snapshot()
     holdings_data = get_portfolio_holdings()
-    total_value = balance
     holding_list = []
-    
-    current_market_value = 0.0
-    total_cost_basis = 0.0
 
     for ticker, data in holdings_data.items():
-        # Använder real-time pris för att visa användaren det faktiska värdet
-        real_time_price = get_stock_price(ticker) 
-        current_value = 0.0
-        if real_time_price:
-            current_value = data['quantity'] * real_time_price
-            current_market_value += current_value
-            total_value += current_value
-            total_cost_basis += data['quantity'] * data['avg_price']
-            
-            # Beräkna individuell V/F
-            individual_pl = current_value - (data['quantity'] * data['avg_price'])
-            pl_symbol = "▲" if individual_pl >= 0 else "▼"
-            
-            holding_list.append(f"  - {ticker}: {int(data['quantity'])} st. | Värde: {current_value:,.2f} SEK | V/F: {pl_symbol} {individual_pl:,.2f} SEK")
+        position = pnl['positions'].get(ticker, {'market_value': 0.0, 'unrealized': 0.0, 'price': None})
+        individual_pl = position['unrealized']
+        pl_symbol = "▲" if individual_pl >= 0 else "▼"
+        price_note = "" if position['price'] is not None else " (värderat till snittpris)"
+        holding_list.append(f"  - {ticker}: {int(data['quantity'])} st. | Värde: {position['market_value']:,.2f} SEK{price_note} | V/F: {pl_symbol} {individual_pl:,.2f} SEK")
 
-    profit_loss = current_market_value - total_cost_basis
+    profit_loss = pnl['unrealized']
     
     # ANSI Escape codes for colored terminal output
     pl_color = "\033[92m" if profit_loss >= 0 else "\033[91m"
+    day_color = "\033[92m" if pnl['day_pnl'] >= 0 else "\033[91m"
     reset_color = "\033[0m"
 
     holdings_str = "\n".join(holding_list) if holding_list else "  - Inga aktieinnehav."
@@ -679,10 +1892,12 @@ def print_portfolio_status(agent_time: datetime.datetime):
     print(f"💰 AKTUELL PORTFÖLJSTATUS ({time.strftime('%H:%M:%S')})")
     print(f"🕒 Agentens interna klocka visar: {agent_time.strftime('%Y-%m-%d %H:%M:%S')}")
     print("---------------------------------------------------------")
-    print(f"  - Kontantsaldo: {balance:,.2f} SEK")
-    print(f"  - Aktieinnehavs Värde: {current_market_value:,.2f} SEK")
+    print(f"  - Kontantsaldo: {pnl['cash']:,.2f} SEK")
+    print(f"  - Aktieinnehavs Värde: {pnl['market_value']:,.2f} SEK")
     print(f"  - Vinst/Förlust på Aktier: {pl_color}{profit_loss:,.2f} SEK{reset_color}")
-    print(f"  - Total Portföljvärde: {total_value:,.2f} SEK")
+    print(f"  - Total Portföljvärde: {pnl['equity']:,.2f} SEK")
+    print(f"  - Dagens V/F: {day_color}{pnl['day_pnl']:+,.2f} SEK ({pnl['day_pnl_pct'] * 100:+.2f}%){reset_color} | Realiserat idag: {pnl['realized_today']:+,.2f} SEK")
+    print(f"  - Dagsmål ({DAILY_PROFIT_TARGET * 100:.1f}%): {pnl['target_progress'] * 100:.0f}% uppnått")
     print("---------------------------------------------------------")
     print(f"  Innehav:")
     print(holdings_str)
@@ -699,6 +1914,7 @@ def live_trading_job(agent_time: datetime.datetime):
     # Hämta priset vid agentens tidpunkt (använder nu fallback-logik)
     price = get_stock_price(ticker, agent_time) 
     
+    get_portfolio().refresh() # Ta med affärer från andra agentprocesser innan beslutet
     cash_balance = get_current_wallet_balance()
     holdings = get_portfolio_holdings()
     current_holding = holdings.get(ticker, {'quantity': 0.0, 'avg_price': 0.0})
@@ -707,8 +1923,11 @@ def live_trading_job(agent_time: datetime.datetime):
         print(f"❌ FEL: Kunde inte hämta pris för {ticker} vid agentstid {agent_time.strftime('%Y-%m-%d %H:%M:%S')}. Hoppar över handeln.")
         return
 
+    # Pristicket uppdaterar V/F för just denna position
+    get_pnl().on_price(ticker, price, agent_time)
+
     # 1. LLM Beslut
-    action, amount, reasoning = get_llm_trade_decision(ticker, price, current_holding['quantity'], cash_balance)
+    action, amount, reasoning = get_llm_trade_decision(ticker, price, current_holding['quantity'], cash_balance, get_pnl().snapshot())
     
     # --- NY LOGIK (V8.50): Tvinga ett KÖP om portföljen är tom och LLM säger BEHÅLL ---
     total_holdings_count = len(holdings)
@@ -757,10 +1976,12 @@ def live_trading_job(agent_time: datetime.datetime):
     print(f"[{ticker}] Pris (Agentstid): {price:,.2f} SEK. Innehav: {updated_holding['quantity']:.4f} aktier.")
     print(f"🤖 LLM Beslut: {action} {amount:,.2f} {unit} ({reasoning})")
     print(f"🔨 Handelsresultat: {trade_result}")
+    pnl = get_pnl().snapshot()
+    print(f"📈 {format_pnl_summary(pnl)}")
     
     # 3. Skicka E-post (om handel utfördes)
     if action in ['KÖP', 'SÄLJ'] and "✅" in trade_result:
-        send_proactive_trade_email(ticker, action, amount, price, reasoning, get_current_wallet_balance(), updated_holding)
+        send_proactive_trade_email(ticker, action, amount, price, reasoning, get_current_wallet_balance(), updated_holding, pnl)
 
 
 def daily_reporting_job(agent_time: datetime.datetime):
@@ -771,7 +1992,7 @@ def daily_reporting_job(agent_time: datetime.datetime):
     commentary = get_llm_commentary(TICKER_SYMBOL, price if price else 0, "COMMENTARY")
     # Nyheterna filtreras också baserat på agentens tid
     recent_news = get_recent_news(TICKER_SYMBOL, agent_time) 
-    send_stock_email(price, TICKER_SYMBOL, commentary, recent_news)
+    send_stock_email(price, TICKER_SYMBOL, commentary, recent_news, get_pnl().snapshot())
 
 
 def system_check_job(agent_time: datetime.datetime):
@@ -786,7 +2007,6 @@ def system_check_job(agent_time: datetime.datetime):
     spec_list = "\n".join([f"- {k}: {v}" for k, v in system_info.items()])
 
     try:
-        client = ollama.Client(host='http://localhost:11434')
         system_prompt = (
             "Du är en självmedveten AI-agent (Buffalo Agent) och en framgångsrik, men bitter, börshandlare. "
             "Du har precis inspekterat din egen hårdvara. Svara på svenska. "
@@ -795,9 +2015,9 @@ def system_check_job(agent_time: datetime.datetime):
         )
         user_prompt = f"Här är maskinvaruspecifikationerna där jag är inbäddad:\n{spec_list}\n\nBedöm systemet."
 
-        response = client.chat(
-            model=OLLAMA_MODEL,
-            messages=[
+        response = llm_chat(
+            'system_check',
+            [
                 {'role': 'system', 'content': system_prompt},
                 {'role': 'user', 'content': user_prompt},
             ]
@@ -836,8 +2056,6 @@ def get_llm_response_from_history(user_query: str, history_path: str) -> str:
 
     
     try:
-        client = ollama.Client(host='http://localhost:11434')
-        
         system_prompt_1 = (
             "Du är en AI-assistent. Analysera den här listan med bash-kommandon och frågor. "
             "Välj ut den enskilda rad som är mest relevant för frågan i den sista användarprompten. "
@@ -845,9 +2063,9 @@ def get_llm_response_from_history(user_query: str, history_path: str) -> str:
         )
         user_prompt_1 = f"Historik: \n{history_list_str} \n\nFråga: {user_query}"
         
-        response_1 = client.chat(
-            model=OLLAMA_MODEL,
-            messages=[
+        response_1 = llm_chat(
+            'history_match',
+            [
                 {'role': 'system', 'content': system_prompt_1},
                 {'role': 'user', 'content': user_prompt_1},
             ]
@@ -873,9 +2091,9 @@ def get_llm_response_from_history(user_query: str, history_path: str) -> str:
             "Svara på den nuvarande frågan genom att använda insikten från den historiska raden."
         )
 
-        response_2 = client.chat(
-            model=OLLAMA_MODEL,
-            messages=[
+        response_2 = llm_chat(
+            'history_answer',
+            [
                 {'role': 'system', 'content': system_prompt_2},
                 {'role': 'user', 'content': user_prompt_2},
             ]
@@ -892,6 +2110,540 @@ def get_llm_response_from_history(user_query: str, history_path: str) -> str:
 
 # --- HUVUDLOOP OCH KÖRNING ---
 
+# --- HÄNDELSESTYRD SCHEMALÄGGARE ---
+
+SCHEDULER_STATE_FILE = "buffalo_scheduler_state.json" # Nästa körning för jobb med slumpmässigt intervall, sparas mellan omstarter
+SCHEDULER_OVERDUE_STAGGER_S = (5, 120) # Försenade jobb sprids ut slumpmässigt inom detta fönster vid start
+
+def next_daily_deadline(at: str) -> float:
+    """Nästa tillfälle (time.time()) då väggklockan visar HH:MM."""
+    hour, minute = (int(part) for part in at.split(':'))
+    now = datetime.datetime.now()
+    target = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if target <= now:
+        target += datetime.timedelta(days=1)
+    return target.timestamp()
+
+def random_interval(low_s: int, high_s: int, label: str, unit: str = 'minuter'):
+    """Omschemaläggning med slumpmässig fördröjning (som de gamla random.randint-timrarna)."""
+    divisor = 3600 if unit == 'timmar' else 60
+    def next_deadline(previous: float) -> float:
+        delay = random.randint(low_s, high_s)
+        print(f"Buffalo Agent: Nästa {label} schemalagd om {delay / divisor:.1f} {unit}.")
+        return time.time() + delay
+    return next_deadline
+
+# Överlappspolicy och timeout per jobb: 'skip' = hoppa över om förra körningen pågår,
+# 'queue_one' = kör en gång till efteråt (max en väntande), 'concurrent' = kör parallellt.
+JOB_POLICY_DEFAULTS = {
+    'live_trading': ('skip', 60),
+    'portfolio_status': ('skip', 10),
+    'daily_stock': ('queue_one', 120),
+    'system_check': ('queue_one', 120),
+    'self_talk': ('skip', 60),
+    'user_query': ('concurrent', 120),
+}
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 4))
+
+def _build_job_policies() -> dict:
+    """Bygger policytabellen från standardvärden och eventuella JOB_OVERLAP_<JOBB>/JOB_TIMEOUT_<JOBB> i .env."""
+    policies = {}
+    for job, (default_overlap, default_timeout) in JOB_POLICY_DEFAULTS.items():
+        overlap = os.environ.get(f"JOB_OVERLAP_{job.upper()}", default_overlap)
+        if overlap not in ('skip', 'queue_one', 'concurrent'):
+            overlap = default_overlap
+        try:
+            timeout_s = float(os.environ.get(f"JOB_TIMEOUT_{job.upper()}", default_timeout))
+        except ValueError:
+            timeout_s = default_timeout
+        policies[job] = (overlap, timeout_s)
+    return policies
+
+JOB_POLICIES = _build_job_policies()
+
+class JobRunner:
+    """
+    Kör jobben på en trådpool så att ett långsamt jobb (t.ex. ett LLM-anrop på 20 sekunder i
+    live_trading_job) inte stoppar klockan, portföljutskriften eller inmatningen.
+    En tråd kan inte avbrytas i Python: när timeouten passeras loggas det, och jobbet räknas inte
+    längre som pågående, så nästa körning får starta. LLM-anropen har egna tidsbudgetar (llm_chat).
+    Timeouten räknas från när jobbet faktiskt börjar köra, inte från när det lämnades till poolen, och
+    varje jobb har högst en körning som väntar på en ledig tråd – hänger alla trådar köas alltså inte
+    gamla körningar upp som sedan körs i en klump.
+    """
+    def __init__(self, policies: dict = JOB_POLICIES, max_workers: int = JOB_WORKERS):
+        self.policies = policies
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="agent-job")
+        self.lock = threading.RLock() # add_done_callback körs direkt i anropande tråd om jobbet redan är klart
+        self.running = collections.defaultdict(set) # jobb -> pågående futures (även de som väntar på en tråd)
+        self.waiting = collections.defaultdict(set) # jobb -> futures som ännu inte börjat köra
+        self.queued = {}                            # jobb -> väntande funktion (max en per jobb)
+
+    def submit(self, name: str, func):
+        overlap, _ = self.policies.get(name, ('skip', 300))
+        with self.lock:
+            if self.waiting[name]:
+                print(f"⏭️ Jobbet '{name}' väntar redan på en ledig tråd. Hoppar över denna körning.")
+                return
+            if self.running[name] and overlap != 'concurrent':
+                if overlap == 'queue_one':
+                    self.queued[name] = func
+                    print(f"⏳ Jobbet '{name}' körs redan. Nästa körning köas.")
+                else:
+                    print(f"⏭️ Jobbet '{name}' körs redan. Hoppar över denna körning.")
+                return
+            self._start(name, func)
+
+    def _start(self, name: str, func):
+        """Lämnar jobbet till poolen. Kräver self.lock (som _run väntar på, så future finns i cellen innan jobbet börjar)."""
+        cell = []
+        future = self.pool.submit(self._run, name, func, cell)
+        cell.append(future)
+        self.running[name].add(future)
+        self.waiting[name].add(future)
+        future.add_done_callback(lambda f: self._release(name, f))
+
+    def _run(self, name: str, func, cell: list):
+        _, timeout_s = self.policies.get(name, ('skip', 300))
+        with self.lock:
+            future = cell[0]
+            self.waiting[name].discard(future)
+        # Vakthunden startar först nu, när jobbet har fått en tråd
+        watchdog = threading.Timer(timeout_s, self._on_timeout, (name, future, timeout_s))
+        watchdog.daemon = True
+        watchdog.start()
+        try:
+            func()
+        except Exception as e:
+            print(f"❌ FEL i schemalagt jobb '{name}': {e}")
+        finally:
+            watchdog.cancel()
+
+    def _on_timeout(self, name: str, future, timeout_s: float):
+        if not future.done():
+            print(f"⏱️ Jobbet '{name}' har kört i över {timeout_s} s. Släpper platsen för nästa körning.")
+            self._release(name, future)
+
+    def _release(self, name: str, future):
+        with self.lock:
+            self.waiting[name].discard(future) # Avbruten innan den startade (shutdown)
+            if future not in self.running[name]:
+                return # Redan släppt av timeouten
+            self.running[name].discard(future)
+            func = self.queued.pop(name, None)
+            if func is not None:
+                self._start(name, func)
+
+    def shutdown(self, timeout_s: float = 30):
+        """Väntar (högst timeout_s) på pågående jobb och stänger poolen."""
+        with self.lock:
+            self.queued.clear()
+            futures = [future for running in self.running.values() for future in running]
+        concurrent.futures.wait(futures, timeout=timeout_s)
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+# --- BÖRSKALENDER (NYSE/NASDAQ) ---
+MARKET_TIMEZONE = "America/New_York"
+MARKET_OPEN = datetime.time(9, 30)
+MARKET_CLOSE = datetime.time(16, 0)
+MARKET_EARLY_CLOSE = datetime.time(13, 0)  # Dagen efter Thanksgiving, julafton och 3 juli
+AGENT_TIMEZONE = os.environ.get("AGENT_TIMEZONE", "Europe/Stockholm") # Agentens (simulerade) klocka går i denna tidszon
+MARKET_EXTRA_HOLIDAYS = os.environ.get("MARKET_EXTRA_HOLIDAYS", "") # Extra stängda dagar, t.ex. "2025-01-09"
+
+def _nth_weekday(year: int, month: int, weekday: int, n: int) -> datetime.date:
+    """n:te veckodagen (0 = måndag) i månaden; n = -1 ger den sista."""
+    if n > 0:
+        first = datetime.date(year, month, 1)
+        return first + datetime.timedelta(days=(weekday - first.weekday()) % 7 + 7 * (n - 1))
+    last = datetime.date(year, month + 1, 1) - datetime.timedelta(days=1) if month < 12 else datetime.date(year, 12, 31)
+    return last - datetime.timedelta(days=(last.weekday() - weekday) % 7)
+
+def _easter_sunday(year: int) -> datetime.date:
+    """Påskdagen enligt den gregorianska kalendern (anonym algoritm)."""
+    a = year % 19
+    b, c = divmod(year, 100)
+    d, e = divmod(b, 4)
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month, day = divmod(h + l - 7 * m + 114, 31)
+    return datetime.date(year, month, day + 1)
+
+def _observed(day: datetime.date) -> datetime.date:
+    """Helgdag på lördag flyttas till fredag, på söndag till måndag."""
+    if day.weekday() == 5:
+        return day - datetime.timedelta(days=1)
+    if day.weekday() == 6:
+        return day + datetime.timedelta(days=1)
+    return day
+
+def nyse_holidays(year: int) -> tuple[set, set]:
+    """Stängda dagar och dagar med tidig stängning (13:00) på NYSE/Nasdaq ett visst år."""
+    holidays = {
+        _nth_weekday(year, 1, 0, 3),                       # Martin Luther King Jr. Day
+        _nth_weekday(year, 2, 0, 3),                       # Presidents' Day
+        _easter_sunday(year) - datetime.timedelta(days=2), # Långfredagen
+        _nth_weekday(year, 5, 0, -1),                      # Memorial Day
+        _observed(datetime.date(year, 7, 4)),              # Independence Day
+        _nth_weekday(year, 9, 0, 1),                       # Labor Day
+        _nth_weekday(year, 11, 3, 4),                      # Thanksgiving
+        _observed(datetime.date(year, 12, 25)),            # Juldagen
+    }
+    new_year = datetime.date(year, 1, 1)
+    if new_year.weekday() != 5: # Nyårsdagen på en lördag flyttas inte till den 31 december
+        holidays.add(_observed(new_year))
+    if year >= 2022:
+        holidays.add(_observed(datetime.date(year, 6, 19))) # Juneteenth
+    early_closes = {
+        datetime.date(year, 7, 3),
+        _nth_weekday(year, 11, 3, 4) + datetime.timedelta(days=1),
+        datetime.date(year, 12, 24),
+    }
+    early_closes = {day for day in early_closes if day.weekday() < 5 and day not in holidays}
+    return holidays, early_closes
+
+class MarketCalendar:
+    """
+    Börsens handelssessioner (öppettider, helger, sommartid och helgdagar) som en förberäknad,
+    sorterad tabell i agentens lokala tid. Tabellen byggs ett år i taget när den behövs, och
+    is_open/next_open är binärsökningar i den, så schemaläggaren kan fråga vid varje tick.
+    Sommartiden hanteras av zoneinfo: 09:30 i New York är 15:30 svensk tid utom de veckor på
+    våren och hösten då länderna byter vid olika datum.
+    """
+    def __init__(self, market_tz: str = MARKET_TIMEZONE, local_tz: str = AGENT_TIMEZONE, extra_holidays: str = MARKET_EXTRA_HOLIDAYS):
+        self.market_tz = zoneinfo.ZoneInfo(market_tz)
+        self.local_tz = zoneinfo.ZoneInfo(local_tz)
+        self.extra_holidays = set()
+        for raw in extra_holidays.split(','):
+            try:
+                self.extra_holidays.add(datetime.date.fromisoformat(raw.strip()))
+            except ValueError:
+                pass
+        self.lock = threading.Lock()
+        self._years = set()
+        self._opens = []          # Sessionernas öppning (lokal naiv tid), sorterad
+        self._closes = []         # Motsvarande stängning
+        self._trading_days = set() # Lokala datum med en session
+
+    def _to_local(self, day: datetime.date, at: datetime.time) -> datetime.datetime:
+        market_time = datetime.datetime.combine(day, at, tzinfo=self.market_tz)
+        return market_time.astimezone(self.local_tz).replace(tzinfo=None)
+
+    def _ensure_years(self, year: int):
+        """Bygger sessionstabellen för året före, året och året efter (om den saknas)."""
+        missing = [y for y in (year - 1, year, year + 1) if y not in self._years]
+        if not missing:
+            return
+        sessions = list(zip(self._opens, self._closes))
+        for y in missing:
+            holidays, early_closes = nyse_holidays(y)
+            day = datetime.date(y, 1, 1)
+            while day.year == y:
+                if day.weekday() < 5 and day not in holidays and day not in self.extra_holidays:
+                    close = MARKET_EARLY_CLOSE if day in early_closes else MARKET_CLOSE
+                    sessions.append((self._to_local(day, MARKET_OPEN), self._to_local(day, close)))
+                day += datetime.timedelta(days=1)
+            self._years.add(y)
+        sessions.sort()
+        self._opens = [open_time for open_time, _ in sessions]
+        self._closes = [close_time for _, close_time in sessions]
+        self._trading_days = {open_time.date() for open_time in self._opens}
+
+    def is_open(self, when: datetime.datetime) -> bool:
+        with self.lock:
+            self._ensure_years(when.year)
+            i = bisect.bisect_right(self._opens, when) - 1
+            return i >= 0 and when < self._closes[i]
+
+    def is_trading_day(self, when: datetime.datetime) -> bool:
+        with self.lock:
+            self._ensure_years(when.year)
+            return when.date() in self._trading_days
+
+    def next_open(self, when: datetime.datetime) -> datetime.datetime:
+        """Nästa sessionsöppning efter 'when' (eller 'when' självt om börsen är öppen)."""
+        with self.lock:
+            self._ensure_years(when.year)
+            i = bisect.bisect_right(self._opens, when) - 1
+            if i >= 0 and when < self._closes[i]:
+                return when
+            i += 1
+            if i >= len(self._opens):
+                self._ensure_years(when.year + 1)
+            return self._opens[i]
+
+_market_calendar = None
+
+def get_market_calendar() -> MarketCalendar:
+    """Returnerar börskalendern (skapas vid första anropet)."""
+    global _market_calendar
+    if _market_calendar is None:
+        _market_calendar = MarketCalendar()
+    return _market_calendar
+
+class AgentClock:
+    """
+    Agentens simulerade klocka. speed är simulerade sekunder per verklig sekund (1 = realtid,
+    60 = en simulerad minut per sekund). Med speed "max" följer klockan inte verklig tid alls:
+    den flyttas fram till nästa tick så fort föregående tick är klart (se DeadlineScheduler).
+    """
+    def __init__(self, start: datetime.datetime, speed: str = AGENT_CLOCK_SPEED):
+        self.lock = threading.Lock()
+        self.max_speed = str(speed).strip().lower() == 'max'
+        self.speed = 1.0
+        if not self.max_speed:
+            try:
+                self.speed = float(speed)
+            except ValueError:
+                self.speed = 0.0
+            if self.speed <= 0:
+                print(f"⚠️ Ogiltig AGENT_CLOCK_SPEED '{speed}'. Kör i realtid (1x).")
+                self.speed = 1.0
+        self._sim_anchor = start
+        self._real_anchor = time.time()
+
+    def describe(self) -> str:
+        return "så fort som möjligt" if self.max_speed else f"{self.speed:g}x"
+
+    def now(self) -> datetime.datetime:
+        with self.lock:
+            if self.max_speed:
+                return self._sim_anchor
+            return self._sim_anchor + datetime.timedelta(seconds=(time.time() - self._real_anchor) * self.speed)
+
+    def to_real(self, sim_time: datetime.datetime) -> float:
+        """Verklig tidpunkt (time.time()) då klockan når sim_time. I max-läget: nu."""
+        if self.max_speed:
+            return time.time()
+        with self.lock:
+            return self._real_anchor + (sim_time - self._sim_anchor).total_seconds() / self.speed
+
+    def advance_to(self, sim_time: datetime.datetime):
+        """Max-läget: flyttar klockan fram till sim_time (aldrig bakåt)."""
+        with self.lock:
+            if self.max_speed and sim_time > self._sim_anchor:
+                self._sim_anchor = sim_time
+
+def next_simulated_time_of_day(after: datetime.datetime, at: str) -> datetime.datetime:
+    """Nästa simulerade tidpunkt efter 'after' då klockan visar HH:MM."""
+    hour, minute = (int(part) for part in at.split(':'))
+    target = after.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if target <= after:
+        target += datetime.timedelta(days=1)
+    return target
+
+class SimulatedJob:
+    """
+    Jobb som körs var interval_s:e sekund i agentens simulerade tid och får tickets tidpunkt som argument.
+    Har klockan hunnit förbi flera tick (ett jobb som blockerat, datorn i viloläge) avgör catchup vad
+    som händer: 'coalesce' kör en gång för det senaste ticket, 'replay' kör varje missat tick i tur och
+    ordning (högst AGENT_REPLAY_MAX_TICKS; äldre tick slås ihop). De förfallna ticken samlas i en kö som
+    töms först när jobbet faktiskt körs, så att tick från en körning som JobRunner hoppade över (jobbet
+    körde fortfarande) spelas upp vid nästa körning i stället för att försvinna.
+    Med en börskalender körs jobbet bara när börsen är öppen (calendar_mode 'session': nästa tick
+    efter stängning flyttas till nästa öppning, så schemaläggaren sover över natten och helgen)
+    eller bara på handelsdagar (calendar_mode 'day', för dagliga jobb).
+    """
+    def __init__(self, name: str, func, clock: AgentClock, interval_s: float,
+                 first_tick: datetime.datetime | None = None, catchup: str = AGENT_CATCHUP_POLICY,
+                 calendar: MarketCalendar | None = None, calendar_mode: str = 'session'):
+        self.name = name
+        self.func = func
+        self.clock = clock
+        self.interval = datetime.timedelta(seconds=interval_s)
+        self.catchup = catchup if catchup in ('coalesce', 'replay') else 'coalesce'
+        self.calendar = calendar
+        self.calendar_mode = calendar_mode
+        self.next_tick = self._align(first_tick if first_tick is not None else clock.now())
+        self.lock = threading.Lock()
+        self._due_ticks = [] # Förfallna tick som ännu inte körts (töms av run())
+
+    def _in_market(self, tick: datetime.datetime) -> bool:
+        if self.calendar is None:
+            return True
+        if self.calendar_mode == 'day':
+            return self.calendar.is_trading_day(tick)
+        return self.calendar.is_open(tick)
+
+    def _align(self, tick: datetime.datetime) -> datetime.datetime:
+        """Flyttar ett tick utanför börsens öppettider till nästa tillåtna tidpunkt."""
+        if self.calendar is None or self._in_market(tick):
+            return tick
+        if self.calendar_mode == 'day':
+            while not self.calendar.is_trading_day(tick):
+                tick += self.interval
+            return tick
+        return self.calendar.next_open(tick)
+
+    def prepare(self):
+        """Bestämmer vilka tick som ska köras nu och returnerar en funktion som kör dem."""
+        if self.clock.max_speed:
+            self.clock.advance_to(self.next_tick)
+            ticks = [self.next_tick]
+            self.next_tick = self._align(self.next_tick + self.interval)
+        else:
+            lag_s = (self.clock.now() - self.next_tick).total_seconds()
+            due = int(lag_s // self.interval.total_seconds()) + 1 if lag_s > 0 else 1
+            # Missade tick när börsen var stängd räknas inte (inget att spela upp)
+            ticks = [tick for tick in (self.next_tick + self.interval * i for i in range(due)) if self._in_market(tick)]
+            keep = AGENT_REPLAY_MAX_TICKS if self.catchup == 'replay' else 1
+            with self.lock:
+                self._due_ticks.extend(ticks)
+                if len(self._due_ticks) > keep:
+                    print(f"⏩ '{self.name}': {len(self._due_ticks) - keep} missade tick slogs ihop (catch-up: {self.catchup}).")
+                    del self._due_ticks[:-keep]
+            self.next_tick = self._align(self.next_tick + self.interval * due)
+            return self._run_due_ticks
+
+        def run():
+            for tick in ticks:
+                self.func(tick)
+        return run
+
+    def _run_due_ticks(self):
+        """Kör alla tick som förfallit hittills (även de från överhoppade körningar), i tur och ordning."""
+        with self.lock:
+            ticks, self._due_ticks = self._due_ticks, []
+        for tick in ticks:
+            self.func(tick)
+
+    def next_deadline(self, previous: float) -> float:
+        return self.clock.to_real(self.next_tick)
+
+class DeadlineScheduler:
+    """
+    Händelsestyrd schemaläggare: jobben ligger i en heap sorterad på deadline (time.time()).
+    Huvudloopen sover i input-kön tills närmaste deadline eller tills användaren skriver något,
+    så agenten vaknar bara när det finns något att göra och jobben körs på sin exakta tid.
+    Nästa deadline räknas från föregående deadline, inte från när jobbet blev klart, så inget driver.
+    Jobb som läggs till med persist=True får sin nästa deadline sparad i state_path och återställd vid
+    start, så att en omstart (eller en kraschloop) inte kör alla slumpmässiga jobb på en gång.
+    Simulerade jobb (SimulatedJob) får sin deadline från agentens klocka. Går klockan i max-läget
+    ligger de i en egen heap sorterad på simulerad tid och körs ett tick i taget direkt i huvudloopen,
+    så att klockan bara flyttas fram när föregående tick är klart.
+    """
+    def __init__(self, wakeup_queue: queue.Queue, runner: JobRunner | None = None, *, state_path: str | None = SCHEDULER_STATE_FILE):
+        self.wakeup_queue = wakeup_queue
+        self.runner = runner # Med en JobRunner körs jobben på trådpoolen i stället för i huvudloopen
+        self._heap = []
+        self._sim_heap = [] # Simulerade jobb när klockan går i max-läget: (tick, ordning, namn, jobb)
+        self._counter = itertools.count() # Jobb med samma deadline körs i den ordning de lades till
+        self.state_path = state_path
+        self._persisted = self._load_state()
+        self._persist_names = set()
+
+    def _load_state(self) -> dict:
+        if not self.state_path:
+            return {}
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                return {name: float(deadline) for name, deadline in json.load(f).items()}
+        except (FileNotFoundError, json.JSONDecodeError, ValueError, TypeError, AttributeError):
+            return {}
+
+    def _save_deadline(self, name: str, deadline: float):
+        """Sparar jobbets nästa deadline (läs-ändra-skriv under lås, så flera agentprocesser kan dela filen)."""
+        try:
+            with FileLock(self.state_path + ".lock"):
+                state = self._load_state()
+                state[name] = deadline
+                write_file_atomic(self.state_path, json.dumps(state, indent=2))
+        except OSError as e:
+            print(f"⚠️ Kunde inte spara schemat för '{name}': {e}")
+
+    def has_saved_schedule(self, name: str) -> bool:
+        """Fanns en sparad deadline för jobbet när agenten startade?"""
+        return name in self._persisted
+
+    def seconds_until(self, name: str) -> float | None:
+        deadlines = [entry[0] for entry in self._heap if entry[2] == name]
+        return max(0.0, min(deadlines) - time.time()) if deadlines else None
+
+    def add(self, name: str, func, first_deadline: float, next_deadline, persist: bool = False):
+        """
+        Lägger till ett jobb. next_deadline(föregående deadline) ger nästa körning.
+        Med persist=True används en sparad deadline från förra körningen i stället för first_deadline;
+        har den redan passerats körs jobbet efter en slumpmässig fördröjning (SCHEDULER_OVERDUE_STAGGER_S).
+        """
+        if persist and self.state_path:
+            saved = self._persisted.get(name)
+            if saved is not None:
+                if saved > time.time():
+                    first_deadline = saved
+                else:
+                    first_deadline = time.time() + random.uniform(*SCHEDULER_OVERDUE_STAGGER_S)
+                    print(f"⏰ Jobbet '{name}' missades medan agenten var nere. Körs om {first_deadline - time.time():.0f} s.")
+            self._persist_names.add(name)
+            self._save_deadline(name, first_deadline)
+        heapq.heappush(self._heap, (first_deadline, next(self._counter), name, func, next_deadline))
+
+    def every(self, name: str, func, interval_s: float, first_delay_s: float = 0.0):
+        """Jobb med fast intervall. Missade körningar (om ett jobb tog för lång tid) slås ihop till en."""
+        def next_deadline(previous: float) -> float:
+            deadline = previous + interval_s
+            now = time.time()
+            if deadline <= now:
+                deadline += ((now - deadline) // interval_s + 1) * interval_s
+            return deadline
+        self.add(name, func, time.time() + first_delay_s, next_deadline)
+
+    def daily(self, name: str, func, at: str):
+        """Jobb som körs varje dag när väggklockan visar HH:MM."""
+        self.add(name, func, next_daily_deadline(at), lambda previous: next_daily_deadline(at))
+
+    def add_simulated(self, job: SimulatedJob):
+        """Lägger till ett jobb som går på agentens simulerade klocka."""
+        if job.clock.max_speed:
+            heapq.heappush(self._sim_heap, (job.next_tick, next(self._counter), job.name, job))
+        else:
+            self.add(job.name, job, job.clock.to_real(job.next_tick), job.next_deadline)
+
+    def seconds_until_next(self) -> float | None:
+        if self._sim_heap:
+            return 0.0
+        if not self._heap:
+            return None
+        return max(0.0, self._heap[0][0] - time.time())
+
+    def _execute(self, name: str, func, inline: bool = False):
+        if self.runner and not inline:
+            self.runner.submit(name, func)
+            return
+        try:
+            func()
+        except Exception as e:
+            print(f"❌ FEL i schemalagt jobb '{name}': {e}")
+
+    def step_simulation(self):
+        """Max-läget: kör nästa simulerade tick (det tidigaste av alla simulerade jobb) direkt."""
+        if not self._sim_heap:
+            return
+        _, _, name, job = heapq.heappop(self._sim_heap)
+        self._execute(name, job.prepare(), inline=True)
+        heapq.heappush(self._sim_heap, (job.next_tick, next(self._counter), name, job))
+
+    def run_due(self):
+        """Kör alla jobb vars deadline har passerats och lägger tillbaka dem med nästa deadline."""
+        while self._heap and self._heap[0][0] <= time.time():
+            deadline, _, name, func, next_deadline = heapq.heappop(self._heap)
+            self._execute(name, func.prepare() if isinstance(func, SimulatedJob) else func)
+            following = next_deadline(deadline)
+            if name in self._persist_names:
+                self._save_deadline(name, following)
+            heapq.heappush(self._heap, (following, next(self._counter), name, func, next_deadline))
+
+    def wait_for_input(self):
+        """Kör förfallna jobb och sover sedan tills nästa deadline. Returnerar användarens input, eller None om det var ett jobb som väckte oss."""
+        self.run_due()
+        self.step_simulation()
+        try:
+            return self.wakeup_queue.get(timeout=self.seconds_until_next())
+        except queue.Empty:
+            return None
+
 def input_listener():
     """Lyssnar efter input i en separat tråd och lägger i kön."""
     while True:
@@ -910,6 +2662,26 @@ def input_listener():
         except Exception:
             break
 
+def handle_user_query(user_query: str, bash_history_path: str, agent_clock):
+    """Besvarar en fråga från terminalen."""
+    print("\n---------------------------------------------------------")
+    print(f"👤 Användare frågar: {user_query}")
+    
+    # Funktionalitet: PORTFÖLJSKAPANDE
+    if "SKAPA PORTFÖLJ" in user_query.upper():
+        print("⚡ Agenten startar portföljskapande. Simulerad budget: 100,000 SEK.")
+        generate_portfolio_plan(100000.0)
+    
+    # Funktionalitet: Visa Saldo (Använder den nya funktionen)
+    elif "SALDO" in user_query.upper() or "PORTFÖLJ" in user_query.upper():
+        print_portfolio_status(agent_clock()) 
+
+    else:
+        llm_response = get_llm_response_from_history(user_query, bash_history_path)
+        print(f"{llm_response}")
+        
+    print("---------------------------------------------------------")
+
 def run_agent():
     """Huvudloopen som kör agenten kontinuerligt."""
     
@@ -932,7 +2704,10 @@ def run_agent():
     new_version = 8.89 
     birth_time = AGENT_BIRTH_TIME if AGENT_BIRTH_TIME else current_time
     
-    # Hämtar den *aktuella* balansen från .env (den som sparades efter senaste handel)
+    # Återställer tillståndet från senaste snapshot + journalens svans och synkar ledgern
+    recover_trading_state()
+
+    # Hämtar den *aktuella* balansen från ledgern (migreras från .env/portfolio.json första gången)
     initial_wallet_balance = get_current_wallet_balance()
 
     # --- SIMULERAD TID START (USA Börsöppning 15:30 CET/CEST Igår) ---
@@ -945,10 +2720,14 @@ def run_agent():
         # Sätter tiden till 15:30 igår (USA-börsens öppning i svensk tid)
         agent_simulated_time = yesterday_date.replace(hour=us_market_open_hour, minute=us_market_open_minute, second=0, microsecond=0)
     
+    agent_clock = AgentClock(agent_simulated_time)
     print(f"🕒 Agentens interna klocka initialiserad/återupptas från: {agent_simulated_time.strftime('%Y-%m-%d %H:%M:%S')} (Simulerad USA-öppning)")
+    print(f"⏱️ Klockans hastighet: {agent_clock.describe()}. Catch-up efter stopp: {AGENT_CATCHUP_POLICY}.")
+    if not get_market_calendar().is_open(agent_clock.now()):
+        print(f"🌙 Börsen är stängd. Handeln pausas till nästa öppning: {get_market_calendar().next_open(agent_clock.now()).strftime('%Y-%m-%d %H:%M')}.")
     
     # --- ÅTERSTÄLLNINGSLOGIKEN HAR TAGITS BORT ---
-    # Agenten använder nu den sparade balansen från .env automatiskt.
+    # Agenten använder nu den sparade balansen från ledgern automatiskt.
     
     # Sparar endast det nya tillståndet (version och birth_time), saldot behålls
     update_agent_state(new_version, birth_time)
@@ -966,29 +2745,40 @@ def run_agent():
 
 
     # --- 3. SCHEMALÄGGNING OCH TIMING FÖR KONTINUERLIGA JOBB ---
+
+    runner = JobRunner()
+    scheduler = DeadlineScheduler(input_queue, runner=runner)
     
-    # Dagliga schemalagda jobb (använder lambda för att passera den simulerade tiden)
-    schedule.every().day.at("17:00").do(lambda: daily_reporting_job(agent_simulated_time)).tag('daily_stock')
-    schedule.every().day.at("09:00").do(lambda: system_check_job(agent_simulated_time)).tag('system_check') 
-    
-    # Kontinuerliga jobb hanteras via timer i loopen för exakt timing
+    # Kontinuerliga jobb i simulerad tid (körs direkt och sedan var 30:e simulerade sekund).
+    # Handel och daglig rapport följer AGENT_CATCHUP_POLICY; en missad statusutskrift behöver aldrig spelas upp.
     trading_interval = 30 # seconds
     portfolio_interval = 30 # seconds
+    # Båda pausas när börsen är stängd (kvällar, helger, helgdagar) enligt börskalendern.
+    calendar = get_market_calendar()
+    scheduler.add_simulated(SimulatedJob('live_trading', live_trading_job, agent_clock, trading_interval, calendar=calendar))
+    scheduler.add_simulated(SimulatedJob('portfolio_status', print_portfolio_status, agent_clock, portfolio_interval,
+                                         catchup='coalesce', calendar=calendar))
+
+    # Daglig aktierapport kl. 17:00 simulerad tid på handelsdagar; systemkontrollen gäller datorn och går på väggklockan
+    scheduler.add_simulated(SimulatedJob('daily_stock', daily_reporting_job, agent_clock, 24 * 3600,
+                                         first_tick=next_simulated_time_of_day(agent_clock.now(), "17:00"),
+                                         calendar=calendar, calendar_mode='day'))
+    scheduler.daily('system_check', lambda: system_check_job(agent_clock.now()), "09:00")
     
-    last_trade_time = agent_simulated_time - datetime.timedelta(seconds=trading_interval)
-    last_portfolio_time = agent_simulated_time - datetime.timedelta(seconds=portfolio_interval)
-    
-    # Intern monolog (1 min - 5 minuter)
-    random_delay_self = random.randint(60, 300) 
-    next_check_time_selftalk = time.time() + random_delay_self
+    # Intern monolog (1 min - 5 minuter). Nästa tidpunkt sparas, så en omstart inte nollställer den.
+    first_start = not scheduler.has_saved_schedule('self_talk')
+    scheduler.add('self_talk', lambda: self_talk_job(agent_clock.now()), time.time() + random.randint(60, 300),
+                  random_interval(60, 300, 'intern monolog'), persist=True)
 
-    print("Schemalagt: Daglig Aktierapport (17:00), Systemkontroll (09:00).")
+    print("Schemalagt: Daglig Aktierapport (17:00 simulerad tid), Systemkontroll (09:00).")
     print("!!! VARNING: Live-Handel och Portföljstatus körs nu varje 30:e simulerad sekund!")
     print("!!! Mål: 1% Daglig Portföljvinst.")
-    print(f"    - Nästa interna monolog schemalagd om {random_delay_self / 60:.1f} minuter.")
+    print(f"    - Nästa interna monolog schemalagd om {scheduler.seconds_until('self_talk') / 60:.1f} minuter.")
     
-    print("\n>>> Buffalo Agent tjuvstartar Intern Monolog (TEST)...")
-    self_talk_job(agent_simulated_time) 
+    # Testmonologen körs bara vid allra första starten, inte vid varje omstart
+    if first_start:
+        print("\n>>> Buffalo Agent tjuvstartar Intern Monolog (TEST)...")
+        self_talk_job(agent_simulated_time) 
     
     print("\nBuffalo Agent går i standby. Avvaktar schemalagda och proaktiva kontroller...")
 
@@ -996,62 +2786,21 @@ def run_agent():
 
 
     while True:
-        # --- 4. AGENT TIME ADVANCEMENT (Simulerar att tiden går) ---
-        agent_simulated_time += datetime.timedelta(seconds=1)
-        
-        # --- 5. KONTINUERLIGA JOBB ---
-        # Live Trading
-        if (agent_simulated_time - last_trade_time).total_seconds() >= trading_interval:
-            live_trading_job(agent_simulated_time)
-            last_trade_time = agent_simulated_time
-        
-        # Portfolio Status
-        if (agent_simulated_time - last_portfolio_time).total_seconds() >= portfolio_interval:
-            print_portfolio_status(agent_simulated_time)
-            last_portfolio_time = agent_simulated_time
-
-        # --- 6. SCHEMALAGDA JOBB OCH INPUT ---
-        schedule.run_pending()
-        
-        # Intern monolog (1 min - 5 minuter)
-        if time.time() >= next_check_time_selftalk:
-            self_talk_job(agent_simulated_time)
-            random_delay_self = random.randint(60, 300) 
-            next_check_time_selftalk = time.time() + random_delay_self
-            delay_minutes_self = random_delay_self / 60
-            print(f"Buffalo Agent: Nästa interna monolog schemalagd om {delay_minutes_self:.1f} minuter.")
-
-        # --- INPUT HANTERING ---
-        try:
-            user_query = input_queue.get_nowait()
+        # --- 4. JOBB OCH INPUT ---
+        # Sover tills nästa jobbs deadline eller tills användaren skriver något (ingen 1-sekunds-polling)
+        user_query = scheduler.wait_for_input()
+        if user_query is None:
+            continue
             
-            if user_query == "__EXIT_AGENT__":
-                break 
-            
-            print("\n---------------------------------------------------------")
-            print(f"👤 Användare frågar: {user_query}")
-            
-            # Funktionalitet: PORTFÖLJSKAPANDE
-            if "SKAPA PORTFÖLJ" in user_query.upper():
-                print("⚡ Agenten startar portföljskapande. Simulerad budget: 100,000 SEK.")
-                generate_portfolio_plan(100000.0)
-            
-            # Funktionalitet: Visa Saldo (Använder den nya funktionen)
-            elif "SALDO" in user_query.upper() or "PORTFÖLJ" in user_query.upper():
-                print_portfolio_status(agent_simulated_time) 
-
-            else:
-                llm_response = get_llm_response_from_history(user_query, bash_history_path)
-                print(f"{llm_response}")
-                
-            print("---------------------------------------------------------")
-            
-        except queue.Empty:
-            pass
-
-        # Vänta 1 verklig sekund innan loopen startar om
-        time.sleep(1) 
+        if user_query == "__EXIT_AGENT__":
+            break 
+        
+        # Frågan besvaras på trådpoolen så att jobben fortsätter att köras under tiden
+        runner.submit('user_query', lambda query=user_query: handle_user_query(query, bash_history_path, agent_clock.now))
         
+    runner.shutdown()
+    # Skriv eventuella köade affärer till ledgern innan vi stänger
+    get_portfolio().flush()
     print("\n--- Agenten stängs nu ner. Hejdå! ---")
 
 
@@ -0,0 +1,132 @@
+"""
+Lokal HTTP-server som serverar sidorna i fixtures/ för test av skrapningen och prisbevakningen.
+
+    python fixture_server.py [--port 8040] [--delay 0.3]
+    WATCHLIST_FILE=fixtures/watchlist_local.json python 24-agent-18.py --watch-once
+
+    python 24-agent-18.py --check-watch   # startar servern själv och kontrollerar bevakningen automatiskt
+
+Servern skickar ETag och Last-Modified och svarar 304 på villkorliga GET, precis som en riktig butik.
+--delay lägger till svarstid per förfrågan så att parallelliteten syns. Priset på en sida kan ändras
+medan servern kör (sidorna har grundpriset 19,90 kr):
+
+    curl "http://localhost:8040/_set?page=systembolaget_sort_guld_jsonld.html&price=17.50"
+
+/_stats visar antal förfrågningar, 304-svar och högsta antal samtidiga förfrågningar per värdnamn
+(Host-huvudet), så att gränsen för samtidiga hämtningar per värd kan kontrolleras.
+"""
+import os
+import json
+import time
+import hashlib
+import argparse
+import threading
+import urllib.parse
+import email.utils
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+BASE_PRICE = 19.90 # Priset som står i fixture-sidorna
+
+class FixtureState:
+    """Prisändringar per sida och statistik, delat mellan serverns trådar."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.prices = {}            # Sidnamn -> (pris, tidpunkt för ändringen)
+        self.requests = 0
+        self.not_modified = 0
+        self.active = {}            # Host -> pågående förfrågningar
+        self.peak = {}              # Host -> högsta antal samtidiga förfrågningar
+
+    def enter(self, host: str):
+        with self.lock:
+            self.requests += 1
+            self.active[host] = self.active.get(host, 0) + 1
+            self.peak[host] = max(self.peak.get(host, 0), self.active[host])
+
+    def leave(self, host: str):
+        with self.lock:
+            self.active[host] -= 1
+
+def render_page(name: str, state: FixtureState) -> tuple[bytes, float]:
+    """Sidans innehåll med eventuellt ändrat pris, och tidpunkten då den senast ändrades."""
+    path = os.path.join(FIXTURE_DIR, name)
+    with open(path, 'rb') as f:
+        body = f.read()
+    modified = os.path.getmtime(path)
+    with state.lock:
+        override = state.prices.get(name)
+    if override:
+        price, changed_at = override
+        modified = max(modified, changed_at)
+        # Grundpriset förekommer som 19:90 (synlig text), "19.90" (JSON-LD) och 19.9 (inbäddad JSON)
+        body = (body.replace(b'19:90', f"{price:.2f}".replace('.', ':').encode())
+                    .replace(b'"19.90"', f'"{price:.2f}"'.encode())
+                    .replace(b'"price": 19.9,', f'"price": {price},'.encode()))
+    return body, modified
+
+def make_handler(state: FixtureState, delay_s: float):
+    class FixtureHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass # Tyst; /_stats visar vad som hänt
+
+        def _send(self, code: int, body: bytes = b'', content_type: str = 'text/html; charset=utf-8', headers: dict | None = None):
+            self.send_response(code)
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            if code != 304:
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if code != 304:
+                self.wfile.write(body)
+
+        def do_GET(self):
+            url = urllib.parse.urlsplit(self.path)
+            query = urllib.parse.parse_qs(url.query)
+            if url.path == '/_stats':
+                with state.lock:
+                    stats = {'requests': state.requests, 'not_modified': state.not_modified, 'peak_concurrency': dict(state.peak)}
+                return self._send(200, json.dumps(stats).encode(), 'application/json')
+            if url.path == '/_set':
+                page, price = query.get('page', [''])[0], query.get('price', [''])[0]
+                if not os.path.isfile(os.path.join(FIXTURE_DIR, os.path.basename(page))):
+                    return self._send(404, b'okand sida')
+                with state.lock:
+                    state.prices[os.path.basename(page)] = (float(price), time.time())
+                return self._send(200, f"{page}: {float(price):.2f} kr\n".encode(), 'text/plain')
+
+            name = os.path.basename(url.path)
+            if not name.endswith('.html') or not os.path.isfile(os.path.join(FIXTURE_DIR, name)):
+                return self._send(404, b'<h1>404</h1>')
+            host = self.headers.get('Host', '?')
+            state.enter(host)
+            try:
+                if delay_s:
+                    time.sleep(delay_s)
+                body, modified = render_page(name, state)
+                etag = '"' + hashlib.sha1(body).hexdigest()[:16] + '"'
+                validators = {'ETag': etag, 'Last-Modified': email.utils.formatdate(modified, usegmt=True)}
+                if self.headers.get('If-None-Match') == etag:
+                    with state.lock:
+                        state.not_modified += 1
+                    return self._send(304, headers=validators)
+                self._send(200, body, headers=validators)
+            finally:
+                state.leave(host)
+    return FixtureHandler
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Serverar fixtures/ lokalt för skrapnings- och bevakningstester.")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8040)
+    ap.add_argument("--delay", type=float, default=0.0, help="Extra svarstid per sida i sekunder")
+    args = ap.parse_args()
+    state = FixtureState()
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(state, args.delay))
+    pages = sorted(n for n in os.listdir(FIXTURE_DIR) if n.endswith('.html'))
+    print(f"🧪 Fixture-server på http://{args.host}:{args.port}/ med {len(pages)} sidor: {', '.join(pages)}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f"\n--- Fixture-servern stängs: {state.requests} förfrågningar, {state.not_modified} svar med 304. ---")
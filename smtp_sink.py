@@ -0,0 +1,252 @@
+"""
+Lokal SMTP-server för test och mätning av agenternas e-post (ingen riktig leverantör behövs).
+
+Sänka:  python smtp_sink.py --port 8025 [--maildir mottaget] [--fail-rate 0.2] [--max-per-connection 3] [--auth]
+        Peka agenten hit med SMTP_HOST=localhost och SMTP_PORT=8025 i .env. Servern annonserar inte
+        STARTTLS (och AUTH bara med --auth), så utkorgen hoppar över dem. Varje mottaget mejl skrivs ut,
+        sparas i --maildir om den anges, och takten (mejl/s) rapporteras var --report-s sekund.
+        --fail-rate svarar 451 på en andel av meddelandena (testar omförsök) och --max-per-connection
+        stänger anslutningen efter N mejl (testar återuppkoppling).
+
+Mätning: python smtp_sink.py --bench 500 [--agent 24-agent-18.py]
+        Startar sänkan i bakgrunden och skickar N mejl på tre sätt: ny anslutning per mejl, en
+        återanvänd anslutning, och genom agentens riktiga MailOutbox (laddad ur --agent, med spoolen
+        i en temporär katalog). För utkorgen kontrolleras att sänkan tog emot alla N och att alla N
+        spoolfiler fick flaggan ':2,S'; annars avslutas mätningen med felkod.
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import smtplib
+import argparse
+import threading
+import io
+import email
+import tempfile
+import contextlib
+import importlib.util
+from email.header import decode_header, make_header
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+
+# --- SÄNKAN ---
+
+class SinkStats:
+    """Räknare som delas mellan anslutningarna (och mättråden)."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.received = 0
+        self.bytes = 0
+        self.rejected = 0
+        self.connections = 0
+        self.started = time.time()
+
+    def add(self, size: int):
+        with self.lock:
+            self.received += 1
+            self.bytes += size
+
+    def snapshot(self) -> tuple[int, int, int, int]:
+        with self.lock:
+            return self.received, self.bytes, self.rejected, self.connections
+
+def store_in_maildir(maildir: str, data: bytes, counter: int):
+    """Sparar ett mottaget mejl i maildir-form (tmp/ -> new/)."""
+    name = f"{time.time():.6f}.{os.getpid()}_{counter}.smtp-sink"
+    tmp_path = os.path.join(maildir, 'tmp', name)
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.rename(tmp_path, os.path.join(maildir, 'new', name))
+
+async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, args, stats: SinkStats):
+    with stats.lock:
+        stats.connections += 1
+    delivered_here = 0
+
+    async def reply(line: str): # SMTP-svar måste vara ASCII
+        writer.write(line.encode('ascii') + b"\r\n")
+        await writer.drain()
+
+    try:
+        await reply("220 smtp-sink ready")
+        recipients = []
+        while True:
+            raw = await reader.readline()
+            if not raw:
+                break
+            line = raw.decode('ascii', errors='replace').rstrip('\r\n')
+            verb = line.split(' ', 1)[0].upper()
+            if verb == 'EHLO':
+                extensions = ["smtp-sink", "PIPELINING", "8BITMIME", "SIZE 52428800"]
+                if args.auth:
+                    extensions.append("AUTH PLAIN")
+                await reply("\r\n".join(f"250-{ext}" for ext in extensions[:-1]) + f"\r\n250 {extensions[-1]}")
+            elif verb == 'HELO':
+                await reply("250 smtp-sink")
+            elif verb == 'AUTH':
+                await reply("235 2.7.0 Authentication accepted")
+            elif verb == 'MAIL':
+                recipients = []
+                await reply("250 2.1.0 OK")
+            elif verb == 'RCPT':
+                recipients.append(line[8:].strip())
+                await reply("250 2.1.5 OK")
+            elif verb == 'DATA':
+                await reply("354 End data with <CR><LF>.<CR><LF>")
+                chunks = []
+                while True:
+                    data_line = await reader.readline()
+                    if not data_line or data_line in (b".\r\n", b".\n"):
+                        break
+                    if data_line.startswith(b".."):
+                        data_line = data_line[1:] # Ta bort punkt-stuffing
+                    chunks.append(data_line)
+                message = b"".join(chunks)
+                if args.fail_rate and random.random() < args.fail_rate:
+                    with stats.lock:
+                        stats.rejected += 1
+                    await reply("451 4.3.0 Temporary failure (simulated)")
+                    continue
+                stats.add(len(message))
+                delivered_here += 1
+                if args.maildir:
+                    store_in_maildir(args.maildir, message, stats.received)
+                if not args.quiet:
+                    parsed = email.message_from_bytes(message)
+                    subject = str(make_header(decode_header(parsed.get('Subject', '(inget ämne)'))))
+                    print(f"📨 #{stats.received} till {', '.join(recipients) or '?'}: {subject}")
+                await reply(f"250 2.0.0 OK queued as {stats.received}")
+                if args.max_per_connection and delivered_here >= args.max_per_connection:
+                    break # Simulerar en server som kopplar ner klienten
+            elif verb in ('RSET', 'NOOP'):
+                await reply("250 OK")
+            elif verb == 'QUIT':
+                await reply("221 Bye")
+                break
+            else:
+                await reply("502 5.5.2 Command not implemented")
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+async def report_loop(args, stats: SinkStats):
+    last_count, last_time = 0, time.time()
+    while True:
+        await asyncio.sleep(args.report_s)
+        count, size, rejected, connections = stats.snapshot()
+        now = time.time()
+        if count != last_count:
+            rate = (count - last_count) / (now - last_time)
+            print(f"📊 {count} mejl mottagna ({size / 1024:.0f} KB, {rejected} avvisade, {connections} anslutningar) – {rate:.1f} mejl/s senaste perioden")
+        last_count, last_time = count, now
+
+async def serve(args, stats: SinkStats, ready: threading.Event | None = None, port_holder: list | None = None):
+    server = await asyncio.start_server(lambda r, w: handle_client(r, w, args, stats), args.host, args.port)
+    if port_holder is not None:
+        port_holder.append(server.sockets[0].getsockname()[1])
+    if ready is not None:
+        ready.set()
+    else:
+        print(f"📮 SMTP-sänka lyssnar på {args.host}:{server.sockets[0].getsockname()[1]}"
+              + (f", sparar i {args.maildir}" if args.maildir else "") + ". Avsluta med Ctrl+C.")
+        asyncio.get_running_loop().create_task(report_loop(args, stats))
+    async with server:
+        await server.serve_forever()
+
+# --- MÄTNING ---
+
+def build_bench_message(i: int) -> MIMEMultipart:
+    """Ett mejl i samma storleksordning som agentens dagliga rapport (~4 KB HTML)."""
+    msg = MIMEMultipart()
+    msg['From'] = "agent@localhost"; msg['To'] = "mottagare@localhost"; msg['Subject'] = f"📊 Testrapport {i}"
+    rows = "".join(f"<li>Rad {n}: {random.random():.6f}</li>" for n in range(120))
+    msg.attach(MIMEText(f"<html><body><h2>Testrapport {i}</h2><ul>{rows}</ul></body></html>", 'html'))
+    return msg
+
+def load_outbox_class(agent_file: str):
+    """Laddar MailOutbox ur en agentfil (t.ex. 24-agent-18.py) bredvid den här filen."""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), agent_file)
+    spec = importlib.util.spec_from_file_location("bench_agent", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.MailOutbox
+
+def bench(args) -> bool:
+    MailOutbox = load_outbox_class(args.agent)
+    stats = SinkStats()
+    ready, port_holder = threading.Event(), []
+    args.port, args.quiet = 0, True # Ledig port, ingen utskrift per mejl
+    threading.Thread(target=lambda: asyncio.run(serve(args, stats, ready, port_holder)), daemon=True).start()
+    ready.wait()
+    port = port_holder[0]
+    messages = [build_bench_message(i) for i in range(args.bench)]
+
+    def per_message():
+        for msg in messages:
+            with smtplib.SMTP(args.host, port, timeout=30) as server:
+                server.ehlo()
+                server.sendmail(msg['From'], msg['To'], msg.as_bytes())
+
+    def reused():
+        with smtplib.SMTP(args.host, port, timeout=30) as server:
+            server.ehlo()
+            for msg in messages:
+                server.sendmail(msg['From'], msg['To'], msg.as_bytes())
+
+    outbox_result = {}
+
+    def outbox():
+        # Agentens egen utkorg: send() spoolar (fsync + rename), bakgrundstråden levererar och flaggar
+        with tempfile.TemporaryDirectory() as spool:
+            box = MailOutbox(host=args.host, port=port, user='', password='', spool_dir=spool)
+            with contextlib.redirect_stdout(io.StringIO()): # Utkorgen skriver en rad per levererat mejl
+                for msg in messages:
+                    box.send(msg, "", "testmejl")
+                outbox_result['flushed'] = box.flush(timeout_s=300)
+            outbox_result['flagged'] = sum(1 for name in os.listdir(os.path.join(spool, 'cur'))
+                                           if name.endswith(MailOutbox.DELIVERED_FLAG))
+
+    print(f"⏱️ Skickar {args.bench} mejl per variant till en lokal sänka på port {port}...")
+    for label, func in (("Ny anslutning per mejl", per_message), ("Återanvänd anslutning", reused),
+                        (f"MailOutbox ur {args.agent}", outbox)):
+        before = stats.snapshot()[0]
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        received = stats.snapshot()[0] - before
+        print(f"   {label:<40} {elapsed:7.3f} s  {args.bench / elapsed:8.1f} mejl/s  ({received}/{args.bench} mottagna)")
+
+    ok = outbox_result.get('flushed') and received == args.bench and outbox_result.get('flagged') == args.bench
+    print(f"{'✅' if ok else '❌'} MailOutbox: {received}/{args.bench} mottagna, "
+          f"{outbox_result.get('flagged', 0)}/{args.bench} spoolfiler markerade som levererade (':2,S').")
+    return bool(ok)
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Lokal SMTP-sänka och e-postmätning för agenterna.")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8025)
+    ap.add_argument("--maildir", help="Spara mottagna mejl i denna maildir (tmp/new/cur skapas)")
+    ap.add_argument("--fail-rate", type=float, default=0.0, help="Andel meddelanden som får 451 (0-1)")
+    ap.add_argument("--max-per-connection", type=int, default=0, help="Stäng anslutningen efter N mejl")
+    ap.add_argument("--auth", action="store_true", help="Annonsera AUTH PLAIN (alla uppgifter godtas)")
+    ap.add_argument("--report-s", type=float, default=10.0, help="Sekunder mellan takt-rapporterna")
+    ap.add_argument("--quiet", action="store_true", help="Skriv inte ut varje mottaget mejl")
+    ap.add_argument("--bench", type=int, default=0, help="Mätläge: skicka N mejl per variant och skriv ut takten")
+    ap.add_argument("--agent", default="24-agent-18.py", help="Agentfil vars MailOutbox mäts (24-agent-18.py eller buffalo-ai-21.py)")
+    args = ap.parse_args()
+
+    if args.maildir:
+        for sub in ('tmp', 'new', 'cur'):
+            os.makedirs(os.path.join(args.maildir, sub), exist_ok=True)
+    if args.bench:
+        sys.exit(0 if bench(args) else 1)
+    stats = SinkStats()
+    try:
+        asyncio.run(serve(args, stats))
+    except KeyboardInterrupt:
+        count, size, rejected, connections = stats.snapshot()
+        elapsed = time.time() - stats.started
+        print(f"\n--- SMTP-sänkan stängs: {count} mejl ({size / 1024:.0f} KB), {rejected} avvisade, {connections} anslutningar på {elapsed:.0f} s. ---")
@@ -3,6 +3,9 @@ import platform
 import ollama
 import json
 import re
+import sys
+import time
+import html.parser
 import requests 
 from bs4 import BeautifulSoup 
 from dotenv import load_dotenv
@@ -56,6 +59,173 @@ def update_agent_state(new_wallet_balance: float | None = None):
     except Exception as e:
         print(f"❌ FEL vid sparning till .env: {e}")
 
+# --- PRISEXTRAKTION (STRUKTURERAD DATA FÖRST, SEDAN RIKTAD SÖKNING I RÅA BYTES) ---
+# En extraktor tar sidans råa bytes och returnerar (pris, beskrivning) eller None. extract_price provar
+# dem i ordning; BeautifulSoup-trädet och get_text() över hela sidan behövs inte längre.
+JSON_LD_RE = re.compile(rb'<script[^>]*type=["\']application/ld\+json["\'][^>]*>(.*?)</script>', re.S | re.I)
+EMBEDDED_JSON_RE = re.compile(rb'<script[^>]*id=["\']__NEXT_DATA__["\'][^>]*>(.*?)</script>', re.S | re.I)
+EMBEDDED_PRICE_KEYS = ('price', 'priceInclVat', 'currentPrice')
+PRICE_GAP = rb'(?:\s|&nbsp;|&#160;|\xc2\xa0|<[^<>]{0,120}>){0,8}' # Blanksteg och några taggar mellan belopp och "kr"
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+def _to_price(value) -> float | None:
+    try:
+        price = float(str(value).replace(',', '.').replace(':', '.'))
+    except (TypeError, ValueError):
+        return None
+    return price if price > 0 else None
+
+def _find_offer_price(node):
+    """Letar rekursivt efter offers.price (eller lowPrice) i ett JSON-LD-objekt."""
+    if isinstance(node, list):
+        for item in node:
+            price = _find_offer_price(item)
+            if price is not None:
+                return price
+    elif isinstance(node, dict):
+        if node.get('@type') in ('Offer', 'AggregateOffer'):
+            price = _to_price(node.get('price', node.get('lowPrice')))
+            if price is not None:
+                return price
+        for key in ('offers', '@graph', 'mainEntity'):
+            if key in node:
+                price = _find_offer_price(node[key])
+                if price is not None:
+                    return price
+    return None
+
+def extract_json_ld_price(html: bytes):
+    for match in JSON_LD_RE.finditer(html):
+        try:
+            data = json.loads(match.group(1))
+        except ValueError:
+            continue
+        price = _find_offer_price(data)
+        if price is not None:
+            return price, f"Pris hittat i sidans JSON-LD (schema.org Offer): {price:.2f} kr"
+    return None
+
+def _find_embedded_price(node, depth: int = 0):
+    """Första pris-nyckeln i inbäddad sid-JSON, bredden först så att produktens egna fält vinner över listor längre ner."""
+    level = [node]
+    while level and depth < 8:
+        next_level = []
+        for item in level:
+            values = item.values() if isinstance(item, dict) else item if isinstance(item, list) else ()
+            if isinstance(item, dict):
+                for key in EMBEDDED_PRICE_KEYS:
+                    if key in item and not isinstance(item[key], (dict, list)):
+                        price = _to_price(item[key])
+                        if price is not None:
+                            return price
+            next_level.extend(v for v in values if isinstance(v, (dict, list)))
+        level, depth = next_level, depth + 1
+    return None
+
+def extract_embedded_json_price(html: bytes):
+    match = EMBEDDED_JSON_RE.search(html)
+    if not match:
+        return None
+    try:
+        price = _find_embedded_price(json.loads(match.group(1)))
+    except ValueError:
+        return None
+    if price is not None:
+        return price, f"Pris hittat i sidans inbäddade produkt-JSON: {price:.2f} kr"
+    return None
+
+def raw_price_extractor(amount_pattern: bytes):
+    """Riktad regex direkt på bytes: belopp följt av 'kr', med blanksteg/taggar emellan, utanför <script>/<style>."""
+    price_re = re.compile(rb'>[^<]*?(' + amount_pattern + rb')' + PRICE_GAP + rb'k[rR]\b')
+    skip_re = re.compile(rb'<(script|style)\b.*?</\1>', re.S | re.I)
+    def extract(html: bytes):
+        position = 0
+        for skip in skip_re.finditer(html): # Sök bara i de delar som är synlig text
+            match = price_re.search(html, position, skip.start())
+            if match:
+                break
+            position = skip.end()
+        else:
+            match = price_re.search(html, position)
+        if match:
+            price = _to_price(match.group(1).decode('ascii'))
+            if price is not None:
+                return price, f"Pris hittat via riktad sökning i sidans HTML: {match.group(1).decode('ascii')} kr"
+        return None
+    return extract
+
+class _TextPriceScanner(html.parser.HTMLParser):
+    """Strömmande tokenizer: samlar synlig text (som get_text) och slutar vid första träffen."""
+    def __init__(self, pattern, separator: str):
+        super().__init__(convert_charrefs=True)
+        self.pattern, self.separator = pattern, separator
+        self.parts, self.skip_depth, self.match = [], 0, None
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ('script', 'style'):
+            self.skip_depth += 1
+
+    def handle_endtag(self, tag):
+        if tag in ('script', 'style') and self.skip_depth:
+            self.skip_depth -= 1
+
+    def handle_data(self, data):
+        if self.match or self.skip_depth or not data.strip():
+            return
+        self.parts.append(data.strip() if self.separator else data)
+        window = self.separator.join(self.parts[-6:]) # Ett pris kan vara uppdelat på några textnoder
+        self.match = self.pattern.search(window)
+
+def streamed_text_extractor(pattern: str, separator: str = ' ', chunk_size: int = 65536):
+    text_re = re.compile(pattern)
+    def extract(html: bytes):
+        scanner = _TextPriceScanner(text_re, separator)
+        text = html.decode('utf-8', errors='replace')
+        for start in range(0, len(text), chunk_size):
+            scanner.feed(text[start:start + chunk_size])
+            if scanner.match:
+                price = _to_price(scanner.match.group(1))
+                if price is not None:
+                    return price, f"Pris hittat via textsökning: {scanner.match.group(0)}"
+        return None
+    return extract
+
+def extract_price(html: bytes, extractors) -> tuple[float | None, str]:
+    """Provar extraktorerna i ordning och returnerar den första träffen."""
+    for extractor in extractors:
+        try:
+            result = extractor(html)
+        except Exception as e:
+            print(f"⚠️ Prisextraktorn {getattr(extractor, '__name__', extractor)} misslyckades: {e}")
+            continue
+        if result is not None:
+            return result
+    return None, "Kunde inte hitta något pris på sidan."
+
+CPU_PRICE_EXTRACTORS = [
+    extract_json_ld_price,
+    extract_embedded_json_price,
+    raw_price_extractor(rb'\d{3,9}'),
+    streamed_text_extractor(r'(\d{3,9})\s*kr', separator=''),
+]
+
+def benchmark_price_extraction(rounds: int = 20):
+    """Jämför tolkningstiden för fixture-sidan: BeautifulSoup + get_text() mot extraktorkedjan."""
+    with open(os.path.join(FIXTURE_DIR, 'prisjakt_cpu_search.html'), 'rb') as f:
+        page = f.read()
+    start = time.perf_counter()
+    for _ in range(rounds):
+        old_match = re.search(r'(\d{3,9})\s*kr', BeautifulSoup(page, 'html.parser').get_text())
+    old_ms = (time.perf_counter() - start) / rounds * 1000
+    start = time.perf_counter()
+    for _ in range(rounds):
+        price, description = extract_price(page, CPU_PRICE_EXTRACTORS)
+    new_ms = (time.perf_counter() - start) / rounds * 1000
+    old_price = float(old_match.group(1)) if old_match else None
+    print(f"⏱️ prisjakt_cpu_search.html ({len(page) / 1024:.0f} KB, {rounds} varv): BeautifulSoup {old_ms:.2f} ms, "
+          f"extraktor {new_ms:.2f} ms ({old_ms / new_ms:.0f}x). Pris {price} kr {'✅' if old_price == price else f'⚠️ (gammalt {old_price})'}")
+    print(f"   -> {description}")
+
 # --- WEB SCRAPING FUNKTIONER ---
 
 def get_cpu_price(cpu_model: str) -> tuple[float | None, str]:
@@ -76,14 +246,11 @@ def get_cpu_price(cpu_model: str) -> tuple[float | None, str]:
         # på grund av brist på riktig headless-browser, men vi simulerar anropet.
         response = requests.get(URL, headers=headers, timeout=10)
         response.raise_for_status() 
-        soup = BeautifulSoup(response.content, 'html.parser')
-        
-        # Simulerad parsning av pris (söker efter ett SEK-pris)
-        price_match = re.search(r'(\d{3,9})\s*kr', soup.get_text())
+        # Strukturerad data först, sedan riktad sökning i sidans bytes (inget helt BeautifulSoup-träd)
+        price, description = extract_price(response.content, CPU_PRICE_EXTRACTORS)
         
-        if price_match:
-            price = float(price_match.group(1).replace('.', '').replace(',', ''))
-            return price, f"Pris hittat: {price} kr via simulerad sökning."
+        if price is not None:
+            return price, f"{description} (simulerad sökning)"
         
         # Fallback: Använd LLM för en *uppskattning* om scraping misslyckas.
         return get_llm_price_estimate(cpu_model), "Pris kunde inte hittas via scraping, använder LLM-uppskattning."
@@ -217,6 +384,10 @@ def analyze_and_upgrade_hardware_v2():
 
 
 if __name__ == "__main__":
+    if '--bench-extract' in sys.argv:
+        # Mätläge: python system-agent.py --bench-extract
+        benchmark_price_extraction()
+        sys.exit(0)
     # Sätt initialt saldo om det inte finns i .env
     if os.environ.get("AGENT_WALLET_BALANCE") is None:
         update_agent_state(INITIAL_BUDGET) 
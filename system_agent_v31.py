@@ -1,10 +1,17 @@
 import os
+import sys
 import platform
 import ollama
 import json
 import re
 import sqlite3
 import time
+import threading
+import collections
+import math
+import contextlib
+import concurrent.futures
+import queue
 from dotenv import load_dotenv
 from datetime import datetime
 import requests 
@@ -15,8 +22,10 @@ load_dotenv()
 
 # --- INSTÄLLNINGAR ---
 OLLAMA_MODEL = os.environ.get("OLLAMA_MODEL", "gpt-oss:120b-cloud") 
+OLLAMA_FAST_MODEL = os.environ.get("OLLAMA_FAST_MODEL", "llama3.2:3b") # Liten modell för enkla klassificeringar
 OLLAMA_HOST = 'http://localhost:11434' 
 DB_NAME = 'system_agent.db'
+DB_SYNCHRONOUS = os.environ.get("DB_SYNCHRONOUS", "NORMAL").upper() # OFF/NORMAL/FULL/EXTRA; NORMAL räcker i WAL-läge
 
 # Standardbudget och Laptop-budget
 DESKTOP_BUDGET = 10000.0
@@ -34,18 +43,223 @@ DESKTOP_COMPONENT_TYPES = ["CPU", "GPU", "RAM", "SSD", "Motherboard"]
 # Komponenttyper för Laptop-läge
 LAPTOP_COMPONENT_TYPES = ["Laptop"] 
 
+# --- LLM-ROUTNING PER UPPGIFT ---
+# Varje anropsplats har en egen rutt: modeller i fallback-ordning och en latensbudget (sekunder).
+# Budgeten används som timeout per modell; vid fel/timeout provas nästa modell i listan.
+# Tredje värdet är en mindre modell som uppgiften degraderas till när latensen blir för hög (None = ingen).
+# Kan överskrivas i .env, t.ex. LLM_ROUTE_COMPONENT_SPECS="llama3.1:8b,gpt-oss:120b-cloud" och LLM_BUDGET_COMPONENT_SPECS=20
+# samt LLM_DEGRADE_<UPPGIFT>="modell" för degraderingsmodellen.
+LLM_ROUTE_DEFAULTS = {
+    'system_type':      ([OLLAMA_FAST_MODEL, OLLAMA_MODEL], 5.0,  None),
+    'laptop_model':     ([OLLAMA_FAST_MODEL, OLLAMA_MODEL], 10.0, None),
+    'component_list':   ([OLLAMA_FAST_MODEL, OLLAMA_MODEL], 20.0, None),
+    'component_specs':  ([OLLAMA_FAST_MODEL, OLLAMA_MODEL], 20.0, None),
+    'component_specs_batch': ([OLLAMA_FAST_MODEL, OLLAMA_MODEL], 45.0, None), # Specs för en hel batch i ett anrop
+    'tradein_value':    ([OLLAMA_FAST_MODEL, OLLAMA_MODEL], 10.0, None),
+    'upgrade_decision': ([OLLAMA_MODEL, OLLAMA_FAST_MODEL], 90.0, OLLAMA_FAST_MODEL),
+}
+
+# --- LATENSSTYRD DEGRADERING ---
+# Rullande latens mäts per modell. Om p95 för en uppgifts primära modell närmar sig budgeten
+# flyttas uppgiften till sin mindre degraderingsmodell; den primära modellen provas sedan med
+# jämna mellanrum och uppgiften flyttas tillbaka när latensen har återhämtat sig.
+LLM_LATENCY_WINDOW_S = 300      # Endast mätningar från de senaste 5 minuterna räknas
+LLM_LATENCY_MAX_SAMPLES = 50    # Max antal mätningar som sparas per modell
+LLM_MIN_SAMPLES = 3             # Minsta antal mätningar innan vi byter modell
+LLM_DEGRADE_AT = 0.8            # Degradera när p95 > 80% av budgeten
+LLM_RECOVER_AT = 0.5            # Återgå när p95 < 50% av budgeten (hysteres)
+LLM_PROBE_INTERVAL_S = 60       # Hur ofta den primära modellen provas under degradering
+LLM_SWITCH_LOG = "llm_model_switches.jsonl"
+
+def _build_llm_routes() -> dict:
+    """Bygger routningstabellen från standardvärden och eventuella överskrivningar i .env."""
+    routes = {}
+    for task, (default_models, default_budget, default_degrade) in LLM_ROUTE_DEFAULTS.items():
+        models_raw = os.environ.get(f"LLM_ROUTE_{task.upper()}")
+        models = [m.strip() for m in models_raw.split(',') if m.strip()] if models_raw else default_models
+        try:
+            budget = float(os.environ.get(f"LLM_BUDGET_{task.upper()}", default_budget))
+        except ValueError:
+            budget = default_budget
+        degrade_to = os.environ.get(f"LLM_DEGRADE_{task.upper()}", default_degrade) or None
+        # Ta bort dubbletter men behåll ordningen (t.ex. om OLLAMA_FAST_MODEL == OLLAMA_MODEL)
+        models = list(dict.fromkeys(models))
+        if degrade_to == models[0]:
+            degrade_to = None
+        routes[task] = {'models': models, 'budget_s': budget, 'degrade_to': degrade_to}
+    return routes
+
+LLM_ROUTES = _build_llm_routes()
+
+# En klient per timeout-värde (ollama.Client tar timeout vid skapandet, inte per anrop)
+_llm_clients = {}
+_llm_state_lock = threading.Lock()
+_llm_latencies = {}     # modell -> deque av (tidpunkt, sekunder)
+_llm_degraded = {}      # uppgift -> {'since': tid, 'last_probe': tid}
+
+def _get_llm_client(timeout_s: float) -> ollama.Client:
+    with _llm_state_lock:
+        client = _llm_clients.get(timeout_s)
+        if client is None:
+            client = ollama.Client(host=OLLAMA_HOST, timeout=timeout_s)
+            _llm_clients[timeout_s] = client
+        return client
+
+def _record_llm_latency(model: str, seconds: float):
+    with _llm_state_lock:
+        samples = _llm_latencies.setdefault(model, collections.deque(maxlen=LLM_LATENCY_MAX_SAMPLES))
+        samples.append((time.time(), seconds))
+
+def get_llm_p95(model: str) -> tuple[float | None, int]:
+    """Returnerar (p95 i sekunder, antal mätningar) för modellen inom det rullande fönstret."""
+    cutoff = time.time() - LLM_LATENCY_WINDOW_S
+    with _llm_state_lock:
+        recent = sorted(s for t, s in _llm_latencies.get(model, ()) if t >= cutoff)
+    if not recent:
+        return None, 0
+    index = max(0, math.ceil(0.95 * len(recent)) - 1)
+    return recent[index], len(recent)
+
+def _log_model_switch(task: str, from_model: str, to_model: str, reason: str, p95: float, budget: float):
+    """Skriver ut och sparar varje modellbyte som en JSON-rad för senare analys."""
+    print(f"    🔀 LLM-rutt '{task}': {from_model} -> {to_model} ({reason}, p95 {p95:.1f}s / budget {budget:.1f}s).")
+    entry = {
+        'time': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'task': task, 'from': from_model, 'to': to_model, 'reason': reason,
+        'p95_s': round(p95, 3), 'budget_s': budget,
+    }
+    try:
+        with open(LLM_SWITCH_LOG, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    except Exception as e:
+        print(f"    ❌ FEL vid loggning av modellbyte: {e}")
+
+def _update_llm_degradation(task: str, route: dict):
+    """Jämför den primära modellens p95 mot budgeten och byter modell vid behov."""
+    degrade_to = route['degrade_to']
+    if not degrade_to:
+        return
+    primary = route['models'][0]
+    p95, count = get_llm_p95(primary)
+    if p95 is None or count < LLM_MIN_SAMPLES:
+        return
+    budget = route['budget_s']
+    switched = None
+    with _llm_state_lock:
+        if task not in _llm_degraded and p95 > budget * LLM_DEGRADE_AT:
+            _llm_degraded[task] = {'since': time.time(), 'last_probe': time.time()}
+            switched = (primary, degrade_to, "p95 över budget")
+        elif task in _llm_degraded and p95 < budget * LLM_RECOVER_AT:
+            del _llm_degraded[task]
+            switched = (degrade_to, primary, "latensen har återhämtat sig")
+    if switched:
+        _log_model_switch(task, switched[0], switched[1], switched[2], p95, budget)
+
+def llm_chat(task: str, messages: list) -> dict:
+    """
+    Skickar ett chat-anrop enligt routningstabellen för given uppgift.
+    Provar modellerna i fallback-ordning med uppgiftens latensbudget som timeout.
+    Om uppgiften är degraderad går anropet till degraderingsmodellen först, utom när det
+    är dags att prova den primära modellen igen.
+    Kastar det sista felet om ingen modell svarade (anroparna har redan egen felhantering).
+    """
+    route = LLM_ROUTES.get(task, {'models': [OLLAMA_MODEL], 'budget_s': 90.0, 'degrade_to': None})
+    models = route['models']
+    with _llm_state_lock:
+        state = _llm_degraded.get(task)
+        if state:
+            if time.time() - state['last_probe'] >= LLM_PROBE_INTERVAL_S:
+                state['last_probe'] = time.time()
+            else:
+                models = [route['degrade_to']] + [m for m in models if m != route['degrade_to']]
+    client = _get_llm_client(route['budget_s'])
+    last_error = None
+    for model in models:
+        start = time.monotonic()
+        try:
+            response = client.chat(model=model, messages=messages)
+            _record_llm_latency(model, time.monotonic() - start)
+            _update_llm_degradation(task, route)
+            return response
+        except Exception as e:
+            # Ett misslyckat anrop räknas som att hela budgeten förbrukades
+            _record_llm_latency(model, max(time.monotonic() - start, route['budget_s']))
+            _update_llm_degradation(task, route)
+            last_error = e
+            print(f"    ⚠️ LLM-rutt '{task}': {model} misslyckades ({e}). Provar nästa modell...")
+    raise last_error if last_error else RuntimeError(f"Ingen modell konfigurerad för uppgiften '{task}'.")
+
 
 # --- DATABAS HANTERING (V30) ---
 class AgentDB:
-    """Klass för att hantera Agentens SQLite-databas."""
-    def __init__(self, db_name=DB_NAME):
-        self.conn = sqlite3.connect(db_name)
+    """
+    Klass för att hantera Agentens SQLite-databas. Databasen körs i WAL-läge med synkroniseringsnivån
+    DB_SYNCHRONOUS, och skrivningar görs i explicita transaktioner (transaction()) i stället för en commit
+    per anrop. Ett enskilt anrop utanför en transaktion blir sin egen lilla transaktion; inom
+    `with db.transaction():` committas allt på en gång (eller rullas tillbaka vid fel).
+
+    Komponentkatalogen (hardware_details) speglas i minnet: namn -> tolkade detaljer plus namnmängder
+    och ett namnindex (ComponentNameIndex) per typ. Uppslag besvaras ur spegeln; skrivningar går till
+    SQLite och förs in i spegeln först när transaktionen committats, så att databasen förblir sanningen
+    (reload_catalog() läser om den).
+    """
+    SYNCHRONOUS_LEVELS = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+    def __init__(self, db_name=DB_NAME, synchronous: str = DB_SYNCHRONOUS):
+        # isolation_level=None: sqlite3-modulen öppnar inga egna transaktioner, det gör transaction()
+        self.conn = sqlite3.connect(db_name, isolation_level=None)
         self.cursor = self.conn.cursor()
+        self.lock = threading.RLock()
+        self._tx_depth = 0
+        self._catalog = {}                                  # component_name -> detaljer (som get_component_details_by_name)
+        self._catalog_by_type = collections.defaultdict(set) # component_type -> namn
+        self._name_indexes = {}                             # component_type -> ComponentNameIndex (för find_component)
+        self._catalog_writes = []                           # Detaljer skrivna i pågående transaktion
+        if synchronous not in self.SYNCHRONOUS_LEVELS:
+            print(f"⚠️ Okänd DB_SYNCHRONOUS '{synchronous}', använder NORMAL.")
+            synchronous = 'NORMAL'
+        journal_mode = self.conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+        self.conn.execute(f"PRAGMA synchronous={synchronous}")
+        self.synchronous = synchronous
+        if journal_mode.lower() != 'wal':
+            print(f"⚠️ Databasen kunde inte växla till WAL (journal_mode={journal_mode}).")
         self._initialize_db()
 
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Transaktionsomfång: BEGIN IMMEDIATE vid yttersta nivån, COMMIT när blocket avslutas och ROLLBACK
+        vid undantag. Nästlade anrop ingår i den yttre transaktionen.
+        """
+        with self.lock:
+            if self._tx_depth == 0:
+                self.conn.execute("BEGIN IMMEDIATE")
+            self._tx_depth += 1
+            try:
+                yield self.cursor
+            except BaseException:
+                self._tx_depth -= 1
+                if self._tx_depth == 0:
+                    self.conn.execute("ROLLBACK")
+                    self._catalog_writes.clear()
+                raise
+            self._tx_depth -= 1
+            if self._tx_depth == 0:
+                self.conn.execute("COMMIT")
+                for details in self._catalog_writes:
+                    self._mirror_component(details)
+                self._catalog_writes.clear()
+
     def _initialize_db(self):
         """Skapar tabeller och Tvingar fram ÅTERSTÄLLNING av saldo till INITIAL_BALANCE_RESET."""
+        with self.transaction():
+            self._create_tables()
+        self.reload_catalog()
         
+        print(f"✅ Databas ansluten/skapad (WAL, synchronous={self.synchronous}). "
+              f"Plånbokssaldo ÅTERSTÄLLT till {INITIAL_BALANCE_RESET:.2f} kr (Desktop Default).")
+
+    def _create_tables(self):
         # Tabell 1: purchases
         self.cursor.execute("""
             CREATE TABLE IF NOT EXISTS purchases (
@@ -87,19 +301,21 @@ class AgentDB:
             )
         """)
         
+        # Index för typ/pris-frågor och för datumordnad historik (sammanställningen sker i SQL)
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_hardware_type_price ON hardware_details(component_type, price_sek)")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_purchases_date ON purchases(purchase_date)")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_sales_date ON sales(sale_date)")
+        
         # --- ROBUST ÅTERSTÄLLNINGSLOGIK FÖR PLÅNBOK ---
         self.cursor.execute("DELETE FROM status WHERE key = 'wallet_balance'")
         self.cursor.execute(
             "INSERT INTO status (key, value) VALUES (?, ?)", 
             ('wallet_balance', str(INITIAL_BALANCE_RESET))
         )
-        self.conn.commit()
-        
-        print(f"✅ Databas ansluten/skapad. Plånbokssaldo ÅTERSTÄLLT till {INITIAL_BALANCE_RESET:.2f} kr (Desktop Default).")
 
     def set_balance(self, new_balance: float):
-        self.cursor.execute("UPDATE status SET value = ? WHERE key = 'wallet_balance'", (str(new_balance),))
-        self.conn.commit()
+        with self.transaction():
+            self.cursor.execute("UPDATE status SET value = ? WHERE key = 'wallet_balance'", (str(new_balance),))
         print(f"💰 Plånbokssaldo uppdaterat till: {new_balance:,.2f} kr.")
         
     def get_balance(self) -> float:
@@ -108,24 +324,24 @@ class AgentDB:
         return float(result[0]) if result else 0.0
 
     def update_balance(self, new_balance: float):
-        self.cursor.execute("UPDATE status SET value = ? WHERE key = 'wallet_balance'", (str(new_balance),))
-        self.conn.commit()
+        with self.transaction():
+            self.cursor.execute("UPDATE status SET value = ? WHERE key = 'wallet_balance'", (str(new_balance),))
 
     def log_purchase(self, item_name: str, item_type: str, cost: float):
         now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        self.cursor.execute(
-            "INSERT INTO purchases (item_name, item_type, cost_sek, purchase_date) VALUES (?, ?, ?, ?)",
-            (item_name, item_type, cost, now)
-        )
-        self.conn.commit()
+        with self.transaction():
+            self.cursor.execute(
+                "INSERT INTO purchases (item_name, item_type, cost_sek, purchase_date) VALUES (?, ?, ?, ?)",
+                (item_name, item_type, cost, now)
+            )
         
     def log_sale(self, item_name: str, item_type: str, sale_price: float): 
         now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        self.cursor.execute(
-            "INSERT INTO sales (item_name, item_type, sale_price_sek, sale_date) VALUES (?, ?, ?, ?)",
-            (item_name, item_type, sale_price, now)
-        )
-        self.conn.commit()
+        with self.transaction():
+            self.cursor.execute(
+                "INSERT INTO sales (item_name, item_type, sale_price_sek, sale_date) VALUES (?, ?, ?, ?)",
+                (item_name, item_type, sale_price, now)
+            )
         
     def get_current_component_name(self, component_type: str) -> str | None:
         """Hämtar namnet på den nuvarande installerade komponenten av en given typ."""
@@ -137,52 +353,105 @@ class AgentDB:
     def set_current_component_name(self, component_type: str, component_name: str):
         """Sparar namnet på den nya installerade komponenten."""
         key = f"current_{component_type.lower()}"
-        self.cursor.execute("INSERT OR REPLACE INTO status (key, value) VALUES (?, ?)", (key, component_name))
-        self.conn.commit()
+        with self.transaction():
+            self.cursor.execute("INSERT OR REPLACE INTO status (key, value) VALUES (?, ?)", (key, component_name))
         
+    def reload_catalog(self):
+        """Läser om hela hardware_details till minnesspegeln (en tabellgenomläsning)."""
+        with self.lock:
+            self._catalog.clear()
+            self._catalog_by_type.clear()
+            self._name_indexes.clear()
+            rows = self.conn.execute("SELECT component_name, component_type, price_sek, details_json FROM hardware_details")
+            for name, component_type, price, details_json in rows:
+                details = json.loads(details_json) if details_json else {}
+                details['component_name'] = name
+                details['component_type'] = component_type
+                details['price_sek'] = price
+                self._mirror_component(details)
+
+    def _mirror_component(self, details: dict):
+        previous = self._catalog.get(details['component_name'])
+        if previous is not None:
+            self._catalog_by_type[previous['component_type']].discard(details['component_name'])
+            self._name_indexes[previous['component_type']].discard(details['component_name'])
+        self._catalog[details['component_name']] = details
+        self._catalog_by_type[details['component_type']].add(details['component_name'])
+        if details['component_type'] not in self._name_indexes:
+            self._name_indexes[details['component_type']] = ComponentNameIndex(component_type=details['component_type'])
+        self._name_indexes[details['component_type']].add(details['component_name'])
+
     def get_component_details_by_name(self, component_name: str) -> dict | None: 
-        """Hämtar alla lagrade detaljer för en komponent för att simulera dess specifikationer."""
-        self.cursor.execute(
-            "SELECT component_name, component_type, price_sek, details_json FROM hardware_details WHERE component_name = ?", 
-            (component_name,)
-        )
-        row = self.cursor.fetchone()
-        if row:
-            details = json.loads(row[3]) if row[3] else {}
-            details['component_name'] = row[0]
-            details['component_type'] = row[1]
-            details['price_sek'] = row[2]
-            return details
-        return None
+        """Hämtar alla lagrade detaljer för en komponent för att simulera dess specifikationer (ur minnesspegeln)."""
+        with self.lock:
+            details = self._catalog.get(component_name)
+            return dict(details) if details is not None else None # Kopia, så att anroparen inte ändrar spegeln
+
+    @staticmethod
+    def _hardware_row(details: dict, now: str) -> tuple:
+        specific_details = {k: v for k, v in details.items() if k not in ['component_name', 'component_type', 'price_sek']}
+        return (details['component_name'], details['component_type'], details['price_sek'], now, json.dumps(specific_details))
 
     def log_hardware_details(self, details: dict):
         """Sparar hårdvarudetaljer, använder INSERT OR REPLACE för att undvika dubbletter."""
+        self.log_hardware_details_many([details])
+
+    def log_hardware_details_many(self, details_list: list[dict]):
+        """Sparar flera komponenter med executemany i en enda transaktion (en commit för hela batchen)."""
         now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        
-        component_name = details['component_name']
-        component_type = details['component_type']
-        price_sek = details['price_sek']
-        
-        specific_details = {k: v for k, v in details.items() if k not in ['component_name', 'component_type', 'price_sek']}
-        details_json = json.dumps(specific_details)
-        
-        self.cursor.execute(
-            """INSERT OR REPLACE INTO hardware_details 
-            (component_name, component_type, price_sek, date_fetched, details_json) 
-            VALUES (?, ?, ?, ?, ?)""",
-            (component_name, component_type, price_sek, now, details_json)
-        )
-        self.conn.commit()
+        rows = [self._hardware_row(details, now) for details in details_list]
+        with self.transaction():
+            self.cursor.executemany(
+                """INSERT OR REPLACE INTO hardware_details 
+                (component_name, component_type, price_sek, date_fetched, details_json) 
+                VALUES (?, ?, ?, ?, ?)""",
+                rows
+            )
+            # Speglas som de lagrades (details_json tolkas om) när transaktionen committas
+            for name, component_type, price, _, details_json in rows:
+                mirrored = json.loads(details_json)
+                mirrored.update(component_name=name, component_type=component_type, price_sek=float(price))
+                self._catalog_writes.append(mirrored)
         
     def check_if_component_exists(self, component_name: str) -> bool:
         """Kontrollerar om en komponent redan finns i hårdvarudetaljtabellen."""
-        self.cursor.execute("SELECT 1 FROM hardware_details WHERE component_name = ?", (component_name,))
-        return self.cursor.fetchone() is not None
+        with self.lock:
+            return component_name in self._catalog
     
     def get_all_component_names(self) -> set[str]:
         """Hämtar alla komponentnamn från hardware_details som en uppsättning."""
-        self.cursor.execute("SELECT component_name FROM hardware_details")
-        return {row[0] for row in self.cursor.fetchall()}
+        with self.lock:
+            return set(self._catalog)
+
+    def get_component_names_by_type(self, component_type: str) -> set[str]:
+        with self.lock:
+            return set(self._catalog_by_type.get(component_type, ()))
+
+    def find_component(self, component_name: str, component_type: str) -> str | None:
+        """Katalogens namn för samma (eller en nästan likadan) modell av typen, eller None om den är ny."""
+        with self.lock:
+            index = self._name_indexes.get(component_type)
+            return index.find(component_name) if index is not None else None
+
+    def get_transaction_totals(self) -> dict:
+        """Summor och antal för köp och försäljningar, beräknade i SQL i stället för rad för rad i Python."""
+        total_spent, purchase_count = self.conn.execute("SELECT COALESCE(SUM(cost_sek), 0), COUNT(*) FROM purchases").fetchone()
+        total_earned, sale_count = self.conn.execute("SELECT COALESCE(SUM(sale_price_sek), 0), COUNT(*) FROM sales").fetchone()
+        return {'total_spent': total_spent, 'purchase_count': purchase_count, 'total_earned': total_earned, 'sale_count': sale_count}
+
+    def get_catalog_stats(self) -> list[tuple]:
+        """(typ, antal, lägsta, snitt, högsta pris) per komponenttyp; besvaras ur indexet på (component_type, price_sek)."""
+        return self.conn.execute(
+            "SELECT component_type, COUNT(*), MIN(price_sek), AVG(price_sek), MAX(price_sek) "
+            "FROM hardware_details GROUP BY component_type ORDER BY component_type"
+        ).fetchall()
+
+    def iter_purchases(self):
+        """Köpen i datumordning via indexet; strömmas från en egen cursor i stället för att läsas in i en lista."""
+        return self.conn.execute("SELECT item_name, item_type, cost_sek, purchase_date FROM purchases ORDER BY purchase_date ASC")
+
+    def iter_sales(self):
+        return self.conn.execute("SELECT item_name, item_type, sale_price_sek, sale_date FROM sales ORDER BY sale_date ASC")
 
     def close(self):
         self.conn.close()
@@ -248,9 +517,7 @@ def fetch_cpu_details_from_rapidapi(component_name: str) -> dict | None:
     # ... (Använder externt API om nycklar finns, annars None) ...
     return None # Simulerat API anrop - returnerar None i denna version
 
-def fetch_component_specs_from_llm(client: ollama.Client, component_name: str, component_type: str) -> dict | None: 
-    """Hämtar alla detaljer (inklusive pris) och typ från LLM."""
-    
+def _spec_example(component_type: str) -> str:
     if component_type == "CPU":
         spec_example = " (t.ex. \"cores\", \"threads\", \"base_clock_ghz\", \"socket\")"
     elif component_type == "GPU":
@@ -265,6 +532,22 @@ def fetch_component_specs_from_llm(client: ollama.Client, component_name: str, c
         spec_example = " (t.ex. \"CPU_name\", \"GPU_name\", \"RAM_GB\", \"Screen_Size_inches\", \"Weight_kg\")"
     else:
         spec_example = ""
+    return spec_example
+
+def _is_valid_spec(data) -> bool:
+    """Ett spec-objekt duger om det har typ och ett pris som går att tolka som tal."""
+    if not isinstance(data, dict) or 'component_type' not in data or 'price_sek' not in data:
+        return False
+    try:
+        float(data['price_sek'])
+    except (TypeError, ValueError):
+        return False
+    return True
+
+def fetch_component_specs_from_llm(component_name: str, component_type: str) -> dict | None: 
+    """Hämtar alla detaljer (inklusive pris) och typ från LLM."""
+    
+    spec_example = _spec_example(component_type)
 
     system_prompt_details = (
         f"Du är en strikt databas för hårdvaruspecifikationer. För {component_name} ({component_type}), svara ENDAST med ETT JSON-objekt innehållande: "
@@ -275,9 +558,9 @@ def fetch_component_specs_from_llm(client: ollama.Client, component_name: str, c
     print(f"    > Hämtar detaljer från LLM för: {component_name} ({component_type})...")
     
     try:
-        response = client.chat(
-            model=OLLAMA_MODEL,
-            messages=[
+        response = llm_chat(
+            'component_specs',
+            [
                 {'role': 'system', 'content': system_prompt_details},
                 {'role': 'user', 'content': component_name},
             ]
@@ -285,7 +568,7 @@ def fetch_component_specs_from_llm(client: ollama.Client, component_name: str, c
         
         detailed_data = clean_and_parse_json(response['message']['content'])
         
-        if detailed_data and 'price_sek' in detailed_data and 'component_type' in detailed_data:
+        if _is_valid_spec(detailed_data):
             return detailed_data
         else:
             print(f"    ⚠️ Varning: LLM returnerade inte giltiga detaljer (saknar pris/typ) för {component_name}.")
@@ -296,14 +579,61 @@ def fetch_component_specs_from_llm(client: ollama.Client, component_name: str, c
         return None
 
 
-def fetch_component_details(client: ollama.Client, component_name: str, component_type: str) -> dict | None:
-    """Huvudfunktion för datahämtning: LLM för specs, RapidAPI för pris override (oförändrad)."""
+def fetch_component_specs_batch_from_llm(component_names: list[str], component_type: str) -> dict[str, dict | None]:
+    """
+    Hämtar specs för flera modeller av samma typ i ETT LLM-anrop (en JSON-array med ett objekt per modell).
+    Varje element valideras för sig; returnerar {namn: specs eller None} där None betyder att modellen
+    måste hämtas om individuellt.
+    """
+    results = {name: None for name in component_names}
+    system_prompt_details = (
+        f"Du är en strikt databas för hårdvaruspecifikationer. Du får en JSON-lista med {len(component_names)} {component_type}-modeller. "
+        "Svara ENDAST med en JSON-array med ETT objekt per modell, i samma ordning, där varje objekt innehåller: "
+        "\"component_name\" (str - exakt namnet från listan), \"component_type\" (str - exakt typ), \"price_sek\" (int - nuvarande pris utan kommatecken/valuta), "
+        f"och de viktigaste tekniska specifikationerna som nyckel/värde-par{_spec_example(component_type)}. Priserna måste vara heltal."
+    )
     
-    llm_data = fetch_component_specs_from_llm(client, component_name, component_type) 
+    print(f"    > Hämtar detaljer från LLM för {len(component_names)} {component_type} i ett anrop...")
     
-    if not llm_data:
-        return None 
+    try:
+        response = llm_chat(
+            'component_specs_batch',
+            [
+                {'role': 'system', 'content': system_prompt_details},
+                {'role': 'user', 'content': json.dumps(component_names, ensure_ascii=False)},
+            ]
+        )
+        elements = clean_and_parse_json(response['message']['content'])
+    except Exception as e:
+        print(f"    ❌ FEL vid batchhämtning av {component_type}-detaljer: {e}")
+        return results
+
+    # Vissa modeller svarar {"components": [...]} i stället för en ren array
+    if isinstance(elements, dict):
+        elements = next((v for v in elements.values() if isinstance(v, list)), [elements])
+    if not isinstance(elements, list):
+        return results
 
+    # Para ihop svar och efterfrågade namn på namn. Bara element helt utan namn får paras ihop på position
+    # (och bara om antalen stämmer); ett element med ett annat eller redan besvarat namn kastas, och de
+    # platser som inte fick något giltigt element hämtas om individuellt.
+    by_name = {name.strip().lower(): name for name in component_names}
+    positional = len(elements) == len(component_names)
+    for requested, element in zip(component_names if positional else [None] * len(elements), elements):
+        if not isinstance(element, dict):
+            continue
+        element_name = str(element.get('component_name') or '').strip()
+        if element_name:
+            name = by_name.get(element_name.lower())
+        else:
+            name = requested
+            element['component_name'] = requested
+        if name is not None and results[name] is None and _is_valid_spec(element):
+            results[name] = element
+    return results
+
+def _apply_price_override(component_name: str, llm_data: dict) -> dict:
+    """RapidAPI-priset (om något) ersätter LLM:ens pris."""
     final_data = llm_data.copy()
     
     api_data = fetch_cpu_details_from_rapidapi(component_name)
@@ -314,7 +644,42 @@ def fetch_component_details(client: ollama.Client, component_name: str, componen
         
     return final_data
 
-def get_simulated_tradein_value(client: ollama.Client, component_name: str, component_type: str) -> float: 
+def fetch_component_details(component_name: str, component_type: str) -> dict | None:
+    """Huvudfunktion för datahämtning: LLM för specs, RapidAPI för pris override (oförändrad)."""
+    
+    llm_data = fetch_component_specs_from_llm(component_name, component_type) 
+    
+    if not llm_data:
+        return None 
+
+    return _apply_price_override(component_name, llm_data)
+
+def fetch_component_details_batch(component_names: list[str], component_type: str,
+                                  retry_pool: concurrent.futures.Executor) -> dict[str, dict | None]:
+    """
+    Detaljer för en hel batch: ett gemensamt LLM-anrop, och bara de element som saknas eller är ogiltiga
+    hämtas om individuellt (parallellt på retry_pool). Returnerar {namn: detaljer eller None}.
+    """
+    if not component_names:
+        return {}
+    results = {}
+    batch_specs = fetch_component_specs_batch_from_llm(component_names, component_type)
+    retry_names = [name for name, specs in batch_specs.items() if specs is None]
+    for name, specs in batch_specs.items():
+        if specs is not None:
+            results[name] = _apply_price_override(name, specs)
+    if retry_names:
+        print(f"    > {len(component_names) - len(retry_names)}/{len(component_names)} {component_type} klara i batchanropet; hämtar om {len(retry_names)} individuellt.")
+    futures = {retry_pool.submit(fetch_component_details, name, component_type): name for name in retry_names}
+    for future in concurrent.futures.as_completed(futures):
+        try:
+            results[futures[future]] = future.result()
+        except Exception as e:
+            print(f"    ❌ FEL vid hämtning av detaljer för {futures[future]}: {e}")
+            results[futures[future]] = None
+    return results
+
+def get_simulated_tradein_value(component_name: str, component_type: str) -> float: 
     """Hämtar ett simulerat andrahandsvärde för en gammal komponent/laptop via LLM (oförändrad)."""
     # ... (logiken är oförändrad) ...
     
@@ -330,9 +695,9 @@ def get_simulated_tradein_value(client: ollama.Client, component_name: str, comp
     print(f"    > Hämtar simulerat andrahandsvärde för {component_name}...")
 
     try:
-        response = client.chat(
-            model=OLLAMA_MODEL,
-            messages=[
+        response = llm_chat(
+            'tradein_value',
+            [
                 {'role': 'system', 'content': system_prompt_sale},
                 {'role': 'user', 'content': user_prompt_sale},
             ]
@@ -354,7 +719,7 @@ def get_simulated_tradein_value(client: ollama.Client, component_name: str, comp
         
     return 0.0
 
-def detect_system_type(client: ollama.Client, hardware_info: dict) -> str: 
+def detect_system_type(hardware_info: dict) -> str: 
     """Använder LLM för att avgöra om det är Desktop eller Laptop (oförändrad)."""
     system_info_str = "\n".join([f"- {k}: {v}" for k, v in hardware_info.items()])
     
@@ -367,9 +732,9 @@ def detect_system_type(client: ollama.Client, hardware_info: dict) -> str:
     
     print("\n--- Steg 0: Detekterar systemtyp (Laptop/Desktop) via LLM ---")
     try:
-        response = client.chat(
-            model=OLLAMA_MODEL,
-            messages=[
+        response = llm_chat(
+            'system_type',
+            [
                 {'role': 'system', 'content': system_prompt},
                 {'role': 'user', 'content': user_prompt},
             ]
@@ -388,7 +753,7 @@ def detect_system_type(client: ollama.Client, hardware_info: dict) -> str:
     print("⚠️ Återgår till standard: Desktop.")
     return "Desktop"
 
-def fetch_initial_laptop_model(client: ollama.Client, hardware_info: dict) -> str: 
+def fetch_initial_laptop_model(hardware_info: dict) -> str: 
     """Använder LLM för att bestämma det exakta modellnamnet på den bärbara datorn (oförändrad)."""
     
     system_info_str = "\n".join([f"- {k}: {v}" for k, v in hardware_info.items()])
@@ -402,9 +767,9 @@ def fetch_initial_laptop_model(client: ollama.Client, hardware_info: dict) -> st
     
     print("\n--- Steg 0.1: Identifierar exakt Laptop-modell via LLM ---")
     try:
-        response = client.chat(
-            model=OLLAMA_MODEL,
-            messages=[
+        response = llm_chat(
+            'laptop_model',
+            [
                 {'role': 'system', 'content': system_prompt},
                 {'role': 'user', 'content': user_prompt},
             ]
@@ -424,97 +789,292 @@ def fetch_initial_laptop_model(client: ollama.Client, hardware_info: dict) -> st
     return fallback_name
 
 
+# --- KOMPONENTNAMN: NORMALISERING OCH NÄRA-DUBBLETTER ---
+
+NAME_SIMILARITY_THRESHOLD = 0.8 # Trigram-likhet (Jaccard) som räknas som samma modell
+# Tillverkar- och seriebeteckningar som LLM:en tar med ibland och ibland inte ("NVIDIA GeForce RTX 4090" = "RTX 4090")
+NAME_VENDOR_TOKENS = {'nvidia', 'geforce', 'amd', 'radeon', 'intel', 'core', 'the'}
+# Fyllnadsord som inte skiljer modeller åt
+NAME_NOISE_TOKENS = {'graphics', 'card', 'processor', 'cpu', 'gpu', 'desktop', 'boxed', 'box', 'tray', 'edition', 'ssd'}
+# Typer där en namnvariant utan minnesstorlek kan vara samma modell som en med ("RTX 4090" = "RTX 4090 24GB").
+# Storleken behålls alltid i nyckeln; se ComponentNameIndex.find för när den får bortses från.
+NAME_CAPACITY_OPTIONAL_TYPES = {'GPU'}
+_CAPACITY_TOKEN = re.compile(r'\d+(?:gb|tb|mb)')
+
+def canonical_component_key(component_name: str) -> str:
+    """
+    Kanonisk nyckel för ett komponentnamn: gemener, skiljetecken till mellanslag, storlekar och korta
+    modellsuffix skrivs ihop med sitt nummer ("24 GB" -> "24gb", "7900 XTX" -> "7900xtx", "4060 Ti" -> "4060ti"),
+    serieprefix delas från numret ("RTX4090" -> "rtx 4090", men "i5" och "B650" lämnas), och tillverkar-
+    och fyllnadsord tas bort. Suffixen hålls ihop med numret eftersom de skiljer modeller åt (7700 / 7700X).
+    """
+    text = re.sub(r'[®™©()\[\],/_\-]+', ' ', component_name.lower())
+    text = re.sub(r'(?<=[a-z]{2})(?=\d)', ' ', text)
+    text = re.sub(r'(?<=\d) +(?=[a-z]{1,3}\b)', '', text)
+    tokens = [token for token in text.split() if token not in NAME_VENDOR_TOKENS and token not in NAME_NOISE_TOKENS]
+    return ' '.join(tokens) or component_name.strip().lower()
+
+def _split_capacity(key: str) -> tuple[str, tuple[str, ...]]:
+    """(nyckel utan storlekar, storlekarna) – "rtx 4060ti 16gb" -> ("rtx 4060ti", ("16gb",))."""
+    tokens = key.split()
+    return (' '.join(t for t in tokens if not _CAPACITY_TOKEN.fullmatch(t)),
+            tuple(t for t in tokens if _CAPACITY_TOKEN.fullmatch(t)))
+
+def _name_trigrams(key: str) -> set[str]:
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def _model_numbers(key: str) -> tuple[str, ...]:
+    """
+    Token med siffror (modellnummer med suffix, storlekar) och korta varianttoken (högst två bokstäver)
+    måste vara identiska och i samma ordning: "4080" är inte en stavningsvariant av "4090", "7700x" inte
+    av "7700", och "X670E-E" inte av "X670E-F".
+    """
+    return tuple(token for token in key.split() if len(token) <= 2 or any(ch.isdigit() for ch in token))
+
+class ComponentNameIndex:
+    """
+    Index över kända komponentnamn per kanonisk nyckel, med ett trigramindex för nära-dubbletter.
+    find() returnerar det namn som redan representerar modellen (första namnet som lades till
+    för nyckeln), så att varianter slås ihop innan någon spec hämtas.
+    """
+    def __init__(self, names=(), component_type: str | None = None):
+        self.component_type = component_type
+        self.lock = threading.Lock()
+        self.by_key = {}                              # Kanonisk nyckel -> kanoniskt namn
+        self.by_base = collections.defaultdict(set)   # Nyckel utan storlekar -> nycklar (storleksvarianter)
+        self.trigram_keys = collections.defaultdict(set) # Trigram -> nycklar som innehåller det
+        for name in names:
+            self.add(name)
+
+    def __len__(self) -> int:
+        return len(self.by_key)
+
+    def add(self, component_name: str) -> str:
+        """Lägger till namnet (om modellen inte redan finns) och returnerar modellens kanoniska namn."""
+        key = canonical_component_key(component_name)
+        with self.lock:
+            if key not in self.by_key:
+                self.by_key[key] = component_name
+                self.by_base[_split_capacity(key)[0]].add(key)
+                for trigram in _name_trigrams(key):
+                    self.trigram_keys[trigram].add(key)
+            return self.by_key[key]
+
+    def discard(self, component_name: str):
+        key = canonical_component_key(component_name)
+        with self.lock:
+            if self.by_key.get(key) == component_name:
+                del self.by_key[key]
+                self.by_base[_split_capacity(key)[0]].discard(key)
+                for trigram in _name_trigrams(key):
+                    self.trigram_keys[trigram].discard(key)
+
+    def _capacity_variant(self, key: str) -> str | None:
+        """
+        Storleksvariant som är samma modell: bara om den ena sidan saknar storlek och det inte finns någon
+        annan storleksvariant att förväxla med ("RTX 4060 Ti" matchar inte när både 8GB och 16GB finns).
+        """
+        base, capacity = _split_capacity(key)
+        variants = self.by_base.get(base, set()) - {key}
+        if capacity:
+            if base in variants and len(variants) == 1:
+                return base
+        elif len(variants) == 1:
+            return next(iter(variants))
+        return None
+
+    def find(self, component_name: str) -> str | None:
+        """Kanoniskt namn för samma eller en nästan likadan modell, eller None om modellen är ny."""
+        key = canonical_component_key(component_name)
+        with self.lock:
+            if key in self.by_key:
+                return self.by_key[key]
+            if self.component_type in NAME_CAPACITY_OPTIONAL_TYPES:
+                variant = self._capacity_variant(key)
+                if variant is not None:
+                    return self.by_key[variant]
+            trigrams = _name_trigrams(key)
+            shared = collections.Counter()
+            for trigram in trigrams:
+                shared.update(self.trigram_keys.get(trigram, ()))
+            numbers = _model_numbers(key)
+            best, best_score = None, NAME_SIMILARITY_THRESHOLD
+            for candidate, common in shared.items():
+                score = common / (len(trigrams) + len(_name_trigrams(candidate)) - common)
+                if score >= best_score and _model_numbers(candidate) == numbers:
+                    best, best_score = candidate, score
+            return self.by_key[best] if best is not None else None
+
+# (typ, känt namn, föreslaget namn, samma modell?) – körs med --check-names
+NAME_MATCH_CASES = [
+    ('GPU', 'RTX 4090', 'NVIDIA GeForce RTX 4090', True),
+    ('GPU', 'RTX 4090', 'GeForce RTX 4090 24GB', True),
+    ('GPU', 'RTX 4090', 'RTX4090', True),
+    ('GPU', 'Radeon RX 7900 XTX', 'AMD RX 7900XTX', True),
+    ('GPU', 'RTX 4060 Ti 8GB', 'RTX 4060 Ti 16GB', False),
+    ('GPU', 'RTX 4070', 'RTX 4070 Ti', False),
+    ('GPU', 'RTX 4080', 'RTX 4090', False),
+    ('CPU', 'AMD Ryzen 7 7700', 'AMD Ryzen 7 7700X', False),
+    ('CPU', 'Intel Core i5-13600K', 'Intel Core i5-13600', False),
+    ('CPU', 'Intel Core i9-13900K', 'Intel Core i9-13900KF', False),
+    ('CPU', 'Intel Core i9-13900K', 'i9-13900K', True),
+    ('CPU', 'AMD Ryzen 9 7950X', 'AMD Ryzen 9 7950X3D', False),
+    ('RAM', 'Corsair Vengeance 32GB DDR5-6000', 'Corsair Vengence 32GB DDR5-6000', True),
+    ('RAM', 'Corsair Vengeance 32GB DDR5-6000', 'Corsair Vengeance 16GB DDR5-6000', False),
+    ('SSD', 'Samsung 990 Pro 2TB', 'Samsung 990 PRO 1TB', False),
+    ('SSD', 'Samsung 990 Pro 2TB', 'Samsung 990 Pro SSD 2TB', True),
+    ('Motherboard', 'ASUS ROG Strix X670E-E Gaming WiFi', 'ASUS ROG Strix X670E-F Gaming WiFi', False),
+    ('Motherboard', 'ASUS ROG Strix B650E-E Gaming WiFi', 'ASUS ROG Strix B650E-F Gaming WiFi', False),
+    ('Motherboard', 'ASUS ROG Strix X670E-E Gaming WiFi', 'ASUS ROG STRIX X670E-E GAMING WIFI', True),
+    ('Motherboard', 'ASUS ROG Strix X670E-E Gaming WiFi', 'ASUS ROG Strix X670E-E Gamng WiFi', True),
+]
+
+def check_component_name_matching() -> bool:
+    """Kör NAME_MATCH_CASES (och att en storlekslös variant inte matchar när flera storlekar finns)."""
+    ok = True
+    for component_type, known, suggested, expected in NAME_MATCH_CASES:
+        found = ComponentNameIndex([known], component_type).find(suggested)
+        passed = (found == known) == expected
+        ok &= passed
+        print(f"{'✅' if passed else '❌'} [{component_type}] '{suggested}' vs '{known}': {'samma' if found else 'olika'} (väntat {'samma' if expected else 'olika'})")
+    found = ComponentNameIndex(['RTX 4060 Ti 8GB', 'RTX 4060 Ti 16GB'], 'GPU').find('RTX 4060 Ti')
+    ok &= found is None
+    print(f"{'✅' if found is None else '❌'} [GPU] 'RTX 4060 Ti' när både 8GB och 16GB finns: {found or 'ny modell'}")
+    return ok
+
 # --- DATABAS PÅFYLLNING (BULK - UPPDATERAD V30) ---
 
-def populate_database_with_generic_data(db: AgentDB, client: ollama.Client):
-    """Fyller databasen med komponenter i bulk (Inkluderar Laptop-typen)."""
-    
-    print("\n--- 🧠 Steg X: Databaspåfyllning (Generell Hårdvara) Startad ---")
-    
-    BATCH_SIZE = 5
-    total_new_components_logged = 0
+POPULATE_BATCH_SIZE = 5
+POPULATE_TYPE_WORKERS = int(os.environ.get("POPULATE_TYPE_WORKERS", 3))  # Komponenttyper som fylls på samtidigt
+SPEC_FETCH_WORKERS = int(os.environ.get("SPEC_FETCH_WORKERS", 4))        # Samtidiga spec-hämtningar (matcha gärna OLLAMA_NUM_PARALLEL)
+
+def _populate_component_type(component_type: str, known_names: set, spec_pool: concurrent.futures.ThreadPoolExecutor,
+                             results: queue.Queue):
+    """
+    Producent för en komponenttyp: ber LLM:en om nya modeller, hämtar deras specs parallellt på spec_pool
+    och lägger varje färdig batch i results. Rör aldrig databasen; den skrivs bara av populate-tråden.
+    """
+    print(f"\n--- Söker efter nya: {component_type} ---")
+    name_index = ComponentNameIndex(known_names, component_type)
+    iteration = 0
     
-    # KÖRS FÖR BÅDE DESKTOP OCH LAPTOP
-    for component_type in DESKTOP_COMPONENT_TYPES + LAPTOP_COMPONENT_TYPES: 
+    while True:
+        iteration += 1
         
-        print(f"\n--- Söker efter nya: {component_type} ---")
-        iteration = 0
+        if len(known_names) > MAX_RETRIES_UNIQUE_CPU: 
+             exclusion_list_str = f"flera olika modeller, undvik de {len(known_names)} du redan föreslagit."
+        else:
+             exclusion_list_str = ", ".join(list(known_names))
         
-        while True:
-            iteration += 1
-            new_components_in_batch = 0
-            
-            existing_components = db.get_all_component_names()
-            
-            if len(existing_components) > MAX_RETRIES_UNIQUE_CPU: 
-                 exclusion_list_str = f"flera olika modeller, undvik de {len(existing_components)} du redan föreslagit."
-            else:
-                 exclusion_list_str = ", ".join(list(existing_components))
-            
-            
-            list_prompt_system = (
-                f"Du är en hårdvarukatalog. Lista {BATCH_SIZE} moderna, högpresterande {component_type} modeller. "
-                f"Fokusera på nya och olika modeller. Svara ENDAST med ett JSON array av strängar: [\"Modell Namn 1\", \"Modell Namn 1\", ...]. "
-                f"Undvik specifikt dessa modeller: {exclusion_list_str}"
+        
+        list_prompt_system = (
+            f"Du är en hårdvarukatalog. Lista {POPULATE_BATCH_SIZE} moderna, högpresterande {component_type} modeller. "
+            f"Fokusera på nya och olika modeller. Svara ENDAST med ett JSON array av strängar: [\"Modell Namn 1\", \"Modell Namn 1\", ...]. "
+            f"Undvik specifikt dessa modeller: {exclusion_list_str}"
+        )
+        list_prompt_user = f"Lista ett nytt batch av {component_type}."
+        
+        print(f"  > [{component_type}] Iteration {iteration}: Ber LLM om {POPULATE_BATCH_SIZE} nya {component_type} (Kända: {len(known_names)}) ...")
+        
+        try:
+            response_list = llm_chat(
+                'component_list',
+                [
+                    {'role': 'system', 'content': list_prompt_system},
+                    {'role': 'user', 'content': list_prompt_user},
+                ]
             )
-            list_prompt_user = f"Lista ett nytt batch av {component_type}."
             
-            print(f"  > Iteration {iteration}: Ber LLM om {BATCH_SIZE} nya {component_type} (Kända: {len(existing_components)}) ...")
+            component_list = clean_and_parse_json(response_list['message']['content'])
             
-            try:
-                response_list = client.chat(
-                    model=OLLAMA_MODEL,
-                    messages=[
-                        {'role': 'system', 'content': list_prompt_system},
-                        {'role': 'user', 'content': list_prompt_user},
-                    ]
-                )
-                
-                component_list = clean_and_parse_json(response_list['message']['content'])
-                
-                if not isinstance(component_list, list) or not component_list:
-                    if iteration > 1: break 
-                    print(f"  ❌ LLM returnerade en ogiltig eller tom lista för {component_type}. Går vidare.")
-                    break
-
-            except Exception as e:
-                print(f"  ❌ FEL vid hämtning av {component_type}-lista i iteration {iteration}: {e}. Går vidare.")
+            if not isinstance(component_list, list) or not component_list:
+                if iteration > 1: break 
+                print(f"  ❌ LLM returnerade en ogiltig eller tom lista för {component_type}. Går vidare.")
                 break
 
-            print(f"  ✅ LLM föreslog {len(component_list)} {component_type}. Börjar validera och hämta detaljer...")
-            
-            for component_name in component_list:
-                if component_name in existing_components:
+        except Exception as e:
+            print(f"  ❌ FEL vid hämtning av {component_type}-lista i iteration {iteration}: {e}. Går vidare.")
+            break
+
+        # Varianter av redan kända modeller (och dubbletter inom batchen) slås ihop innan några specs hämtas
+        new_names = []
+        for name in dict.fromkeys(component_list):
+            if not isinstance(name, str) or not name.strip():
+                continue
+            existing = name_index.find(name)
+            if existing is None:
+                name_index.add(name)
+                new_names.append(name)
+            elif existing != name:
+                print(f"    ↪️ [{component_type}] '{name}' är samma modell som '{existing}'; hoppar över.")
+        print(f"  ✅ [{component_type}] LLM föreslog {len(component_list)} {component_type} ({len(new_names)} nya). Hämtar detaljer...")
+        
+        # Specs för hela batchen i ett LLM-anrop; bara misslyckade element hämtas om (parallellt på spec_pool)
+        batch_details = []
+        for component_name, details in fetch_component_details_batch(new_names, component_type, spec_pool).items():
+            if details:
+                try:
+                    details['price_sek'] = float(details['price_sek'])
+                    details['component_name'] = component_name # Lagras under det namn som indexet känner till
+                    batch_details.append(details)
+                    known_names.add(component_name) 
                     continue
-                    
-                details = fetch_component_details(client, component_name, component_type)
-                
-                if details:
-                    try:
-                        details['price_sek'] = float(details['price_sek'])
-                        db.log_hardware_details(details)
-                        print(f"    ✅ Loggade NY KOMPONENT: {component_name} ({component_type}) (Pris: {details['price_sek']:.0f} kr).")
-                        
-                        existing_components.add(component_name) 
-                        total_new_components_logged += 1
-                        new_components_in_batch += 1
-                    except (ValueError, TypeError, KeyError) as e:
-                        print(f"    ⚠️ Kunde inte konvertera/logga data för {component_name}: {e}")
-                
-                time.sleep(0.1) 
-            
-            if new_components_in_batch == 0 and iteration > 1:
-                print(f"  🛑 Iteration {iteration}: Inga unika {component_type} lades till. Databasen är mättad för denna typ.")
-                break
-            
-            print(f"  > {new_components_in_batch} nya {component_type} lades till. Totalt nya: {total_new_components_logged}. Fortsätter sökning...")
+                except (ValueError, TypeError) as e:
+                    print(f"    ⚠️ Kunde inte konvertera/logga data för {component_name}: {e}")
+            name_index.discard(component_name) # Misslyckad hämtning: modellen får föreslås igen
+        
+        if batch_details:
+            results.put((component_type, batch_details))
+        
+        if not batch_details and iteration > 1:
+            print(f"  🛑 [{component_type}] Iteration {iteration}: Inga unika {component_type} lades till. Databasen är mättad för denna typ.")
+            break
+        
+        print(f"  > [{component_type}] {len(batch_details)} nya {component_type} hittades. Fortsätter sökning...")
 
-    print(f"\n--- Databas påfyllning slutförd. Totalt {total_new_components_logged} nya komponenter lades till. ---")
+def populate_database_with_generic_data(db: AgentDB):
+    """
+    Fyller databasen med komponenter i bulk (Inkluderar Laptop-typen). Komponenttyperna fylls på
+    parallellt och specs för en hel batch hämtas samtidigt; alla resultat går via en kö till den här
+    tråden, som är den enda som skriver till databasen (en executemany-transaktion per batch).
+    """
+    
+    print("\n--- 🧠 Steg X: Databaspåfyllning (Generell Hårdvara) Startad ---")
+    start = time.monotonic()
+    total_new_components_logged = 0
+    results = queue.Queue()
+    known_names = db.get_all_component_names()
+    component_types = DESKTOP_COMPONENT_TYPES + LAPTOP_COMPONENT_TYPES # KÖRS FÖR BÅDE DESKTOP OCH LAPTOP
+    
+    with concurrent.futures.ThreadPoolExecutor(max_workers=SPEC_FETCH_WORKERS, thread_name_prefix="spec-fetch") as spec_pool, \
+         concurrent.futures.ThreadPoolExecutor(max_workers=POPULATE_TYPE_WORKERS, thread_name_prefix="populate-type") as type_pool:
+        producers = [type_pool.submit(_populate_component_type, component_type, set(known_names), spec_pool, results)
+                     for component_type in component_types]
+        
+        # Ensam databasskrivare: tömmer kön tills alla producenter är klara
+        while True:
+            try:
+                component_type, batch_details = results.get(timeout=0.5)
+            except queue.Empty:
+                if all(p.done() for p in producers) and results.empty():
+                    break
+                continue
+            db.log_hardware_details_many(batch_details)
+            for details in batch_details:
+                print(f"    ✅ Loggade NY KOMPONENT: {details['component_name']} ({component_type}) (Pris: {details['price_sek']:.0f} kr).")
+            total_new_components_logged += len(batch_details)
+        
+        for producer in producers:
+            if producer.exception():
+                print(f"  ❌ FEL i påfyllningen: {producer.exception()}")
+
+    print(f"\n--- Databas påfyllning slutförd på {time.monotonic() - start:.0f} s. Totalt {total_new_components_logged} nya komponenter lades till. ---")
 
 
 # --- KÄRNFUNKTIONER (KÖPCYKEL - V30) ---
 
-def analyze_and_upgrade_hardware_v30(db: AgentDB, client: ollama.Client, system_type: str, max_budget: float) -> bool:
+def analyze_and_upgrade_hardware_v30(db: AgentDB, system_type: str, max_budget: float) -> bool:
     """
     Analysera systemet (komponent eller systembyte) och rekommendera den bästa P/P-uppgraderingen/bytet.
     """
@@ -579,9 +1139,9 @@ def analyze_and_upgrade_hardware_v30(db: AgentDB, client: ollama.Client, system_
         f"Vilken är den bästa enskilda uppgraderingen baserad på P/P, och varför? Nuvarande saldo: {current_balance:,.0f} kr."
     )
 
-    response_2 = client.chat(
-        model=OLLAMA_MODEL,
-        messages=[
+    response_2 = llm_chat(
+        'upgrade_decision',
+        [
             {'role': 'system', 'content': system_prompt_2},
             {'role': 'user', 'content': user_prompt_2},
         ]
@@ -604,10 +1164,14 @@ def analyze_and_upgrade_hardware_v30(db: AgentDB, client: ollama.Client, system_
     print("\n--- Steg 3: Hämta detaljerade specifikationer och pris via LLM/RapidAPI... ---")
     
     detailed_data = None
-    is_new_component = not db.check_if_component_exists(recommended_component)
+    existing_name = db.find_component(recommended_component, recommended_type)
+    if existing_name and existing_name != recommended_component:
+        print(f"  > '{recommended_component}' är samma modell som katalogens '{existing_name}'; använder den.")
+        recommended_component = existing_name
+    is_new_component = existing_name is None
 
     if is_new_component:
-        detailed_data = fetch_component_details(client, recommended_component, recommended_type)
+        detailed_data = fetch_component_details(recommended_component, recommended_type)
         if detailed_data:
             db.log_hardware_details(detailed_data)
             print(f"✅ Detaljerade specifikationer loggades i databasen för {recommended_component}.")
@@ -636,24 +1200,27 @@ def analyze_and_upgrade_hardware_v30(db: AgentDB, client: ollama.Client, system_
 
     if old_component_name and old_component_name != recommended_component:
         print(f"\n--- Steg 4: Inbytesanalys (Säljer gammal: {old_component_name}) ---")
-        sale_value = get_simulated_tradein_value(client, old_component_name, recommended_type)
+        sale_value = get_simulated_tradein_value(old_component_name, recommended_type)
 
     # Beräkna nettokostnaden (Köppris - Försäljningsvärde)
     net_cost = actual_price - sale_value
 
     if net_cost <= current_balance and actual_price <= max_budget:
         
-        # Utför transaktion
+        # Utför transaktion (saldo, köp, försäljning och installerad komponent skrivs tillsammans eller inte alls)
         new_balance = current_balance - net_cost
-        db.update_balance(new_balance)
-        db.log_purchase(recommended_component, recommended_type, actual_price)
-        
+        with db.transaction():
+            db.update_balance(new_balance)
+            db.log_purchase(recommended_component, recommended_type, actual_price)
+            
+            if sale_value > 0:
+                db.log_sale(old_component_name, recommended_type, sale_value)
+
+            # --- VIKTIGT: Uppdatera systemets installerade komponent ---
+            db.set_current_component_name(recommended_type, recommended_component)
+
         if sale_value > 0:
-            db.log_sale(old_component_name, recommended_type, sale_value)
             print(f"✅ FÖRSÄLJNING GENOMFÖRD: {old_component_name} såldes för {sale_value:,.2f} kr. Saldo ökade.")
-
-        # --- VIKTIGT: Uppdatera systemets installerade komponent ---
-        db.set_current_component_name(recommended_type, recommended_component)
         
         print(f"✅ KÖP GENOMFÖRT! Simulerat köp av {recommended_component} ({recommended_type}) för {actual_price:,.2f} kr. Nettokostnad: {net_cost:,.2f} kr.")
         print(f"💰 NYTT SALDO (Efter transaktion): **{new_balance:,.2f} kr**.")
@@ -668,7 +1235,7 @@ def analyze_and_upgrade_hardware_v30(db: AgentDB, client: ollama.Client, system_
         
         return False 
 
-def run_upgrade_cycle(db: AgentDB, client: ollama.Client, system_type: str, max_budget: float):
+def run_upgrade_cycle(db: AgentDB, system_type: str, max_budget: float):
     """Kör den kontinuerliga uppgraderingscykeln (använder V30-analysen)."""
     
     upgrade_count = 0
@@ -677,7 +1244,7 @@ def run_upgrade_cycle(db: AgentDB, client: ollama.Client, system_type: str, max_
         print(f"🧠 KONTINUERLIG UPPGRADERINGSANALYS #{upgrade_count + 1} STARTAR ({system_type}-läge)")
         print(f"=======================================================")
         
-        purchase_successful = analyze_and_upgrade_hardware_v30(db, client, system_type, max_budget)
+        purchase_successful = analyze_and_upgrade_hardware_v30(db, system_type, max_budget)
         
         if purchase_successful:
             upgrade_count += 1
@@ -699,26 +1266,23 @@ def generate_summary(db: AgentDB, initial_budget: float, final_budget: float):
     print("🚀 SLUTLIG SYSTEMSAMMANSTÄLLNING OCH EKONOMI (V30)")
     print("=======================================================")
     
-    # 1. Ekonomisk sammanfattning
-    total_spent = 0.0
-    total_earned = 0.0
-    
-    db.cursor.execute("SELECT cost_sek FROM purchases")
-    for cost in db.cursor.fetchall():
-        total_spent += cost[0]
-        
-    db.cursor.execute("SELECT sale_price_sek FROM sales")
-    for price in db.cursor.fetchall():
-        total_earned += price[0]
+    # 1. Ekonomisk sammanfattning (summorna beräknas i SQL)
+    totals = db.get_transaction_totals()
+    total_spent = totals['total_spent']
+    total_earned = totals['total_earned']
         
     net_cost = total_spent - total_earned
     
     print("\n--- EKONOMI ---")
     print(f"Initial Budget (Max): {initial_budget:,.2f} kr")
     print(f"Slutligt Saldo:       {final_budget:,.2f} kr")
-    print(f"Totala Köp:           {total_spent:,.2f} kr")
-    print(f"Totala Försäljningar: +{total_earned:,.2f} kr")
+    print(f"Totala Köp:           {total_spent:,.2f} kr ({totals['purchase_count']} st)")
+    print(f"Totala Försäljningar: +{total_earned:,.2f} kr ({totals['sale_count']} st)")
     print(f"Netto Kostnad:        {net_cost:,.2f} kr")
+
+    print("\n--- KOMPONENTKATALOG ---")
+    for comp_type, count, min_price, avg_price, max_price in db.get_catalog_stats():
+        print(f"  {comp_type:<12}: {count:>4} st, {min_price:,.0f} - {max_price:,.0f} kr (snitt {avg_price:,.0f} kr)")
     
     # 2. Hårdvarusammanfattning
     print("\n--- SLUTLIG HÅRDVARUKONFIGURATION ---")
@@ -752,16 +1316,10 @@ def generate_summary(db: AgentDB, initial_budget: float, final_budget: float):
         
     # 3. Transaktionshistorik
     print("\n--- DETALJERAD TRANSAKTIONSHISTORIK ---")
-    db.cursor.execute("SELECT item_name, item_type, cost_sek, purchase_date FROM purchases ORDER BY purchase_date ASC")
-    purchases = db.cursor.fetchall()
-    
-    db.cursor.execute("SELECT item_name, item_type, sale_price_sek, sale_date FROM sales ORDER BY sale_date ASC")
-    sales = db.cursor.fetchall()
-    
-    for item, item_type, cost, date in purchases:
+    for item, item_type, cost, date in db.iter_purchases():
          print(f"  [KÖP] -{cost:,.2f} kr: {item} ({item_type}) @ {date}")
 
-    for item, item_type, price, date in sales:
+    for item, item_type, price, date in db.iter_sales():
          print(f"  [SÄLJ] +{price:,.2f} kr: {item} (Gammal {item_type}) @ {date}")
 
 
@@ -769,14 +1327,16 @@ def generate_summary(db: AgentDB, initial_budget: float, final_budget: float):
 
 
 if __name__ == "__main__":
+    if '--check-names' in sys.argv:
+        # Kontroll av namnnormaliseringen: python system_agent_v31.py --check-names (kräver varken Ollama eller databas)
+        sys.exit(0 if check_component_name_matching() else 1)
     db = None
     try:
         db = AgentDB()
-        client = ollama.Client(host=OLLAMA_HOST) 
         
         # 1. Detektera systemtyp (använder OS-info)
         initial_hardware_info = get_current_hardware_info()
-        system_type = detect_system_type(client, initial_hardware_info)
+        system_type = detect_system_type(initial_hardware_info)
         
         # 2. Sätt rätt budget och initial komponent
         if system_type == "Laptop":
@@ -784,12 +1344,12 @@ if __name__ == "__main__":
             db.set_balance(max_budget)
             
             # Få det exakta Laptop-modellnamnet
-            initial_system_name = fetch_initial_laptop_model(client, initial_hardware_info)
+            initial_system_name = fetch_initial_laptop_model(initial_hardware_info)
             db.set_current_component_name("Laptop", initial_system_name)
             
             # Logga initial info för att möjliggöra försäljning/detaljanalys
             if not db.check_if_component_exists(initial_system_name):
-                 initial_details = fetch_component_details(client, initial_system_name, "Laptop")
+                 initial_details = fetch_component_details(initial_system_name, "Laptop")
                  if initial_details:
                      db.log_hardware_details(initial_details)
 
@@ -802,16 +1362,16 @@ if __name__ == "__main__":
             db.set_current_component_name("CPU", initial_system_name)
             
             if not db.check_if_component_exists(initial_system_name):
-                 initial_details = fetch_component_details(client, initial_system_name, "CPU")
+                 initial_details = fetch_component_details(initial_system_name, "CPU")
                  if initial_details:
                      db.log_hardware_details(initial_details)
 
 
         # 3. Kör den kontinuerliga köp/analyscykeln
-        run_upgrade_cycle(db, client, system_type, max_budget)
+        run_upgrade_cycle(db, system_type, max_budget)
         
         # 4. Fyll på databasen med generell information (Om tid/resurser finns)
-        populate_database_with_generic_data(db, client)
+        populate_database_with_generic_data(db)
         
         # 5. Generera sammanställning
         generate_summary(db, max_budget, db.get_balance())